@@ -51,4 +51,10 @@ canonical_ez = np.array([0, 0, 1])
 
 degree = math.pi/180.0
 
-numerical_tolerance = 1e-17
\ No newline at end of file
+numerical_tolerance = 1e-17
+
+# invalid rays are removed from a RayBundle at the next refraction or
+# reflection if their fraction exceeds this threshold; the default 0
+# removes every invalid ray, such that e.g. rays lost by total internal
+# reflection (NaN positions) never reach the merit functions
+compaction_threshold = 0.
\ No newline at end of file
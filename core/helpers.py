@@ -33,7 +33,7 @@ from optical_element import OpticalElement
 from surface import Surface
 from surfShape import Conic
 from globalconstants import numerical_tolerance, canonical_ey, standard_wavelength
-from ray import RayBundle
+from ray import RayBundle, raybundle_chunks
 from material_isotropic import ConstantIndexGlass
 from helpers_math import rodrigues
 from material_glasscat import refractiveindex_dot_info_glasscatalog
@@ -167,6 +167,16 @@ def collimated_bundle(nrays, startz, starty, radius, rast):
     return (o, k, E0)
 
 
+def collimated_bundle_chunks(nrays, startz, starty, radius, rast, chunksize, wave=standard_wavelength):
+    """
+    Streaming variant of collimated_bundle for OpticalSystem.seqtrace_chunked.
+    
+    :return generator of RayBundle objects with at most chunksize rays
+    """
+    (o, k, E0) = collimated_bundle(nrays, startz, starty, radius, rast)
+    return raybundle_chunks(o, k, E0, chunksize, wave=wave)
+
+
 def build_pilotbundle(surfobj, mat, (dx, dy), (phix, phiy), Elock=None, 
                       kunitvector=None, lck=None, wave=standard_wavelength, 
                       num_sampling_points=5, random_xy=False):
@@ -272,9 +282,12 @@ def build_pilotbundle(surfobj, mat, (dx, dy), (phix, phiy), Elock=None,
         kglob = mat.lc.returnLocalToGlobalDirections(k_4[j])
         Eglob = mat.lc.returnLocalToGlobalDirections(E_4[j])
                 
+        # pilot rays are never removed, since the transfer matrices
+        # are calculated from the complete pilot bundles
         pilotbundles.append(RayBundle(
                 x0 = xglob, 
                 k0 = kglob, 
-                Efield0 = Eglob, wave=wave
+                Efield0 = Eglob, wave=wave,
+                compaction_threshold = 1.
                 ))
     return pilotbundles
\ No newline at end of file
@@ -36,6 +36,81 @@ def checkfinite(vec):
     return np.any(np.isfinite(vec) ^ True, axis=0) ^ True
 
 
+def polyroots(coeffs, polish=2):
+    """
+    Calculates the roots of N polynomials at once. Like np.roots, the
+    roots are the eigenvalues of the companion matrices, but all N
+    matrices are stacked and solved in one call. The roots are then 
+    polished by Newton steps which are only accepted if they decrease
+    the absolute value of the polynomial (double roots are therefore
+    left untouched).
+    
+    :param coeffs: (list or (deg+1)xN numpy array) 
+                   polynomial coefficients, highest power first;
+                   the leading coefficients must not vanish
+    :param polish: (int) number of Newton steps
+    
+    :return roots: (degxN numpy array of complex)
+    """
+    coeffs = np.array(np.broadcast_arrays(*coeffs), dtype=complex)
+    (num_coeffs, num_pts) = np.shape(coeffs)
+    deg = num_coeffs - 1
+    
+    companion = np.zeros((num_pts, deg, deg), dtype=complex)
+    companion[:, 0, :] = -(coeffs[1:]/coeffs[0]).T
+    companion[:, range(1, deg), range(deg - 1)] = 1.
+    roots = np.linalg.eigvals(companion).T
+
+    def horner(z):
+        p = np.zeros_like(z)
+        dp = np.zeros_like(z)
+        for c in coeffs:
+            dp = dp*z + p
+            p = p*z + c
+        return (p, dp)
+
+    (p, dp) = horner(roots)
+    for i in range(polish):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newroots = roots - p/dp
+        (newp, newdp) = horner(newroots)
+        better = np.isfinite(newroots) & (np.abs(newp) < np.abs(p))
+        roots = np.where(better, newroots, roots)
+        p = np.where(better, newp, p)
+        dp = np.where(better, newdp, dp)
+
+    return roots
+
+
+def det3x3(m):
+    """
+    Determinants of N stacked 3x3 matrices by cofactor expansion.
+    
+    :param m: (3x3xN numpy array)
+    
+    :return det: (1d numpy array of N elements)
+    """
+    return m[0, 0]*(m[1, 1]*m[2, 2] - m[1, 2]*m[2, 1]) \
+        - m[0, 1]*(m[1, 0]*m[2, 2] - m[1, 2]*m[2, 0]) \
+        + m[0, 2]*(m[1, 0]*m[2, 1] - m[1, 1]*m[2, 0])
+
+
+def rotate_tensors(rotation, tensors):
+    """
+    Similarity transform R T R^T of one or N stacked 3x3 tensors
+    by broadcasting; only the result array is allocated.
+    
+    :param rotation: (3x3 numpy array)
+    :param tensors: (3x3 or 3x3xN numpy array)
+    
+    :return rotated tensors: (same shape as tensors)
+    """
+    if tensors.ndim == 2:
+        return np.dot(rotation, np.dot(tensors, rotation.T))
+    return np.einsum('ikn,lk->iln', 
+                     np.einsum('ij,jkn->ikn', rotation, tensors), rotation)
+
+
 def checkEcompatibility2(E, E1, E2, tol=1e-8):
     """
     Checks whether E is in the subspace spanned by
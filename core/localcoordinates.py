@@ -28,8 +28,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 import math
 import random
+import weakref
 
-from helpers_math import rodrigues
+from helpers_math import rodrigues, rotate_tensors
 
 from optimize import ClassWithOptimizableVariables, OptimizableVariable
 
@@ -81,9 +82,29 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         self.localrotation = np.lib.eye(3)
         self.localbasis = np.lib.eye(3)
 
+        # dirty checking: variable values and parent (version) which were
+        # used for the last calculation of the global transformation;
+        # version is increased whenever the global transformation changes
+        self.version = 0
+        self.__state = None
+        self.__parentstate = None
+        # cached transformations to other systems; weak keys, such that
+        # temporary systems are not kept alive by the cache
+        self.__transforms = weakref.WeakKeyDictionary()
+
         self.update() # initial update
 
 
+    def __getstate__(self):
+        # the transformation cache is rebuilt on demand
+        state = super(LocalCoordinates, self).__getstate__()
+        state.pop("_LocalCoordinates__transforms", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__transforms = weakref.WeakKeyDictionary()
+
     def getChildren(self):
         return self.__children
         
@@ -103,6 +124,7 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         childlc.parent = self
         childlc.update()
         self.__children.append(childlc)
+        self.invalidateVariableRegistry()
         return childlc
         
     def addChildToReference(self, refname, childlc):
@@ -216,11 +238,47 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         self.localdecenter = np.array([decx, decy, decz])
         self.localrotation = self.calculateMatrixFromTilt(tiltx, tilty, tiltz, self.tiltThenDecenter)
 
+    def getState(self):
+        '''
+        Values which determine the local transformation.
+        '''
+        return (self.decx.evaluate(), self.decy.evaluate(), self.decz.evaluate(),
+                self.tiltx.evaluate(), self.tilty.evaluate(), self.tiltz.evaluate(),
+                self.tiltThenDecenter)
+
     def update(self):
         ''' 
         runs through all references specified and sums up 
         coordinates and local rotations to get appropriate 
         global coordinate
+
+        Only coordinate systems whose variables or parents changed since
+        the last update are recalculated and inform their observers.
+        '''
+        state = self.getState()
+        parentstate = None
+        if self.parent is not None:
+            parentstate = (self.parent, self.parent.version)
+        
+        changed = (state != self.__state or parentstate != self.__parentstate)
+        
+        if changed:
+            self.__state = state
+            self.__parentstate = parentstate
+            self.calculateGlobal()
+            self.version += 1
+        
+        for ch in self.__children:
+            ch.update()
+
+        # inform observers about update
+        if changed:
+            self.informObservers()
+
+    def calculateGlobal(self):
+        '''
+        Calculates local rotation and decenter and from those and the
+        parent the global basis and coordinates.
         '''
         self.calculate()
 
@@ -244,12 +302,26 @@ class LocalCoordinates(ClassWithOptimizableVariables):
             parentcoordinates + \
             np.dot(self.localbasis, self.localdecenter)
             # TODO: removed .T on localbasis to obtain correct behavior; examine!
-        
-        for ch in self.__children:
-            ch.update()
 
-        # inform observers about update
-        self.informObservers()
+    def returnTransformationTo(self, lcother):
+        '''
+        Affine transformation from self to lcother. It is cached until one
+        of both coordinate systems changes.
+
+        @param: lcother -- target coordinate system (object)
+
+        @return: transform -- 4x4 numpy array, 
+                 x_other = transform[:3, :3] x_self + transform[:3, 3]
+        '''
+        entry = self.__transforms.get(lcother)
+        if entry is None or entry[0] != (self.version, lcother.version):
+            transform = np.lib.eye(4)
+            transform[:3, :3] = np.dot(lcother.localbasis.T, self.localbasis)
+            transform[:3, 3] = np.dot(lcother.localbasis.T, 
+                                      self.globalcoordinates - lcother.globalcoordinates)
+            entry = ((self.version, lcother.version), transform)
+            self.__transforms[lcother] = entry
+        return entry[1]
 
     def aimAt(self, anotherlc, update=False):
         (tiltx, tilty, tiltz) = self.calculateAim(anotherlc)
@@ -297,31 +369,32 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         
     def returnActualToOtherPoints(self, localpts, lcother):
         # TODO: constraint: lcother and self share same root, check: lcother=self
-        globalpts = self.returnLocalToGlobalPoints(localpts)
-        return lcother.returnGlobalToLocalPoints(globalpts)
+        transform = self.returnTransformationTo(lcother)
+        # construction to use broadcasting
+        return (np.dot(transform[:3, :3], localpts).T + transform[:3, 3]).T
 
     def returnOtherToActualPoints(self, otherpts, lcother):
         # TODO: constraint: lcother and self share same root        
-        globalpts = lcother.returnLocalToGlobalPoints(otherpts)
-        return self.returnGlobalToLocalPoints(globalpts)
+        return lcother.returnActualToOtherPoints(otherpts, self)
        
     def returnActualToOtherDirections(self, localdirs, lcother):
         # TODO: constraint: lcother and self share same root
-        globaldirs = self.returnLocalToGlobalDirections(localdirs)
-        return lcother.returnGlobalToLocalDirections(globaldirs)
+        return np.dot(self.returnTransformationTo(lcother)[:3, :3], localdirs)
 
     def returnOtherToActualDirections(self, otherdirs, lcother):
-        globaldirs = lcother.returnLocalToGlobalDirections(otherdirs)
-        return self.returnGlobalToLocalDirections(globaldirs)
+        return lcother.returnActualToOtherDirections(otherdirs, self)
         
     def returnActualToOtherTensors(self, localtensors, lcother):
+        """
+        @param: localtensors (3x3 or 3x3xN numpy array)
+        @return: othertensors (same shape as localtensors)
+        """
         # TODO: constraint: lcother and self share same root
-        globaltensors = self.returnLocalToGlobalTensorss(localtensors)
-        return lcother.returnGlobalToLocalDirections(globaltensors)
+        return rotate_tensors(self.returnTransformationTo(lcother)[:3, :3], 
+                              localtensors)
 
     def returnOtherToActualTensors(self, othertensors, lcother):
-        globaltensors = lcother.returnLocalToGlobalTensors(othertensors)
-        return self.returnGlobalToLocalTensors(globaltensors)
+        return lcother.returnActualToOtherTensors(othertensors, self)
 
 
     def returnLocalToGlobalPoints(self, localpts):
@@ -362,25 +435,20 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         
     def returnGlobalToLocalTensors(self, globaltensor):
         """
-        @param: globaldirs (3x3xN numpy array)
-        @return: localdirs (3x3xN numpy array)
-        """
+        Constant (position independent) tensors may be given as a
+        single 3x3 array; they are transformed only once.
 
-        (num_dims_r, num_dims_c, num_pts) = np.shape(globaltensor)
-        localbasisT = np.repeat(self.localbasis.T[:, :, np.newaxis], num_pts, axis=2)
-        localtensor = np.einsum('lj...,ji...,ki...', localbasisT, globaltensor, localbasisT).T
-        return localtensor
+        @param: globaltensor (3x3 or 3x3xN numpy array)
+        @return: localtensor (same shape as globaltensor)
+        """
+        return rotate_tensors(self.localbasis.T, globaltensor)
 
     def returnLocalToGlobalTensors(self, localtensor):
         """
-        @param: globaldirs (3x3xN numpy array)
-        @return: localdirs (3x3xN numpy array)
+        @param: localtensor (3x3 or 3x3xN numpy array)
+        @return: globaltensor (same shape as localtensor)
         """
-
-        (num_dims_r, num_dims_c, num_pts) = np.shape(localtensor)
-        localbasis = np.repeat(self.localbasis[:, :, np.newaxis], num_pts, axis=2)
-        globaltensor = np.einsum('lj...,ji...,ki...', localbasis, localtensor, localbasis).T
-        return globaltensor
+        return rotate_tensors(self.localbasis, localtensor)
         
 
     def returnConnectedNames(self):
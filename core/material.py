@@ -27,6 +27,7 @@ from optimize import ClassWithOptimizableVariables
 import scipy.linalg as sla
 
 from globalconstants import standard_wavelength
+from helpers_math import polyroots, det3x3
 
 class Material(ClassWithOptimizableVariables):
     """Abstract base class for materials."""
@@ -83,10 +84,31 @@ class MaxwellMaterial(Material):
     def getEpsilonTensor(self, x, wave=standard_wavelength):
         """
         Calculate epsilon tensor if needed. (isotropic e.g.) eps = diag(3)*n^2
+        Homogeneous materials may return a single tensor which is
+        broadcast against the N points by the callers.
         
-        :return epsilon (3x3xN numpy array of complex)
+        :return epsilon (3x3xN or 3x3 numpy array of complex)
         """
         raise NotImplementedError()
+
+    def isHomogeneous(self):
+        """
+        True if the epsilon tensor does not depend on the position.
+        """
+        return False
+
+    def getEpsilonTensorArray(self, x, wave=standard_wavelength):
+        """
+        Epsilon tensor for every point. For homogeneous materials this is
+        a read-only broadcast view of the single tensor.
+        
+        :return epsilon (3x3xN numpy array of complex)
+        """
+        eps = self.getEpsilonTensor(x, wave=wave)
+        if np.ndim(eps) == 2:
+            eps = np.broadcast_to(eps[:, :, np.newaxis], 
+                                  np.shape(eps) + (np.shape(x)[1],))
+        return eps
     
     def calcKnormEfield(self, x, n, kpa_norm, wave=standard_wavelength):
         (xi_4, efield_4) = self.calcXiEigenvectorsNorm(x, n, kpa_norm, wave=wave)
@@ -94,9 +116,7 @@ class MaxwellMaterial(Material):
         # xi_4: 4xN
         # efield_4: 4x3xN
         
-        k_norm_4 = np.zeros_like(efield_4)        
-        for i in range(4):
-            k_norm_4[i, :, :] = kpa_norm + xi_4[i, :]*n
+        k_norm_4 = kpa_norm + xi_4[:, np.newaxis, :]*n
             
         return (k_norm_4, efield_4)
 
@@ -106,9 +126,7 @@ class MaxwellMaterial(Material):
         # xi_4: 4xN
         # efield_4: 4x3xN
         
-        k_norm_4 = np.zeros_like(efield_4)        
-        for i in range(4):
-            k_norm_4[i, :, :] = k_4[i, :]*e
+        k_norm_4 = k_4[:, np.newaxis, :]*e
             
         return (k_norm_4, efield_4)    
     
@@ -125,25 +143,9 @@ class MaxwellMaterial(Material):
         
         """
         
-        (num_dims, num_pts) = np.shape(n)        
-
         (k_norm_4, Efield_4) = self.calcKnormEfield(x, n, kpa_norm, wave=wave)
         
-        k_norm_4_sorted = np.zeros_like(k_norm_4)
-        Efield_4_sorted = np.zeros_like(Efield_4)
-        Sn_scalarproduct = np.zeros((4, num_pts))        
-        
-        
-        for i in range(4):
-            Si = self.calcPoytingVectorNorm(k_norm_4[i, :, :], Efield_4[i, :, :])
-            Sn_scalarproduct[i, :] = np.sum(Si*e, axis=0)
-        
-        Sn_scalarproduct_argsort = Sn_scalarproduct.argsort(axis=0)
-        for i in range(num_pts):
-            k_norm_4_sorted[:, :, i] = k_norm_4[Sn_scalarproduct_argsort[:, i], :, i] 
-            Efield_4_sorted[:, :, i] = Efield_4[Sn_scalarproduct_argsort[:, i], :, i] 
-            
-        return (k_norm_4_sorted, Efield_4_sorted)
+        return self.sortByPoyntingVector(k_norm_4, Efield_4, e)
 
     def sortKnormUnitEField(self, x, kd, e, wave=standard_wavelength):
         """
@@ -158,27 +160,31 @@ class MaxwellMaterial(Material):
         
         """
         
-        (num_dims, num_pts) = np.shape(kd)        
-
         (k_norm_4, Efield_4) = self.calcKnormUnitEfield(x, kd, wave=wave)
         
-        k_norm_4_sorted = np.zeros_like(k_norm_4)
-        Efield_4_sorted = np.zeros_like(Efield_4)
-        Sn_scalarproduct = np.zeros((4, num_pts))        
+        return self.sortByPoyntingVector(k_norm_4, Efield_4, e)
+
+
+    def sortByPoyntingVector(self, k_norm_4, Efield_4, e):
+        """
+        Sort the four k_norm and E-field solutions of every ray by the
+        scalar product of their Poynting vectors with e (ascending).
         
+        :param k_norm_4 (4x3xN array of complex)
+        :param Efield_4 (4x3xN array of complex)
+        :param e (3xN array of float)
         
-        for i in range(4):
-            Si = self.calcPoytingVectorNorm(k_norm_4[i, :, :], Efield_4[i, :, :])
-            Sn_scalarproduct[i, :] = np.sum(Si*e, axis=0)
+        :return (k_norm_4_sorted, Efield_4_sorted)
+        """
+        S_4 = self.calcPoytingVectorNorm(k_norm_4, Efield_4)
+        Sn_scalarproduct = np.einsum("bi...,i...->b...", S_4, e)
         
-        Sn_scalarproduct_argsort = Sn_scalarproduct.argsort(axis=0)
-        for i in range(num_pts):
-            k_norm_4_sorted[:, :, i] = k_norm_4[Sn_scalarproduct_argsort[:, i], :, i] 
-            Efield_4_sorted[:, :, i] = Efield_4[Sn_scalarproduct_argsort[:, i], :, i] 
+        Sn_scalarproduct_argsort = Sn_scalarproduct.argsort(axis=0)[:, np.newaxis, :]
+        k_norm_4_sorted = np.take_along_axis(k_norm_4, Sn_scalarproduct_argsort, axis=0)
+        Efield_4_sorted = np.take_along_axis(Efield_4, Sn_scalarproduct_argsort, axis=0)
             
         return (k_norm_4_sorted, Efield_4_sorted)
 
-
     def sortKEField(self, x, n, kpa, e, wave=standard_wavelength):
         
         k0 =  2.*math.pi/wave
@@ -207,13 +213,12 @@ class MaxwellMaterial(Material):
     
     def calcPoytingVectorNorm(self, k_norm, Efield):
         # S_j = Re((conj(E)_i E_i delta_{jl} - conj(E)_j E_l) k_l)
+        # k_norm, Efield: 3xN or stacked solutions with the vector
+        # components on axis -2 (e.g. 4x3xN)
     
-        (num_dim, num_pts) = np.shape(k_norm)
-                
-        S = np.zeros((num_dim, num_pts), dtype=float)
         S = np.real(
-            np.einsum("i...,i...", np.conj(Efield), Efield)*k_norm 
-            - np.einsum("i...,i...", k_norm, Efield)*np.conj(Efield))
+            np.einsum("...ij,...ij->...j", np.conj(Efield), Efield)[..., np.newaxis, :]*k_norm 
+            - np.einsum("...ij,...ij->...j", k_norm, Efield)[..., np.newaxis, :]*np.conj(Efield))
         return S
     
     def calcKfromUnitVector(self, x, e, wave=standard_wavelength):
@@ -239,20 +244,18 @@ class MaxwellMaterial(Material):
         
         eps = self.getEpsilonTensor(x, wave=wave)
 
+        eps2 = np.einsum('ij...,jk...->ik...', eps, eps)
+
         a1 = np.einsum('ii...', eps)        
-        a2 = np.einsum('ij...,ji...', eps, eps)
-        a3 = np.einsum('ij...,jk...,ki...', eps, eps, eps)
-        a4 = np.einsum('ij...,i...,j...', eps, e, e)        
-        a5 = np.einsum('ij...,jk...,i...,k...', eps, eps, e, e)
+        a2 = np.einsum('ii...', eps2)
+        a3 = np.einsum('ij...,ji...', eps2, eps)
+        a4 = np.einsum('i...,ij...,j...', e, eps, e)        
+        a5 = np.einsum('i...,ij...,j...', e, eps2, e)
 
         p2 = (-a4*a1 + a5)#*k0**2 # remove k0?
         p0 = 1./6.*(a1**3 - 3*a1*a2 + 2*a3)#*k0**4
         
-        kappaarray = np.zeros((4, num_pts), dtype=complex)
-
-        for i in np.arange(num_pts):       
-            polycoeffs = [a4[i], 0, p2[i], 0, p0[i]]
-            kappaarray[:, i] = np.roots(polycoeffs)
+        kappaarray = polyroots([a4, np.zeros(num_pts), p2, np.zeros(num_pts), p0])
 
         kvectors = np.repeat(kappaarray[:, np.newaxis, :], 3, axis=1)*e
         
@@ -277,22 +280,20 @@ class MaxwellMaterial(Material):
         
         eps = self.getEpsilonTensor(x, wave=wave)
 
+        eps2 = np.einsum('ij...,jk...->ik...', eps, eps)
+
         a1 = np.einsum('ii...', eps)        
-        a2 = np.einsum('ij...,ji...', eps, eps)
-        a3 = np.einsum('ij...,jk...,ki...', eps, eps, eps)
-        a4 = np.einsum('ij...,i...,j...', eps, kd, kd)        
-        a5 = np.einsum('ij...,jk...,i...,k...', eps, eps, kd, kd)
+        a2 = np.einsum('ii...', eps2)
+        a3 = np.einsum('ij...,ji...', eps2, eps)
+        a4 = np.einsum('i...,ij...,j...', kd, eps, kd)        
+        a5 = np.einsum('i...,ij...,j...', kd, eps2, kd)
         a6 = np.einsum('i...,i...', kd, kd)
 
         p4 = a4*a6        
         p2 = (-a4*a1 + a5)#*k0**2 # remove k0?
         p0 = 1./6.*(a1**3 - 3*a1*a2 + 2*a3)#*k0**4
         
-        kappaarray = np.zeros((4, num_pts), dtype=complex)
-
-        for i in np.arange(num_pts):       
-            polycoeffs = [p4[i], 0, p2[i], 0, p0[i]]
-            kappaarray[:, i] = np.roots(polycoeffs)
+        kappaarray = polyroots([p4, np.zeros(num_pts), p2, np.zeros(num_pts), p0])
 
         kvectors = np.repeat(kappaarray[:, np.newaxis, :], 3, axis=1)*kd
         
@@ -332,11 +333,7 @@ class MaxwellMaterial(Material):
         p1 = a1*a9 + a8minusa7*a2 + a6 + 2*a3*a4plusa5
         p0 = 2*a3*a9 + a8minusa7*a4plusa5 + a10 + a11 
         
-        kappaarray = np.zeros((3, num_pts), dtype=complex)
-
-        for i in np.arange(num_pts):       
-            polycoeffs = [p3[i], p2[i], p1[i], p0[i]]
-            kappaarray[:, i] = np.roots(polycoeffs)
+        kappaarray = polyroots([p3, p2, p1, p0])
 
         kvectors = k + (np.repeat(kappaarray[:, np.newaxis, :], 3, axis=1)*kd)
         
@@ -346,7 +343,7 @@ class MaxwellMaterial(Material):
     def calcXiQEVMatricesNorm(self, x, n, kpa_norm, wave=standard_wavelength):
 
         (num_dims, num_pts) = np.shape(kpa_norm)
-        eps = self.getEpsilonTensor(x, wave=wave)
+        eps = self.getEpsilonTensorArray(x, wave=wave)
 
         # quadratic eigenvalue problem (xi^2 M + xi C + K) e = 0
         # build up 6x6 matrices for generalized linear ev problem
@@ -440,7 +437,7 @@ class MaxwellMaterial(Material):
     def calcKEigenvectorsNorm(self, x, e, wave=standard_wavelength):
         
         (num_dims, num_pts) = np.shape(x)
-        eps = self.getEpsilonTensor(x, wave=wave)
+        eps = self.getEpsilonTensorArray(x, wave=wave)
 
         eigenvectors = np.zeros((4, 3, num_pts), dtype=complex)
         eigenvalues = np.zeros((4, num_pts), dtype=complex)
@@ -502,19 +499,27 @@ class MaxwellMaterial(Material):
 
         eps = self.getEpsilonTensor(x, wave=wave)
 
+        # eps may be a single 3x3 tensor (homogeneous material), then the
+        # invariants a1, a2, a3 and eps^2 are only calculated once and
+        # the matrix vector products broadcast over the N rays
+        eps2 = np.einsum('ij...,jk...->ik...', eps, eps)
+        eps_kpa = np.einsum('ij...,j...->i...', eps, kpa_norm)
+        eps_n = np.einsum('ij...,j...->i...', eps, n)
+        eps2_kpa = np.einsum('ij...,j...->i...', eps2, kpa_norm)
+        eps2_n = np.einsum('ij...,j...->i...', eps2, n)
 
         a1 = np.einsum('ii...', eps)        
-        a2 = np.einsum('ij...,ji...', eps, eps)
-        a3 = np.einsum('ij...,jk...,ki...', eps, eps, eps)
+        a2 = np.einsum('ii...', eps2)
+        a3 = np.einsum('ij...,ji...', eps2, eps)
         a4 = np.einsum('i...,i...', kpa_norm, kpa_norm)
-        a5 = np.einsum('ij...,i...,j...', eps, kpa_norm, kpa_norm)
-        a6 = np.einsum('ij...,jk...,i...,k...', eps, eps, kpa_norm, kpa_norm)
-        a7 = np.einsum('ij...,i...,j...', eps, n, n)        
-        a8 = np.einsum('ij...,j...,i...', eps, kpa_norm, n)
-        a9 = np.einsum('ij...,i...,j...', eps, kpa_norm, n)
-        a11 = np.einsum('ij...,jk...,k...,i...', eps, eps, kpa_norm, n)
-        a12 = np.einsum('ij...,jk...,i...,k...', eps, eps, kpa_norm, n)
-        a13 = np.einsum('ij...,jk...,i...,k...', eps, eps, n, n)
+        a5 = np.einsum('i...,i...', kpa_norm, eps_kpa)
+        a6 = np.einsum('i...,i...', kpa_norm, eps2_kpa)
+        a7 = np.einsum('i...,i...', n, eps_n)
+        a8 = np.einsum('i...,i...', n, eps_kpa)
+        a9 = np.einsum('i...,i...', kpa_norm, eps_n)
+        a11 = np.einsum('i...,i...', n, eps2_kpa)
+        a12 = np.einsum('i...,i...', kpa_norm, eps2_n)
+        a13 = np.einsum('i...,i...', n, eps2_n)
 
         #p4 = a7*omegabar**2
         #p3 = (2*a10*a7 + a8 + a9)*omegabar**2
@@ -548,12 +553,7 @@ class MaxwellMaterial(Material):
 
         (p4, p3, p2, p1, p0) = self.calcXiPolynomialNorm(x, n, kpa_norm, wave=wave)
 
-        xizeros = np.zeros((4, num_pts), dtype=complex)
-        for i in np.arange(num_pts):       
-            polycoeffs = [p4[i], p3[i], p2[i], p1[i], p0[i]]
-            roots = np.roots(polycoeffs)
-            xizeros[:, i] = roots
-        return xizeros
+        return polyroots([p4, p3, p2, p1, p0])
         
         
 
@@ -587,17 +587,22 @@ class MaxwellMaterial(Material):
         (eigenvals, eigenvectors) = self.calcXiEigenvectorsNorm(x, n, kpa_norm, wave=wave)
         return (k0*eigenvals, eigenvectors)
 
-    def calcDetPropagatorNormX(self, x, k_norm, wave=standard_wavelength):
+    def calcPropagatorNormX(self, x, k_norm, wave=standard_wavelength):
+        """
+        Propagator -k^2 delta_ij + k_i k_j + eps_ij for all rays at once.
+        
+        :return Propagator (3x3xN numpy array of complex)
+        """
         (num_dim, num_pts) = np.shape(k_norm)
 
-        Propagator = np.zeros((num_dim, num_dim, num_pts), dtype=complex)    
-        dets = np.zeros(num_pts, dtype=complex)
-        
-        for j in range(num_pts):
-            Propagator[:, :, j] = -np.dot(k_norm[:, j], k_norm[:, j])*np.eye(num_dim) +\
-                    np.outer(k_norm[:, j], k_norm[:, j]) + self.getEpsilonTensor(x, wave=wave)[:, :, j]
-            dets[j] = np.linalg.det(Propagator[:, :, j])
-        return dets
+        eps = self.getEpsilonTensorArray(x, wave=wave)
+        k2 = np.einsum('i...,i...', k_norm, k_norm)
+
+        return -k2*np.eye(num_dim)[:, :, np.newaxis] +\
+            np.einsum('i...,j...->ij...', k_norm, k_norm) + eps
+
+    def calcDetPropagatorNormX(self, x, k_norm, wave=standard_wavelength):
+        return det3x3(self.calcPropagatorNormX(x, k_norm, wave=wave))
         
     def calcDetPropagatorNorm(self, k_norm, wave=standard_wavelength):
         return self.calcDetPropagatorNormX(np.zeros_like(k_norm), k_norm, wave=wave)
@@ -630,7 +635,7 @@ class MaxwellMaterial(Material):
 
     def calcDet2ndDerivativePropagatorNormX(self, x, k_norm, wave=standard_wavelength):
         eps = self.getEpsilonTensor(x, wave=wave)        
-        (num_dims, num_dims, num_pts) = np.shape(eps)        
+        num_dims = np.shape(eps)[0]
         
         tre = np.einsum('ii...', eps)
         k2 = np.einsum('i...,i...', k_norm, k_norm)
@@ -646,9 +651,7 @@ class MaxwellMaterial(Material):
         fifth = np.einsum("ij..., l..., l...", eps, k_norm, k_norm)
         sixth = np.einsum("ji..., l..., l...", eps, k_norm, k_norm)
 
-        delta_mat = np.repeat(np.eye(num_dims)[:, :, np.newaxis], num_pts, axis=2)
-
-        seventh = 2*np.einsum("ij...,kl...,k...,l...", delta_mat, eps, k_norm, k_norm)
+        seventh = 2*beta[:, np.newaxis, np.newaxis]*np.eye(num_dims)
         
         eigth = 2*np.einsum("li...,l...,j...", eps, k_norm, k_norm)
         nineth = 2*np.einsum("il...,l...,j...", eps, k_norm, k_norm)
@@ -38,11 +38,14 @@ class AnisotropicMaterial(MaxwellMaterial):
         # up to now the material is not dispersive since the epsilon tensor
         # is not intended to be wave-dependent
     
+    def isHomogeneous(self):
+        return True
+
     def getEpsilonTensor(self, x, wave=standard_wavelength):
-        
-        (num_dims, num_pts) = np.shape(x)
-        
-        return np.repeat(self.epstensor[:, :, np.newaxis], num_pts, axis=2)
+        """
+        The crystal is homogeneous; only the single 3x3 tensor is returned.
+        """
+        return self.epstensor
 
     def propagate(self, raybundle, nextSurface):
 
@@ -73,6 +76,8 @@ class AnisotropicMaterial(MaxwellMaterial):
 
         (k2_sorted, e2_sorted) = self.sortKnormEField(xlocal, normal, k_inplane, normal, wave=raybundle.wave)
 
+        valid = raybundle.valid[-1] * valid_x * valid_normals
+
         if not splitup:
         # 2 vectors with largest scalarproduct of S with n
             k2 = np.hstack((k2_sorted[2], k2_sorted[3]))
@@ -80,12 +85,15 @@ class AnisotropicMaterial(MaxwellMaterial):
             e2 = np.hstack((e2_sorted[2], e2_sorted[3]))
     
             newids = np.hstack((raybundle.rayID, raybundle.rayID))
+            newwave = raybundle.wave
+            if raybundle.isPolychromatic():
+                newwave = np.hstack((newwave, newwave))
     
             orig = np.hstack((raybundle.x[-1], raybundle.x[-1]))        
             newk = self.lc.returnLocalToGlobalDirections(k2)
             newe = self.lc.returnLocalToGlobalDirections(e2)
     
-            return (RayBundle(orig, newk, newe, newids, raybundle.wave, splitted=True),)
+            return (raybundle.createContinuation(orig, newk, newe, np.hstack((valid, valid)), rayID=newids, splitted=True, wave=newwave),)
         else:
             k2_1 = self.lc.returnLocalToGlobalDirections(k2_sorted[2])
             k2_2 = self.lc.returnLocalToGlobalDirections(k2_sorted[3])
@@ -96,8 +104,8 @@ class AnisotropicMaterial(MaxwellMaterial):
             orig = raybundle.x[-1]
 
             return (
-                RayBundle(orig, k2_1, e2_1, raybundle.rayID, raybundle.wave),
-                RayBundle(orig, k2_2, e2_2, raybundle.rayID, raybundle.wave)
+                raybundle.createContinuation(orig, k2_1, e2_1, valid),
+                raybundle.createContinuation(orig, k2_2, e2_2, valid)
                 )
 
     def reflect(self, raybundle, actualSurface, splitup=False):
@@ -122,17 +130,22 @@ class AnisotropicMaterial(MaxwellMaterial):
         # TODO: negative sign due to compatibility with z-direction of
         # coordinate decenter
 
+        valid = raybundle.valid[-1] * valid_x * valid_normals
+
         if not splitup:
             k2 = -np.hstack((k2_sorted[0], k2_sorted[1]))
             e2 = -np.hstack((e2_sorted[0], e2_sorted[1]))
             newids = np.hstack((raybundle.rayID, raybundle.rayID))
+            newwave = raybundle.wave
+            if raybundle.isPolychromatic():
+                newwave = np.hstack((newwave, newwave))
     
             orig = np.hstack((raybundle.x[-1], raybundle.x[-1]))        
             newk = self.lc.returnLocalToGlobalDirections(k2)
             newe = self.lc.returnLocalToGlobalDirections(e2)
 
 
-            return (RayBundle(orig, newk, newe, newids, raybundle.wave, splitted=True),)
+            return (raybundle.createContinuation(orig, newk, newe, np.hstack((valid, valid)), rayID=newids, splitted=True, wave=newwave),)
         else:
             k2_1 = self.lc.returnLocalToGlobalDirections(-k2_sorted[0])
             k2_2 = self.lc.returnLocalToGlobalDirections(-k2_sorted[1])
@@ -143,7 +156,7 @@ class AnisotropicMaterial(MaxwellMaterial):
             orig = raybundle.x[-1]
 
             return (
-                RayBundle(orig, k2_1, e2_1, raybundle.rayID, raybundle.wave),
-                RayBundle(orig, k2_2, e2_2, raybundle.rayID, raybundle.wave)
+                raybundle.createContinuation(orig, k2_1, e2_1, valid),
+                raybundle.createContinuation(orig, k2_2, e2_2, valid)
                 )
 
@@ -22,21 +22,42 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 
+import os
+import copy
+import pickle
 import yaml
 import numpy as np
 import scipy.interpolate
+from scipy.spatial import cKDTree
 from material_isotropic import IsotropicMaterial
-from globalconstants import Fline, dline, Cline
+from optimize import OptimizableVariable
+from globalconstants import gline, Fline, dline, Cline
 from log import BaseLogger
 
+# LibYAML based parser is much faster, if available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# increase if the layout of the cache file changes
+glasscatalog_cache_version = 1
+
+# differences of 0.01 in nd, 1 in vd and 0.001 in PgF count equally
+# in the search for close glasses
+glass_map_weights = (100., 1., 1000.)
+
 # TODO: this class has too many methods
 class refractiveindex_dot_info_glasscatalog(BaseLogger):
-    def __init__(self, database_basepath, **kwargs):
+    def __init__(self, database_basepath, cachefile=None, **kwargs):
         """
         Reads the refractiveindex.info database and provides glass data. 
         
         :param database_basepath: (str)
                path of the database folder
+        :param cachefile: (str or None)
+               file in which the parsed library, the long name lookup
+               table and the pages read so far are stored. It is rebuilt
+               if library.yml changes and written at the end of the
+               search functions or by save_cache. None (default) keeps
+               the cache in memory only.
                
         References:
         [1] https://github.com/polyanskiy/refractiveindex.info-database.git
@@ -51,11 +72,87 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         Example:
         gcat = refractiveindex_dot_info_glasscatalog("/home/user/refractiveindex.info-database/database")
         """
-        self.database_basepath = database_basepath
-        self.librarydict = self.read_library(database_basepath + "/library.yml")
-        
         super(refractiveindex_dot_info_glasscatalog, self).__init__(**kwargs)
 
+        self.database_basepath = database_basepath
+        self.cachefile = cachefile
+        self.load_index()
+
+
+    def load_index(self):
+        """
+        Takes library, long name table and pages from the cache file if it
+        belongs to the current library.yml, else parses library.yml.
+        """
+        libraryfilename = self.database_basepath + "/library.yml"
+        mtime = os.path.getmtime(libraryfilename)
+
+        cache = self.read_cache()
+        rebuild = (cache is None or cache["library_mtime"] != mtime)
+        if rebuild:
+            self.debug("building index of " + libraryfilename)
+            librarydict = self.read_library(libraryfilename)
+            cache = {"version": glasscatalog_cache_version,
+                     "library_mtime": mtime,
+                     "librarydict": librarydict,
+                     "longnames": self.buildDictOfLongNames(librarydict),
+                     "pages": {}}
+
+        self.__cache = cache
+        self.__cache_dirty = rebuild
+        self.librarydict = cache["librarydict"]
+        self.__longnames = cache["longnames"]
+        self.__pages = cache["pages"]
+        self.__trees = {}
+        self.save_cache()
+
+
+    def read_cache(self):
+        """
+        :return cache: (dict or None)
+                None if there is no valid cache file
+        """
+        if self.cachefile is None or not os.path.isfile(self.cachefile):
+            return None
+        try:
+            with open(self.cachefile, "rb") as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            self.warning("cannot read glass catalog cache " + self.cachefile + ": " + str(e))
+            return None
+        if not isinstance(cache, dict) or cache.get("version") != glasscatalog_cache_version:
+            return None
+        return cache
+
+
+    def save_cache(self):
+        """
+        Writes the cache file if the cache changed since it was read or
+        written last. Reading many pages by getMaterialDict only marks the
+        cache as changed; call this afterwards to keep them on disk.
+        """
+        if self.__cache_dirty and self.cachefile is not None:
+            self.write_cache()
+        self.__cache_dirty = False
+
+
+    def write_cache(self):
+        """
+        Writes the cache atomically; failures (e.g. read-only database
+        folder) only produce a warning.
+        """
+        if self.cachefile is None:
+            return
+        tmpfilename = self.cachefile + "." + str(os.getpid())
+        try:
+            with open(tmpfilename, "wb") as f:
+                pickle.dump(self.__cache, f, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+            os.rename(tmpfilename, self.cachefile)
+        except (IOError, OSError) as e:
+            self.warning("cannot write glass catalog cache " + self.cachefile + ": " + str(e))
+
 
     def read_yml_file(self, ymlfilename):
         """
@@ -65,7 +162,7 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         :return data: (list or dict)
         """
         f = open(ymlfilename, "r")
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=YamlLoader)
         f.close()
         return data
 
@@ -112,6 +209,8 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
     def getMaterialDict(self, shelf, book, page):
         """
         Reads and returns a page of the refractiveindex.info database.
+        Pages are parsed only once and kept in the cache as long as
+        their file is unchanged (see save_cache for the cache file).
         
         :param shelf: (str)
         :param book:  (str)
@@ -122,8 +221,14 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         ymlfilename  = self.database_basepath + "/"
         ymlfilename += self.librarydict[shelf]["content"][book]["content"][page]["path"]
 
-        data = self.read_yml_file(ymlfilename)
-        return data
+        mtime = os.path.getmtime(ymlfilename)
+        entry = self.__pages.get((shelf, book, page))
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, self.read_yml_file(ymlfilename))
+            self.__pages[(shelf, book, page)] = entry
+            self.__cache_dirty = True
+
+        return copy.deepcopy(entry[1])
 
 
     # start of higher functionality section   
@@ -164,6 +269,19 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         return self.librarydict[shelf]["content"][book]["content"][page]["name"]
 
 
+    def buildDictOfLongNames(self, librarydict):
+        """
+        Builds the lookup table of getDictOfLongNames from the library.
+        """
+        dic = {}
+        for (shelf, shelfdict) in librarydict.iteritems():
+            for (book, bookdict) in shelfdict["content"].iteritems():
+                for (page, pagedict) in bookdict["content"].iteritems():
+                    # todo: if 2 pages have the same longName, now only one will be put in dic
+                    dic[pagedict["name"]] = (shelf, book, page)
+        return dic
+
+
     def getDictOfLongNames(self):
         """
         Returns a lookup table in which shelf, book and page a glass name can be found.
@@ -172,14 +290,7 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                    keys are glass long names
                    values are tuples (shelf, book, page)
         """
-        dic = {}
-        for shelf in self.getShelves():
-            for book in self.getBooks(shelf):
-                for page in self.getPages(shelf, book):
-                    longname = self.getPageLongName(shelf, book, page)
-                    # todo: if 2 pages have the same longName, now only one will be put in dic
-                    dic[longname] = (shelf, book, page)
-        return dic
+        return dict(self.__longnames)
 
         
     def findPagesWithLongNameContaining(self, searchterm):
@@ -192,12 +303,9 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                    keys are glass long names
                    values are tuples (shelf, book, page)        
         """
-        allpages = self.getDictOfLongNames()
-        result = {}
-        for longname in allpages:
-            if longname.find(searchterm) != -1:
-                result[longname] = allpages[longname]
-        return result
+        return dict((longname, location) 
+                    for (longname, location) in self.__longnames.iteritems() 
+                    if searchterm in longname)
                    
                     
     def getMaterialDictFromLongName(self, glassName):
@@ -209,11 +317,7 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         refractiveindex.info database.
         """
 
-        allpages = self.getDictOfLongNames()
-        result = []
-        for longname in allpages:
-            if longname == glassName:
-                result = allpages[longname]
+        result = self.__longnames.get(glassName, [])
                 
         if len(result) == 0: # no glass found, throwing exception
             errormsg = "glass name "+ str(glassName) + " not found."
@@ -224,7 +328,9 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                 errormsg += " No glass names containing this string found."
             raise Exception(errormsg)
         shelf, book, page =  result
-        return self.getMaterialDict(shelf, book, page)
+        ymldict = self.getMaterialDict(shelf, book, page)
+        self.save_cache()
+        return ymldict
 
 
     def createGlassObjectFromLongName(self, lc, glassName):
@@ -242,26 +348,129 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         return matobj
         
 
+    def calcGlassParameters(self, ymldict):
+        """
+        Calculates refractive index nd, Abbe number vd and partial
+        dispersion PgF of a database page.
+
+        :param ymldict: (dict)
+
+        :return (nd, vd, PgF): (tuple of float)
+                nan if a line is outside the range of the page
+        """
+        material = CatalogMaterial(None, ymldict)
+
+        def index(wave):
+            try:
+                return np.real(material.getIndex(None, wave))
+            except Exception:
+                return np.nan
+
+        (ng, nF, nd, nC) = [index(wave) for wave in (gline, Fline, dline, Cline)]
+        vd = (nd - 1.)/(nF - nC)
+        PgF = (ng - nF)/(nF - nC)
+        return (nd, vd, PgF)
+
+
+    def getGlassTable(self):
+        """
+        Table of nd, vd and PgF of all pages for which nd and vd are
+        defined. It is calculated once and stored in the cache (file).
+
+        :return (locations, table): (list of tuples (shelf, book, page),
+                                     Nx3 numpy array of float)
+        """
+        glasstable = self.__cache.get("glasstable")
+        if glasstable is None:
+            self.debug("building nd, vd, PgF table of " + self.database_basepath)
+            locations = []
+            values = []
+            for (shelf, shelfdict) in self.librarydict.iteritems():
+                for (book, bookdict) in shelfdict["content"].iteritems():
+                    for (page, pagedict) in bookdict["content"].iteritems():
+                        try:
+                            ymldict = self.read_yml_file(self.database_basepath + "/" + pagedict["path"])
+                            with np.errstate(divide="ignore", invalid="ignore"):
+                                parameters = self.calcGlassParameters(ymldict)
+                        except Exception as e:
+                            self.debug("skipping page " + str((shelf, book, page)) + ": " + str(e))
+                            continue
+                        if np.all(np.isfinite(parameters[:2])):
+                            locations.append((shelf, book, page))
+                            values.append(parameters)
+            glasstable = (locations, np.array(values, dtype=float).reshape(-1, 3))
+            self.__cache["glasstable"] = glasstable
+            self.__cache_dirty = True
+            self.save_cache()
+        return glasstable
+
+
+    def findPagesCloseTo_nd_vd_PgF(self, nd=1.51680, vd=64.17, PgF=None, num=1, weights=glass_map_weights):
+        """
+        Searches the pages closest to given glass parameters.
+
+        :param nd: (float)
+        :param vd: (float)
+        :param PgF: (float or None)
+               if None, only nd and vd are compared
+        :param num: (int) maximum number of pages to return
+        :param weights: (tuple of 3 float)
+               scaling of the nd, vd and PgF differences in the distance
+
+        :return pages: (list of tuples (shelf, book, page))
+                sorted by distance
+        """
+        dims = 2 if PgF is None else 3
+        key = (dims, tuple(weights[:dims]))
+        if key not in self.__trees:
+            (locations, table) = self.getGlassTable()
+            rows = np.flatnonzero(np.all(np.isfinite(table[:, :dims]), axis=1))
+            scaling = np.array(weights[:dims])
+            self.__trees[key] = (cKDTree(table[rows, :dims]*scaling), rows, scaling)
+        (tree, rows, scaling) = self.__trees[key]
+
+        if len(rows) == 0:
+            return []
+        point = np.array([nd, vd, PgF][:dims])*scaling
+        (distances, indices) = tree.query(point, k=min(num, len(rows)))
+        (locations, table) = self.getGlassTable()
+        return [locations[rows[i]] for i in np.atleast_1d(indices)]
+
+
     def getMaterialDictCloseTo_nd_vd_PgF(self, nd=1.51680, vd=64.17, PgF=0.5349):
         """
         Search a material close to given parameters.
         """
-        raise NotImplementedError()
+        pages = self.findPagesCloseTo_nd_vd_PgF(nd, vd, PgF)
+        if len(pages) == 0:
+            raise Exception("no glass with nd, vd and PgF data found.")
+        (shelf, book, page) = pages[0]
+        ymldict = self.getMaterialDict(shelf, book, page)
+        self.save_cache()
+        return ymldict
         
         
     def getMaterialDictCloseTo_nd_vd(self, nd=1.51680, vd=64.17):
         """
         Search a material close to given parameters.
         """
-        raise NotImplementedError()
+        pages = self.findPagesCloseTo_nd_vd_PgF(nd, vd)
+        if len(pages) == 0:
+            raise Exception("no glass with nd and vd data found.")
+        (shelf, book, page) = pages[0]
+        ymldict = self.getMaterialDict(shelf, book, page)
+        self.save_cache()
+        return ymldict
 
 
     def getMaterialDictFromSchottCode(self, schottCode=517642):
         """
         Identify and return a material from a given material code.
+        The six digit code consists of (nd - 1)*1000 and vd*10.
         """
-        raise NotImplementedError()
-
+        nd = 1. + (schottCode // 1000)/1000.
+        vd = (schottCode % 1000)/10.
+        return self.getMaterialDictCloseTo_nd_vd(nd, vd)
 
 class IndexFormulaContainer(object):
     def __init__(self, typ, coeff, waverange):
@@ -283,54 +492,62 @@ class IndexFormulaContainer(object):
 
         
     def setDispFunction(self, typ, coeff):
+        """
+        Selects the dispersion formula. The coefficients are split up here
+        once, the formulas accept wavelengths of any shape.
+        """
         self.coeff = coeff
 
+        # The sums over the coefficients run along an appended last axis
+        # of the wavelength array.
+        c0 = coeff[0] if coeff.ndim == 1 else None
+        odd = coeff[1::2] if coeff.ndim == 1 else None
+        even = coeff[2::2] if coeff.ndim == 1 else None
+
         def Sellmeier(w_um):
-            B = self.coeff[1::2]
-            C = self.coeff[2::2]
-            nsquared = 1 + self.coeff[0] + sum( B * w_um**2 / (  w_um**2 - C**2  ) )
+            w = w_um[..., np.newaxis]
+            nsquared = 1 + c0 + np.sum( odd * w**2 / (  w**2 - even**2  ), axis=-1 )
             return np.sqrt(nsquared)
         def Sellmeier2(w_um):
-            B = self.coeff[1::2]
-            C = self.coeff[2::2]
-            nsquared = 1 + self.coeff[0] + sum( B * w_um**2 / (  w_um**2 - C ) )
+            w = w_um[..., np.newaxis]
+            nsquared = 1 + c0 + np.sum( odd * w**2 / (  w**2 - even ), axis=-1 )
             return np.sqrt(nsquared)
         def Polynomial(w_um):
-            A = self.coeff[1::2]
-            P = self.coeff[2::2]
-            nsquared = self.coeff[0] + sum( A * (w_um**P) )
+            w = w_um[..., np.newaxis]
+            nsquared = c0 + np.sum( odd * (w**even), axis=-1 )
             return np.sqrt(nsquared)
         def refractiveindex_dot_info_formula_with_9_or_less_coefficients(w_um):
-            A = self.coeff[1::4]
-            B = self.coeff[2::4]
-            C = self.coeff[3::4]
-            D = self.coeff[4::4]
-            nsquared = self.coeff[0] + sum( A * (w_um**B)  / (  w_um**2 - C**D ) )
+            w = w_um[..., np.newaxis]
+            A = coeff[1::4]
+            B = coeff[2::4]
+            C = coeff[3::4]
+            D = coeff[4::4]
+            nsquared = c0 + np.sum( A * (w**B)  / (  w**2 - C**D ), axis=-1 )
             return np.sqrt(nsquared)
         def refractiveindex_dot_info_formula_with_11_or_more_coefficients(w_um):
-            A = self.coeff[[1,5]]
-            B = self.coeff[[2,6]]
-            C = self.coeff[[3,7]]
-            D = self.coeff[[4,8]]
-            E = self.coeff[9::2]
-            F = self.coeff[10::2]
-            nsquared = self.coeff[0] + sum( A * (w_um**B)  / (  w_um**2 - C**D ) ) + sum( E * (w_um**F) )
+            w = w_um[..., np.newaxis]
+            A = coeff[[1,5]]
+            B = coeff[[2,6]]
+            C = coeff[[3,7]]
+            D = coeff[[4,8]]
+            E = coeff[9::2]
+            F = coeff[10::2]
+            nsquared = c0 + np.sum( A * (w**B)  / (  w**2 - C**D ), axis=-1 ) + np.sum( E * (w**F), axis=-1 )
             return np.sqrt(nsquared)
         def Cauchy(w_um):
-            A = self.coeff[1::2]
-            P = self.coeff[2::2]
-            n = self.coeff[0] + sum( A * (w_um**P) )
+            w = w_um[..., np.newaxis]
+            n = c0 + np.sum( odd * (w**even), axis=-1 )
             return n
         def Gases(w_um):
-            B = self.coeff[1::2]
-            C = self.coeff[2::2]
-            n = 1 + self.coeff[0] + sum( B / (  C - w_um**(-2)  ) )
+            w = w_um[..., np.newaxis]
+            n = 1 + c0 + np.sum( odd / (  even - w**(-2)  ), axis=-1 )
             return n
         def Herzberger(w_um):
+            w = w_um[..., np.newaxis]
             denom = w_um**2 - 0.028
-            A = self.coeff[3:]
+            A = coeff[3:]
             P = 2 * np.arange(len(A)) + 2
-            n = self.coeff[0] + self.coeff[1] / denom + self.coeff[2] / (denom**2) + sum (A * w_um**P )
+            n = c0 + coeff[1] / denom + coeff[2] / (denom**2) + np.sum(A * w**P, axis=-1)
             return n
         def Retro(w_um):
             raise NotImplementedError()
@@ -355,7 +572,7 @@ class IndexFormulaContainer(object):
         elif typ == "formula 7":
             self.__dispFunction = Herzberger
         elif typ == "formula 8":
-            self.n_fucntion = Retro
+            self.__dispFunction = Retro
         elif typ == "formula 9":
             self.__dispFunction = Exotic
         elif typ == "tabulated n":
@@ -370,20 +587,19 @@ class IndexFormulaContainer(object):
 
     def getIndex(self, wavelength):
         """
-        :param wavelength: (float)
+        :param wavelength: (float or numpy array of float)
                wavelength in mm
-        :return n: (float)
+        :return n: (float or numpy array of float)
                refractive index real part
         """
-        wave_um = 1000 * wavelength # wavelength in um
+        wave_um = 1000 * np.asarray(wavelength, dtype=float) # wavelength in um
         # The refractiveindex.info database uses units of um 
         # for its dispersion formulas.
         # It would be a huge effort to rewrite the whole database,
         # so we leave the database as it is and adapt 
         # the pyrate wavelength in mm to fit the dispersion formulas.
         
-        # TODO: this is an if statement in a time-critical place
-        if wave_um < self.waverange[0] or wave_um > self.waverange[1]:
+        if np.any(wave_um < self.waverange[0]) or np.any(wave_um > self.waverange[1]):
             raise Exception("wavelength out of range")
         
         n = self.__dispFunction(wave_um)
@@ -391,12 +607,15 @@ class IndexFormulaContainer(object):
 
                 
 class CatalogMaterial(IsotropicMaterial):
-    def __init__(self, lc, ymldict, **kwargs):
+    def __init__(self, lc, ymldict, index_cache_size=32, **kwargs):
         """
         Material from the refractiveindex.info database.
         
         :param ymldict: (dict)
                 dictionary from a refractiveindex.info page yml file.
+        :param index_cache_size: (int)
+                number of wavelengths for which the refractive index
+                is memoized (least recently used are dropped first)
         :param name: (str)
         :param comment: (str)
         
@@ -430,12 +649,73 @@ class CatalogMaterial(IsotropicMaterial):
                 rang  = np.array( dispersionDict["range"].split(), dtype=float)
             self.__nk.append(IndexFormulaContainer(typ, coeff, rang))
 
+        self.index_cache_size = index_cache_size
+        self.clearIndexCache()
 
-    def getIndex(self, x, wave):
+
+    def clearIndexCache(self):
+        """
+        Empties the memoized refractive indices, e.g. after the
+        dispersion data were changed or optimizable variables were
+        added to the material.
+        """
+        # key: (wavelength, values of optimizable variables),
+        # value: [index, time of last use]
+        self.__index_cache = {}
+        self.__index_cache_clock = 0
+        self.__cache_variables = [var for var in self.__dict__.values()
+                                  if isinstance(var, OptimizableVariable)]
+        self.index_cache_hits = 0
+        self.index_cache_misses = 0
+
+    def getCacheState(self):
+        """
+        Values of the optimizable variables of the material itself. They
+        are part of the cache key, therefore changing one of them
+        invalidates the memoized indices.
+        """
+        return tuple([var() for var in self.__cache_variables])
+
+    def calcIndex(self, wave):
         n = 0
         for dispFun in self.__nk:
-            n += dispFun.getIndex(wave)
+            n = n + dispFun.getIndex(wave)
         return n
+
+    def getIndexCached(self, wave):
+        """
+        Refractive index for a single wavelength from the LRU cache.
+        """
+        key = (wave, self.getCacheState())
+        cache = self.__index_cache
+        self.__index_cache_clock += 1
+        entry = cache.get(key)
+        if entry is None:
+            self.index_cache_misses += 1
+            while cache and len(cache) >= self.index_cache_size:
+                del cache[min(cache, key=lambda k: cache[k][1])]
+            entry = [self.calcIndex(wave), 0]
+            cache[key] = entry
+        else:
+            self.index_cache_hits += 1
+        entry[1] = self.__index_cache_clock
+        return entry[0]
+
+    def getIndex(self, x, wave):
+        """
+        Refractive index (complex if the material is absorbing).
+
+        :param x: position (ignored, the material is homogeneous)
+        :param wave: (float or numpy array of float) wavelength(s) in mm;
+               for arrays every distinct wavelength is evaluated once
+
+        :return n: (float or numpy array of float) shape of wave
+        """
+        if not isinstance(wave, np.ndarray):
+            return self.getIndexCached(wave)
+        (waves, inverse) = np.unique(wave, return_inverse=True)
+        n = np.array([self.getIndexCached(w) for w in waves])
+        return n[inverse].reshape(np.shape(wave))
         
 
 if __name__ == "__main__":
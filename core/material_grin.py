@@ -30,17 +30,65 @@ from globalconstants import standard_wavelength
 
 from material_isotropic import IsotropicMaterial
 
+# coefficients of the fourth order symplectic integrator
+# by Forest and Ruth
+forest_ruth_c = [1.0/(2.0*(2.0 - 2.0**(1./3.))),
+                 (1.0 - 2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),
+                 (1.0 - 2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),
+                 1.0/(2.0*(2.0 - 2.0**(1./3.)))]
+forest_ruth_d = [1.0/(2.0 - 2.0**(1./3.)),
+                 (-2.0**(1./3.))/(2.0 - 2.0**(1./3.)),
+                 1.0/(2.0 - 2.0**(1./3.)),
+                 0.0]
+
 class IsotropicGrinMaterial(IsotropicMaterial):
-    def __init__(self, lc, fun, dfdx, dfdy, dfdz, bndfunction, ds, energyviolation, name="", comment=""):
+    def __init__(self, lc, fun, dfdx, dfdy, dfdz, bndfunction, ds, energyviolation, name="", comment="",
+                 gradfun=None, adaptive=False, maxds=None, steptolerance=None, decimation=1, maxsteps=100000):
+        """
+        Isotropic medium with position dependent refractive index. Rays are
+        propagated by a fourth order symplectic (Forest-Ruth) integration of
+        the ray equation in Hamiltonian form H = p^2 - n(x)^2 = 0.
+
+        :param fun (function 3xN -> N) refractive index n(x)
+        :param dfdx, dfdy, dfdz (functions 3xN -> N) partial derivatives
+                of n; ignored if gradfun is given
+        :param bndfunction (function 3xN -> N of bool) True inside the
+                lateral boundary of the medium
+        :param ds (float) integration step size (a step advances the rays
+                by 2 n ds); with adaptive stepping this is the initial step
+                and the resolution by which rays reach the boundary
+        :param energyviolation (float) rays with |H| above this value
+                are invalidated
+        :param gradfun (function 3xN -> 3xN) gradient of n in one call
+        :param adaptive (bool) per ray step size control by the energy
+                error of each step; default: fixed step size ds
+        :param maxds (float) upper bound of the adaptive step size;
+                if None: 16*ds
+        :param steptolerance (float) allowed change of H per step;
+                if None: energyviolation/10000
+        :param decimation (int) only every decimation-th integration step
+                is stored in the RayBundle; the last one is always stored
+        :param maxsteps (int) rays not having reached the next surface
+                after this number of steps are invalidated
+        """
         super(IsotropicGrinMaterial, self).__init__(lc, name=name, comment=comment)
         self.nfunc = fun
         self.dndx = dfdx
         self.dndy = dfdy
         self.dndz = dfdz
+        self.gradfun = gradfun
         self.ds = ds
         self.energyviolation = energyviolation
         self.boundaryfunction = bndfunction
+        self.adaptive = adaptive
+        self.maxds = maxds
+        self.steptolerance = steptolerance
+        self.decimation = decimation
+        self.maxsteps = maxsteps
+
 
+    def isHomogeneous(self):
+        return False
 
     def getEpsilonTensor(self, x, wave=standard_wavelength):
         (num_dims, num_pts) = np.shape(x)
@@ -54,123 +102,165 @@ class IsotropicGrinMaterial(IsotropicMaterial):
     def getIndex(self, x, wave=standard_wavelength):
         return self.nfunc(x)**2
 
+    def getIndexGradient(self, x):
+        """
+        Gradient of the refractive index.
+
+        :param x (3xN numpy array of float) local positions
+
+        :return grad (3xN numpy array of float)
+        """
+        if self.gradfun is not None:
+            return self.gradfun(x)
+        return np.array([self.dndx(x), self.dndy(x), self.dndz(x)])
+
     def returnLocalDtoK(self, d, wave=standard_wavelength):
         return 2.*math.pi/wave*d
 
     def inBoundary(self, x):
         return self.boundaryfunction(x)
 
+    def symplecticstep(self, pos, vel, tau):
+        """
+        One Forest-Ruth step of the ray equation dx/ds = 2p, dp/ds = 2n grad n.
 
-    def symplecticintegrator(self, raybundle, nextSurface, tau):
-
-        startpoint = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
-        startdirection = self.lc.returnGlobalToLocalDirections(raybundle.returnKtoD()[-1])
+        :param pos (3xN numpy array of float) positions
+        :param vel (3xN numpy array of float) momenta (n times direction)
+        :param tau (1d numpy array of float) step size per ray
 
-        ci = [1.0/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),1.0/(2.0*(2.0 - 2.0**(1./3.)))]
-        di = [1.0/(2.0 - 2.0**(1./3.)),(-2.0**(1./3.))/((2.0 - 2.0**(1./3.))),1.0/(2.0 - 2.0**(1./3.)),0.0]
+        :return (pos, vel, n) after the step; n is the index at pos
+        """
+        for (c, d) in zip(forest_ruth_c, forest_ruth_d):
+            pos = pos + tau*c*2.0*vel
+            if d != 0.:
+                vel = vel + tau*d*2.0*self.nfunc(pos)*self.getIndexGradient(pos)
 
+        return (pos, vel, self.nfunc(pos))
 
-        optindstart = self.nfunc(startpoint)
-        positions = [1.*startpoint]
-        velocities = [1.*optindstart*startdirection]
+    def symplecticintegrator(self, raybundle, nextSurface, tau):
+        """
+        Integrates the rays until they cross the next surface.
+
+        Only rays which are still running (valid and not at the next
+        surface) are integrated in each step. With self.adaptive every ray
+        has its own step size: a step is rejected and repeated with a
+        smaller one if H changes by more than the step tolerance, if the
+        ray crosses the boundary with a step larger than tau or if it crosses
+        the next surface with a step larger than tau/1000. Hence the rays
+        end close to the next surface. Otherwise the step size grows up to
+        self.maxds.
+
+        :param raybundle (RayBundle) the integration steps are appended
+        :param nextSurface (Surface)
+        :param tau (float) step size
+
+        :return (pointstodraw, momentatodraw, energies, valid)
+                positions and momenta of all stored steps (local coordinates),
+                energy H per ray and validity at the end of the integration
+        """
+        startpoint = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
+        startdirection = self.lc.returnGlobalToLocalDirections(raybundle.returnKtoDAt(-1))
 
-        energies = []
-        phasespace4d = []
+        maxds = self.maxds if self.maxds is not None else 16.*tau
+        steptolerance = (self.steptolerance if self.steptolerance is not None
+                         else 1e-4*self.energyviolation)
+        mintau = tau*1e-3
 
-        path = 0.
+        pos = 1.*startpoint
+        vel = self.nfunc(startpoint)*startdirection
+        energies = np.sum(vel**2, axis=0) - self.nfunc(pos)**2
 
-        loopcount = 0
+        num_rays = np.shape(pos)[1]
+        steps = np.ones(num_rays)*tau
 
-        valid = np.ones_like(startpoint[0], dtype=bool)
-        final = np.zeros_like(startpoint[0], dtype=bool)
+        valid = np.copy(raybundle.valid[-1])
+        final = True ^ valid
+        # invalid rays are not integrated at all
 
         pointstodraw = []
         momentatodraw = []
 
-        updatedpos = startpoint
-        updatedvel = velocities[-1]
-
-        while not np.all(final): 
-            
-            loopcount += 1
-            lastpos = positions[-1]
-            lastvel = velocities[-1]
-
-            for i in range(len(ci)):
-                newpos = lastpos + tau*ci[i]*2.0*lastvel
-                newvel = lastvel
-
-                optin = self.nfunc(newpos)
-
-                newvel = newvel + tau*di[i]*2.0*optin*np.array( \
-                 [self.dndx(newpos),
-                  self.dndy(newpos),
-                  self.dndz(newpos)])
-
-                lastpos = newpos
-                lastvel = newvel
+        def store():
+            k0 = 1. #2.*math.pi/raybundle.wave
+            newk = k0*vel/self.nfunc(pos)
+            Eapp = self.lc.returnLocalToGlobalDirections(self.calcEfield(pos, None, newk, wave=raybundle.wave))
+            kapp = self.lc.returnLocalToGlobalDirections(newk)
+            xapp = self.lc.returnLocalToGlobalPoints(pos)
 
-            positions.append(newpos)
-            velocities.append(newvel)
+            pointstodraw.append(1.*pos)
+            momentatodraw.append(1.*vel)
 
-            
-            
+            raybundle.append(xapp, kapp, Eapp, valid)
 
-            # validity and finalization check
+        loopcount = 0
+        stored = True
 
-            totalenergy = np.sum(newvel**2) - np.sum(optin**2)
+        while not np.all(final):
 
-            # testing for some critical energyviolation
-            # and invalidate all rays
+            loopcount += 1
+            if loopcount > self.maxsteps:
+                self.warning('integration aborted after ' + str(self.maxsteps) + ' steps for ' +
+                             str(np.sum(True ^ final)) + ' rays')
+                valid[True ^ final] = False
+                stored = False
+                break
 
-            if abs(totalenergy) > self.energyviolation:
-                #FreeCAD.Console.PrintMessage('WARNING: integration aborted due to energy violation: abs(' + str(totalenergy) + ') > ' + str(self.energyviolation) + '\n')
-                #FreeCAD.Console.PrintMessage('Please reduce integration step size.\n')
-                self.warning('integration aborted due to energy violation: abs(' + str(totalenergy) + ') > ' + str(self.energyviolation))
-                self.warning('Please reduce integration step size.')
-                valid[:] = False # all rays with energy violation are not useful due to integration errors
-                # TODO: report to user via some kind of fancy interface
+            active = np.flatnonzero(True ^ final)
+            tau_act = steps[active]
 
-            self.debug("step(" + str(loopcount) + ") -> energy conservation violation: " + str(totalenergy))
+            (newpos, newvel, optin) = self.symplecticstep(pos[:, active], vel[:, active], tau_act)
+            newenergies = np.sum(newvel**2, axis=0) - optin**2
 
-            xglobalnewpos = self.lc.returnLocalToGlobalPoints(newpos)                        
+            # has ray reached next surface? has ray hit boundary?
+            xglobalnewpos = self.lc.returnLocalToGlobalPoints(newpos)
             xshape = nextSurface.shape.lc.returnGlobalToLocalPoints(xglobalnewpos)
+            crossed = (xshape[2] - nextSurface.shape.getSag(xshape[0], xshape[1]) > 0)
+            outside = True ^ self.inBoundary(newpos)
+
+            if self.adaptive:
+                steperror = np.abs(newenergies - energies[active])
+                toolarge = (steperror > steptolerance)*(tau_act > mintau)
+                overshoot = crossed*(tau_act > mintau) + outside*(tau_act > tau)
+                rejected = toolarge + overshoot
+
+                factor = np.clip(0.9*(steptolerance/np.maximum(steperror, 1e-300))**0.2, 0.2, 2.)
+                factor[overshoot] = np.minimum(factor[overshoot], 0.5)
+                newsteps = np.clip(tau_act*factor, mintau, maxds)
+                steps[active] = newsteps
+            else:
+                rejected = np.zeros_like(crossed)
+
+            accepted = True ^ rejected
+            # final rays keep the last position in front of the next surface
+            moved = accepted*(True ^ crossed)*(True ^ outside)
+            pos[:, active[moved]] = newpos[:, moved]
+            vel[:, active[moved]] = newvel[:, moved]
+            energies[active[accepted]] = newenergies[accepted]
+
+            # testing for some critical energy violation
+            # and invalidate the affected rays
+            violated = accepted*(np.abs(newenergies) > self.energyviolation)
+            if np.any(violated):
+                self.warning('integration aborted due to energy violation for ' + str(np.sum(violated)) +
+                             ' rays: max(abs(H)) = ' + str(np.max(np.abs(newenergies[violated]))) +
+                             ' > ' + str(self.energyviolation))
+                self.warning('Please reduce integration step size.')
 
-            final = (xshape[2] - nextSurface.shape.getSag(xshape[0], xshape[1]) > 0)
-            # has ray reached next surface? if yes: mark as final
-
-            valid[True ^ self.inBoundary(newpos)] = False
-            # has ray hit boundary? mark as invalid
-
-            final[True ^ valid] += True            
-            # all non valid rays are also final
-
-            updatedpos[:,True ^ final] = newpos[:,True ^ final]
-            updatedvel[:,True ^ final] = newvel[:,True ^ final]
-
-            k0 = 1. #2.*math.pi/raybundle.wave
-            newk = k0*updatedvel/self.nfunc(updatedpos)
-            Eapp = self.lc.returnLocalToGlobalDirections(self.calcEfield(newpos, None, newk, wave=raybundle.wave))
-            kapp = self.lc.returnLocalToGlobalDirections(newk)            
-            xapp = self.lc.returnLocalToGlobalPoints(updatedpos)            
-
-            pointstodraw.append(1.*updatedpos)
-            momentatodraw.append(1.*updatedvel)
-
-            raybundle.append(xapp, kapp, Eapp, valid)
-            # TODO: if pathlength of a certain ray is too long, mark as invalid and final
-
-            # for energy and phase space analysis
+            valid[active[accepted*(outside + violated)]] = False
+            final[active[accepted*crossed]] = True
+            final[True ^ valid] = True
 
-            energies.append(totalenergy)
+            self.debug("step(" + str(loopcount) + ") -> active rays: " + str(len(active)) +
+                       ", max energy conservation violation: " + str(np.max(np.abs(newenergies))))
 
-        # TODO: hier gehts schon in die hose
-        # TODO: somehow the pointstodraw array is overwritten after the integration!
+            stored = (loopcount % self.decimation == 0)
+            if stored:
+                store()
 
-        #for ind, pt in enumerate(pointstodraw):
-        #    FreeCAD.Console.PrintMessage("symint: " + str(ind) + ": " + str(pt)+"\n")
+        if not stored:
+            store()
 
-        return (positions, velocities, pointstodraw, momentatodraw, energies, valid)
+        return (pointstodraw, momentatodraw, energies, valid)
 
 
     def propagate(self, raybundle, nextSurface):
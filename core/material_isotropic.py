@@ -35,13 +35,19 @@ class IsotropicMaterial(MaxwellMaterial):
         super(IsotropicMaterial, self).__init__(lc, **kwargs)
 
 
+    def isHomogeneous(self):
+        return True
+
     def getEpsilonTensor(self, x, wave=standard_wavelength):
+        """
+        Returns a single 3x3 tensor if the index does not depend
+        on the points (or wavelengths) and 3x3xN tensors otherwise.
+        """
         (num_dims, num_pts) = np.shape(x)
-        mat = np.zeros((num_dims, num_dims, num_pts))
-        mat[0, 0, :] = 1.
-        mat[1, 1, :] = 1.
-        mat[2, 2, :] = 1.
-        return mat*self.getIsotropicEpsilon(x, wave=wave)
+        epsilon = self.getIsotropicEpsilon(x, wave=wave)
+        if np.ndim(epsilon) == 0:
+            return np.eye(num_dims)*epsilon
+        return np.eye(num_dims)[:, :, np.newaxis]*epsilon
 
 
     def getIsotropicEpsilon(self, x, wave=standard_wavelength):
@@ -71,6 +77,9 @@ class IsotropicMaterial(MaxwellMaterial):
                 normal of surface in local coordinates
         :param k_inplane (3xN numpy array of float) 
                 incoming wave vector inplane component in local coordinates
+        :param wave (float or 1d numpy array of N floats)
+                wavelength(s); for polychromatic RayBundles every ray
+                gets the index of its own wavelength
         
         :return (xi, valid) tuple of (3x1 numpy array of complex, 
                 3x1 numpy array of bool)
@@ -106,15 +115,15 @@ class IsotropicMaterial(MaxwellMaterial):
         k2 = k_inplane + xi * normal
 
         # return ray with new direction and properties of old ray
-        # return only valid rays
-        orig = raybundle.x[-1][:, valid]        
-        newk = self.lc.returnLocalToGlobalDirections(k2[:, valid])
+        # invalid rays are removed according to the compaction policy
+        orig = raybundle.x[-1]
+        newk = self.lc.returnLocalToGlobalDirections(k2)
 
         # E field calculation wrong: xlocal, normal, newk in different
         # coordinate systems
         Efield = self.calcEfield(xlocal, normal, newk, wave=raybundle.wave)
 
-        return (RayBundle(orig, newk, Efield, raybundle.rayID[valid], raybundle.wave),)
+        return (raybundle.createContinuation(orig, newk, Efield, valid),)
 
 
     def reflect(self, raybundle, actualSurface, splitup=False):
@@ -136,13 +145,13 @@ class IsotropicMaterial(MaxwellMaterial):
         k2 = -k_inplane + xi * normal # changed for mirror, all other code is doubled
 
         # return ray with new direction and properties of old ray
-        # return only valid rays
-        orig = raybundle.x[-1][:, valid]        
-        newk = self.lc.returnLocalToGlobalDirections(k2[:, valid])
+        # invalid rays are removed according to the compaction policy
+        orig = raybundle.x[-1]
+        newk = self.lc.returnLocalToGlobalDirections(k2)
 
         Efield = self.calcEfield(xlocal, normal, newk, wave=raybundle.wave)
         
-        return (RayBundle(orig, newk, Efield, raybundle.rayID[valid], raybundle.wave),)
+        return (raybundle.createContinuation(orig, newk, Efield, valid),)
 
 
     def propagate(self, raybundle, nextSurface):
@@ -192,10 +201,18 @@ class ModelGlass(IsotropicMaterial):
         """
         Private routine for all isotropic materials obeying the Snell law of refraction.
 
-        :param raybundle: RayBundle object containing the wavelength of the rays.
+        :param wave: (float or numpy array of float) wavelength(s) of the rays;
+               for arrays every distinct wavelength is evaluated once
 
-        :return index: refractive index at respective wavelength (float)
+        :return index: refractive index at respective wavelength (float or 
+                numpy array of float in the shape of wave)
         """
+        if isinstance(wave, np.ndarray):
+            (waves, inverse) = np.unique(wave, return_inverse=True)
+            return self.calcConradyIndex(waves)[inverse].reshape(np.shape(wave))
+        return self.calcConradyIndex(wave)
+
+    def calcConradyIndex(self, wave):
         return self.n0() + self.A() / wave + self.B() / (wave**3.5)
 
 
@@ -64,6 +64,7 @@ class OpticalElement(LocalCoordinatesTreeBase):
             raise Exception("surface coordinate system should be connected to OpticalElement root coordinate system")
         self.__surfaces[key].name = name
         self.__surf_mat_connection[key] = (minusNmat_key, plusNmat_key)
+        self.invalidateVariableRegistry()
 
     def getSurfaces(self):
         return self.__surfaces
@@ -83,6 +84,7 @@ class OpticalElement(LocalCoordinatesTreeBase):
             if key not in self.__materials:
                 self.__materials[key] = material_object
                 self.__materials[key].comment = comment
+                self.invalidateVariableRegistry()
             else:
                 self.warning("Material key " + str(key) + " already taken. Material will not be added.")
         else:
@@ -297,7 +299,22 @@ class OpticalElement(LocalCoordinatesTreeBase):
         return (pilotraypath, XYUVmatrices)
      
 
-    def seqtrace(self, raybundle, sequence, background_medium, splitup=False):
+    def seqtrace(self, raybundle, sequence, background_medium, splitup=False, record=None):
+        """
+        Traces raybundle through the surfaces in sequence.
+        
+        :param raybundle: (RayBundle object)
+        :param sequence: (list of (surfkey, surfoptions) tuples)
+        :param background_medium: (Material object)
+        :param splitup: (bool) split rays at anisotropic materials
+        :param record: (None or container of surface keys) 
+                None keeps every RayBundle. Else only the RayBundles
+                starting at the given surfaces and the last RayBundle 
+                of each RayPath are kept; all others (including raybundle)
+                are discarded while tracing.
+        
+        :return list of RayPath objects
+        """
         
         # FIXME: should depend on a list of RayPath        
         
@@ -306,6 +323,9 @@ class OpticalElement(LocalCoordinatesTreeBase):
         rpath = RayPath(raybundle)    
         rpaths = [rpath]
         
+        # key of the surface where the last RayBundles start
+        prevkey = None
+        
         # surfoptions is intended to be a comma separated list
         # of keyword=value pairs        
         
@@ -317,6 +337,8 @@ class OpticalElement(LocalCoordinatesTreeBase):
 
             rpaths_new = []            
 
+            keeplast = record is None or prevkey in record
+
             current_surface = self.__surfaces[surfkey]
                         
             (mnmat, pnmat) = self.__surf_mat_connection[surfkey]
@@ -343,9 +365,9 @@ class OpticalElement(LocalCoordinatesTreeBase):
                                             
                     for rb in raybundles[1:]: # if there are more than one return value, copy path
                         rpathprime = deepcopy(rp)
-                        rpathprime.appendRayBundle(rb)
+                        rpathprime.appendRayBundle(rb, keeplast=keeplast)
                         rpaths_new.append(rpathprime)
-                    rp.appendRayBundle(raybundles[0])
+                    rp.appendRayBundle(raybundles[0], keeplast=keeplast)
 
 
             else:
@@ -358,11 +380,12 @@ class OpticalElement(LocalCoordinatesTreeBase):
     
                     for rb in raybundles[1:]:
                        rpathprime = deepcopy(rp)
-                       rpathprime.appendRayBundle(rb)
+                       rpathprime.appendRayBundle(rb, keeplast=keeplast)
                        rpaths_new.append(rpathprime)
-                    rp.appendRayBundle(raybundles[0])
+                    rp.appendRayBundle(raybundles[0], keeplast=keeplast)
             
             rpaths = rpaths + rpaths_new
+            prevkey = surfkey
             
         return rpaths
         
@@ -26,8 +26,27 @@ import numpy as np
 from material_isotropic import ConstantIndexGlass
 from localcoordinates import LocalCoordinates
 from localcoordinatestreebase import LocalCoordinatesTreeBase
-from ray import RayPath
+from ray import RayPath, RayBundle, merge_raypaths
+from optimize import pool_initargs_error
 from copy import deepcopy
+import multiprocessing
+
+
+# state of the worker processes of OpticalSystem.seqtrace_parallel;
+# it is set once per worker by the pool initializer, such that the
+# optical system is not transferred again with every chunk
+_worker_state = {}
+
+def _init_seqtrace_worker(opticalsystem, elementsequence, splitup, record):
+    _worker_state["system"] = opticalsystem
+    _worker_state["sequence"] = elementsequence
+    _worker_state["splitup"] = splitup
+    _worker_state["record"] = record
+    
+def _seqtrace_worker(raybundle):
+    return _worker_state["system"].seqtrace(raybundle, _worker_state["sequence"], 
+                                            splitup=_worker_state["splitup"],
+                                            record=_worker_state["record"])
 
 class OpticalSystem(LocalCoordinatesTreeBase):
     """
@@ -55,14 +74,72 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         self.material_background = matbackground # Background material        
         self.elements = {}
 
-    def seqtrace(self, initialbundle, elementsequence, splitup=False): # [("elem1", [1, 3, 4]), ("elem2", [1,4,4]), ("elem1", [4, 3, 1])]
+    def getRecordedSurfaces(self, elementsequence, record):
+        """
+        Translates the record option of seqtrace into a set of 
+        (elementkey, surfacekey) tuples. Surfaces are qualified by their
+        element since surface keys are only unique within an element.
+        
+        :param elementsequence: (list) as in seqtrace
+        :param record: (None, string or list)
+                None: all surfaces; "last": only the last RayBundle;
+                "stop": the stop surface(s); a list of (elementkey, 
+                surfacekey) tuples which may also contain "stop".
+                
+        :return None or set of (elementkey, surfacekey) tuples
+        """
+        if record is None:
+            return None
+        if record == "last":
+            record = []
+        elif isinstance(record, str):
+            record = [record]
+        recorded = set()
+        for key in record:
+            if key == "stop":
+                for (elem, subseq) in elementsequence:
+                    for (surfkey, surfoptions) in subseq:
+                        if surfoptions.get("is_stop", False):
+                            recorded.add((elem, surfkey))
+            elif isinstance(key, tuple) and len(key) == 2:
+                recorded.add(key)
+            else:
+                raise Exception("record: expected \"stop\" or (elementkey, surfacekey), got " + repr(key))
+        return recorded
+
+    def seqtrace(self, initialbundle, elementsequence, splitup=False, record=None): # [("elem1", [1, 3, 4]), ("elem2", [1,4,4]), ("elem1", [4, 3, 1])]
+        """
+        Sequential trace of initialbundle through the elements.
+        
+        :param initialbundle: (RayBundle object)
+        :param elementsequence: (list of (elementkey, sequence) tuples)
+        :param splitup: (bool) split rays at anisotropic materials
+        :param record: (None, "last", "stop" or list of (elementkey, surfacekey))
+                Selects the surfaces whose outgoing RayBundles are kept 
+                in the RayPaths (see getRecordedSurfaces). The last 
+                RayBundle is always kept. Discarding the others while 
+                tracing saves memory e.g. in optimization loops which
+                only need the final bundle. Default: keep everything.
+        
+        :return list of RayPath objects
+        """
+        recorded = self.getRecordedSurfaces(elementsequence, record)
+        # (element, surface) where the last RayBundles start
+        prevkey = None
+
         rpath = RayPath(initialbundle)
         rpaths = [rpath]
         for (elem, subseq) in elementsequence:
             rpaths_new = []
+            elemrecorded = None
+            if recorded is not None:
+                elemrecorded = set([surfkey for (elemkey, surfkey) in recorded if elemkey == elem])
             
             for rp in rpaths:
-                raypaths_to_append = self.elements[elem].seqtrace(rp.raybundles[-1], subseq, self.material_background, splitup=splitup)
+                raypaths_to_append = self.elements[elem].seqtrace(rp.raybundles[-1], subseq, self.material_background, splitup=splitup, record=elemrecorded)
+                if recorded is not None and prevkey not in recorded:
+                    # incoming RayBundle is not to be recorded
+                    rp.raybundles.pop()
                 for rp_append in raypaths_to_append[1:]:
                     rpathprime = deepcopy(rp)
                     rpathprime.appendRayPath(rp_append)
@@ -70,8 +147,108 @@ class OpticalSystem(LocalCoordinatesTreeBase):
                 rp.appendRayPath(raypaths_to_append[0])
                 
             rpaths = rpaths + rpaths_new
+            if len(subseq) > 0:
+                prevkey = (elem, subseq[-1][0])
         return rpaths
         
+    def seqtrace_chunked(self, raybundles, elementsequence, splitup=False, reducer=None, record=None):
+        """
+        Streaming variant of seqtrace. Every RayBundle delivered by
+        raybundles is traced separately and reduced right after tracing,
+        such that the full ray history exists only for one chunk at a time.
+        Peak memory is therefore bounded by the chunk size rather than by
+        the total number of rays.
+        
+        :param raybundles: (iterable of RayBundle objects)
+                e.g. a generator from ray.raybundle_chunks
+        :param elementsequence: (list) as in seqtrace
+        :param splitup: (bool) as in seqtrace
+        :param reducer: (function) eats the list of RayPath objects of one
+                chunk and returns the per-chunk result which is kept.
+                Default: the last RayBundle of every RayPath.
+        :param record: as in seqtrace; if None and no reducer is given,
+                only the last RayBundles are recorded.
+        
+        :return generator of reducer results (one per chunk)
+        """
+        if reducer is None:
+            reducer = lambda rpaths: [rp.raybundles[-1] for rp in rpaths]
+            if record is None:
+                record = "last"
+        for raybundle in raybundles:
+            yield reducer(self.seqtrace(raybundle, elementsequence, splitup=splitup, record=record))
+
+    def seqtrace_parallel(self, initialbundle, elementsequence, splitup=False, processes=None, chunksize=10000, record=None):
+        """
+        Variant of seqtrace which distributes the rays over a pool of
+        worker processes. Since the rays are independent of each other,
+        initialbundle is divided into chunks of consecutive rays which are
+        traced separately and merged afterwards. The chunks keep validity
+        and compaction_threshold of initialbundle and do not depend on the
+        number of processes. Therefore the valid rays are the same as the
+        ones of seqtrace (up to the order of splitted paths); only for
+        compaction_threshold > 0 the decision whether invalid rays are
+        carried along is taken per chunk.
+        
+        The optical system is handed to every worker only once at pool
+        start-up (by fork on POSIX systems, else it has to be picklable).
+        If it cannot be transferred, a warning is issued and the chunks 
+        are traced serially.
+        
+        :param initialbundle: (RayBundle object) 
+        :param elementsequence: (list) as in seqtrace
+        :param splitup: (bool) as in seqtrace
+        :param processes: (int) number of worker processes;
+                None uses multiprocessing.cpu_count()
+        :param chunksize: (int) number of rays per chunk
+        :param record: as in seqtrace
+        
+        :return list of RayPath objects as in seqtrace
+        """
+        x0 = initialbundle.x[-1]
+        k0 = initialbundle.k[-1]
+        Efield0 = initialbundle.Efield[-1]
+        valid0 = initialbundle.valid[-1]
+        rayID = initialbundle.rayID
+        numrays = np.shape(x0)[1]
+        
+        chunksize = max(int(chunksize), 1)
+        chunks = []
+        for start in range(0, numrays, chunksize):
+            part = slice(start, start + chunksize)
+            chunk = RayBundle(x0[:, part], k0[:, part], Efield0[:, part], rayID[part], 
+                              initialbundle.returnWaveOfRays(part), 
+                              splitted=initialbundle.splitted,
+                              compaction_threshold=initialbundle.compaction_threshold)
+            # rays already marked invalid stay invalid
+            chunk.valid[0] = valid0[part]
+            chunks.append(chunk)
+        
+        initargs = (self, elementsequence, splitup, record)
+        if processes != 1 and len(chunks) > 1:
+            error = pool_initargs_error(initargs)
+            if error is not None:
+                self.warning("seqtrace_parallel traces serially, cannot transfer system to worker processes: " + error)
+                processes = 1
+        
+        if processes == 1 or len(chunks) == 1:
+            chunkpaths = [self.seqtrace(rb, elementsequence, splitup=splitup, record=record) for rb in chunks]
+        else:
+            pool = multiprocessing.Pool(processes, initializer=_init_seqtrace_worker,
+                                        initargs=initargs)
+            try:
+                # map preserves the order of the chunks
+                chunkpaths = pool.map(_seqtrace_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        
+        numpaths = len(chunkpaths[0])
+        if any([len(rpaths) != numpaths for rpaths in chunkpaths]):
+            raise Exception("seqtrace_parallel: chunks produced different numbers of raypaths")
+        
+        return [merge_raypaths([rpaths[i] for rpaths in chunkpaths]) for i in range(numpaths)]
+
     # TODO: maybe split up para_seqtrace and calculation of pilotraypath from pilotbundle
     # TODO: therefore split pilotbundle, elementsequence from para_seqtrace
     """
@@ -185,6 +362,7 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         """
         if self.checkForRootConnection(element.rootcoordinatesystem):
             self.elements[key] = element
+            self.invalidateVariableRegistry()
         else:
             raise Exception("OpticalElement root should be connected to root of OpticalSystem")
 
@@ -197,6 +375,7 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         # TODO: update of local coordinate references missing
         if key in self.elements:        
             self.elements.pop(key)
+            self.invalidateVariableRegistry()
 
 
     def getABCDMatrix(self, ray, firstSurfacePosition=0, lastSurfacePosition=-1):
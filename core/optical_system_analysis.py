@@ -24,6 +24,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 from log import BaseLogger
 from ray_analysis import RayBundleAnalysis
+from globalconstants import numerical_tolerance
 import matplotlib.pyplot as plt
 
 
@@ -33,9 +34,9 @@ class OpticalSystemAnalysis(BaseLogger):
         super(OpticalSystemAnalysis, self).__init__(name=name)
         self.opticalsystem = os
         
-    def trace(self, initialbundle, fullsequence):
+    def trace(self, initialbundle, fullsequence, record=None):
         self.info("tracing rays")
-        list_of_raypaths = s.seqtrace(initialbundle, sysseq)
+        list_of_raypaths = self.opticalsystem.seqtrace(initialbundle, fullsequence, record=record)
         return list_of_raypaths
         
     def getFootprint(self, raypath, fullsequence, hitlist_part):
@@ -47,14 +48,18 @@ class OpticalSystemAnalysis(BaseLogger):
         return xpos_in_surface_lc
         
     def getSpot(self, raypath, fullsequence):
-        
+        """
+        Spot positions in local coordinates of the last surface and RMS
+        spot size. Only the last RayBundle of raypath is used, therefore
+        it may be traced with record="last".
+        """
         (last_oe, last_oe_sequence) = fullsequence[-1]
         (last_surf_name, last_opt_dict) = last_oe_sequence[-1]
         
         last_surf = self.opticalsystem.elements[last_oe].surfaces[last_surf_name]
         
         last_raybundle = raypath.raybundles[-1]        
-        last_x_global = raypath.raybundles[-1].x[-1]
+        last_x_global = last_raybundle.x[-1][:, last_raybundle.valid[-1]]
 
         last_x_surf = last_surf.rootcoordinatesystem.returnGlobalToLocalPoints(last_x_global)
         
@@ -63,6 +68,57 @@ class OpticalSystemAnalysis(BaseLogger):
         
         return (last_x_surf[0:2, :], rmscentroidsize)
 
+
+    def getSpotChunked(self, raybundles, fullsequence):
+        """
+        Spot centroid and RMS spot size for large numbers of rays. The rays
+        are traced chunk by chunk (see OpticalSystem.seqtrace_chunked) and
+        only number, mean and sum of squared deviations of the valid final
+        positions are kept per chunk. They are combined by the pairwise
+        update of Chan et al., which (unlike sums of squares) does not 
+        cancel for small spots far off the local origin.
+        
+        :param raybundles: (iterable of RayBundle objects)
+        :param fullsequence: (list) element sequence for seqtrace
+        
+        :return (centroid, rmscentroidsize, num_rays): centroid in local
+                coordinates of the last surface (1d numpy array of 3 floats),
+                RMS spot size w.r.t. centroid (float), number of valid rays (int)
+        """
+        (last_oe, last_oe_sequence) = fullsequence[-1]
+        (last_surf_name, last_opt_dict) = last_oe_sequence[-1]
+        
+        last_surf = self.opticalsystem.elements[last_oe].surfaces[last_surf_name]
+
+        def reducer(raypaths):
+            xs = []
+            for raypath in raypaths:
+                last_raybundle = raypath.raybundles[-1]
+                valid = last_raybundle.valid[-1]
+                xs.append(last_surf.rootcoordinatesystem.returnGlobalToLocalPoints(last_raybundle.x[-1][:, valid]))
+            x = np.hstack(xs)
+            num_rays = np.shape(x)[1]
+            if num_rays == 0:
+                return (0, np.zeros(3), 0.)
+            mean_x = np.mean(x, axis=1)
+            m2 = np.sum((x - mean_x[:, np.newaxis])**2)
+            return (num_rays, mean_x, m2)
+
+        num_rays = 0
+        centroid = np.zeros(3)
+        m2 = 0.
+        for (n, mean_x, m2_chunk) in self.opticalsystem.seqtrace_chunked(raybundles, fullsequence, reducer=reducer, record="last"):
+            if n == 0:
+                continue
+            total = num_rays + n
+            delta = mean_x - centroid
+            centroid = centroid + delta*float(n)/total
+            m2 += m2_chunk + np.sum(delta**2)*float(num_rays)*n/total
+            num_rays = total
+        
+        rmscentroidsize = np.sqrt(m2/(num_rays - 1 + numerical_tolerance))
+        
+        return (centroid, rmscentroidsize, num_rays)
     
     def drawSpotDiagram(self, raypath, fullsequence, ax=None):
         (spot_xy, rmscentroidsize) = self.getSpot(raypath, fullsequence)
@@ -23,9 +23,52 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 import math
+import sys
+import pickle
+import multiprocessing
 
 from log import BaseLogger
 
+
+# state of the worker processes of Optimizer.MeritFunctionWrapperBatch;
+# the optimizer (and therefore the optical system) is set once per worker 
+# by the pool initializer, afterwards only the variable vectors are sent
+_worker_state = {}
+
+def _init_merit_worker(optimizer):
+    _worker_state["optimizer"] = optimizer
+
+def _merit_worker(x):
+    return _worker_state["optimizer"].calcMerit(x)
+
+def pool_initargs_error(initargs, forking=None):
+    """
+    Checks whether initargs can be handed to the initializer of 
+    multiprocessing.Pool workers. Forked workers (POSIX) inherit them,
+    other start methods (spawn on Windows) pickle them; this requires 
+    e.g. merit and update functions defined at module level (no lambdas,
+    no nested functions).
+    
+    @param: initargs (tuple)
+    @param: forking (bool or None): None detects the start method
+    
+    @return: None if the workers can receive initargs, else the error message
+    """
+    if forking is None:
+        get_start_method = getattr(multiprocessing, "get_start_method", None)
+        if get_start_method is None:
+            # Python 2 forks on every platform except Windows
+            forking = sys.platform != "win32"
+        else:
+            forking = get_start_method() == "fork"
+    if forking:
+        return None
+    try:
+        pickle.dumps(initargs, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return str(e)
+    return None
+
 class OptimizableVariable(BaseLogger):
     """
     Class that contains an optimizable variable. Used to get a pointer on a variable.
@@ -106,7 +149,9 @@ class OptimizableVariable(BaseLogger):
             self.transform = lambda x: x
             self.inv_transform = lambda x: x
         else:
-            self.inv_transform = lambda x: left + (right - left)/(1. + math.exp(-x/math.fabs(right - left)))
+            # left + (right - left)/(1 + exp(-x/|right - left|)) written with tanh,
+            # which does not overflow for large |x| (e.g. particle swarms)
+            self.inv_transform = lambda x: left + 0.5*(right - left)*(1. + math.tanh(0.5*x/math.fabs(right - left)))
             self.transform = lambda x: math.log((-x + left)/(x - right))*math.fabs(left - right)
 
     def changetype(self, vtype, **kwargs):
@@ -121,6 +166,9 @@ class OptimizableVariable(BaseLogger):
             and self.__var_type in ["variable", "fixed"] \
             and parameter_backup["value"] != None:
             self.parameters["value"] = parameter_backup["value"]
+        # the sets of active variables have changed
+        if getattr(self, "_in_variable_registry", False):
+            ClassWithOptimizableVariables.invalidateVariableRegistry()
 
     def setvalue(self, value):
         # TODO: overload assign operator
@@ -172,7 +220,37 @@ class ClassWithOptimizableVariables(BaseLogger):
     """
     Implementation of some class with optimizable variables with the help of a dictionary.
     This class is also able to collect the variables and their values from its subclasses per recursion.
+
+    The collected variables are cached (see getVariableRegistry). Assigning
+    an attribute which is an optimizable variable or an object containing
+    them, as well as changing the type of a variable, is detected. Changes
+    inside containers (e.g. self.somedict[key] = var or list.append) are
+    not detected: methods doing so have to call invalidateVariableRegistry.
     """
+
+    # Incremented whenever optimizable variables or objects containing them
+    # are linked, unlinked or change their type. The variable lists cached
+    # by getAllVariables are valid as long as this counter is unchanged.
+    # Objects and variables which were never collected into a registry
+    # (e.g. still under construction) cannot invalidate it.
+    structure_version = 0
+
+    @staticmethod
+    def invalidateVariableRegistry():
+        ClassWithOptimizableVariables.structure_version += 1
+
+    def __setattr__(self, name, value):
+        if isinstance(value, (OptimizableVariable, ClassWithOptimizableVariables)) \
+            and self.__dict__.get("_in_variable_registry", False):
+            ClassWithOptimizableVariables.structure_version += 1
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        # the cached registry is rebuilt where needed (e.g. in worker processes)
+        state = self.__dict__.copy()
+        state.pop("_ClassWithOptimizableVariables__registry", None)
+        return state
+
     def __init__(self, name = "", **kwargs):
         """
         Initialize with empty dict.
@@ -205,40 +283,66 @@ class ClassWithOptimizableVariables(BaseLogger):
 
                 
     def getAllVariables(self):
+        """
+        Optimizable variables in this object and its linked objects. 
+        The list is cached and only collected again after structural
+        changes (see invalidateVariableRegistry).
+        
+        @return: list of OptimizableVariable objects
+        """
+        return list(self.getVariableRegistry()[0])
+
+    def getVariableRegistry(self):
+        """
+        Cached lists of all and of the active optimizable variables.
+        
+        @return: (allvariables, activevariables) (tuple of lists)
+        """
+        registry = self.__dict__.get("_ClassWithOptimizableVariables__registry")
+        if registry is None or registry[0] != ClassWithOptimizableVariables.structure_version:
+            allvariables = self.collectAllVariables()
+            activevariables = [x for x in allvariables if x.var_type == "variable"]
+            registry = (ClassWithOptimizableVariables.structure_version, 
+                        allvariables, activevariables)
+            # bypass __setattr__, the registry is no structural change
+            self.__dict__["_ClassWithOptimizableVariables__registry"] = registry
+        return registry[1:]
+                
+    def collectAllVariables(self):
+        """
+        Accumulates optimizable variables in self and its linked objects.
+        Ignores ring-links and double links.       
+        """
+        listOfOptVars = []
+        visited = set()
 
-        def addOptimizableVariablesToList(var, listOfOptVars = [], idlist=[]):
+        def addOptimizableVariablesToList(var):
             """
-            Accumulates optimizable variables in var and its linked objects.
-            Ignores ring-links and double links.       
-            
             @param var: object to evaluate (object)
-            @param listOfOptVars: optimizable variables found so far (list of objects)
-            @param idlist: ids of objects already evaluated (list of int)
             """ 
-            
-            if id(var) not in idlist:
-                idlist.append(id(var))
-    
-                if isinstance(var, ClassWithOptimizableVariables):
-                    for v in var.__dict__.values():
-                        listOfOptVars, idlist = addOptimizableVariablesToList(v, listOfOptVars, idlist) 
-                elif isinstance(var, dict):
-                    for v in var.values():
-                        listOfOptVars, idlist = addOptimizableVariablesToList(v, listOfOptVars, idlist)                        
-    
-                elif isinstance(var, list) or isinstance(var, tuple):
-                    for v in var:
-                        listOfOptVars, idlist = addOptimizableVariablesToList(v, listOfOptVars, idlist)
-    
-                elif isinstance(var, OptimizableVariable):
-                    listOfOptVars.append(var)
-    
-            return listOfOptVars, idlist
-
-
-
-        (lst, idlist) = addOptimizableVariablesToList(self)
-        return lst
+            if id(var) in visited:
+                return
+            visited.add(id(var))
+
+            if isinstance(var, ClassWithOptimizableVariables):
+                var.__dict__["_in_variable_registry"] = True
+                # sorted: the order of the variables must not depend on
+                # the layout of __dict__ (e.g. after caching the registry)
+                for key in sorted(var.__dict__):
+                    if key != "_ClassWithOptimizableVariables__registry":
+                        addOptimizableVariablesToList(var.__dict__[key]) 
+            elif isinstance(var, dict):
+                for v in var.values():
+                    addOptimizableVariablesToList(v)
+            elif isinstance(var, list) or isinstance(var, tuple):
+                for v in var:
+                    addOptimizableVariablesToList(v)
+            elif isinstance(var, OptimizableVariable):
+                var._in_variable_registry = True
+                listOfOptVars.append(var)
+
+        addOptimizableVariablesToList(self)
+        return listOfOptVars
 
 
     def getAllValues(self):
@@ -253,30 +357,30 @@ class ClassWithOptimizableVariables(BaseLogger):
         but it does not matter since the variable references are still in the
         original dictionary in the class
         """
-        return [x for x in self.getAllVariables() if x.var_type == "variable"]
+        return list(self.getVariableRegistry()[1])
 
 
     def getActiveValues(self):
         """
         Function to get all values into one large np.array.
         """
-        return np.array([a() for a in self.getActiveVariables()])
+        return np.array([a() for a in self.getVariableRegistry()[1]])
 
     def setActiveValues(self, x):
         """
         Function to set all values of active variables to the values in the large np.array x.
         """
-        for i, var in enumerate(self.getActiveVariables()):
+        for i, var in enumerate(self.getVariableRegistry()[1]):
             var.setvalue(x[i])
 
     def getActiveTransformedValues(self):
-        return np.array([a.evaluate_transformed() for a in self.getActiveVariables()])
+        return np.array([a.evaluate_transformed() for a in self.getVariableRegistry()[1]])
 
     def setActiveTransformedValues(self, x):
         """
         Function to set all values of active variables to the values in the large np.array x.
         """
-        for i, var in enumerate(self.getActiveVariables()):
+        for i, var in enumerate(self.getVariableRegistry()[1]):
             var.setvalue_transformed(x[i])
 
 
@@ -286,12 +390,29 @@ class Optimizer(BaseLogger):
     attachment of other meritfunctions or other update functions with other
     parameters is possible.
     '''
-    def __init__(self, classwithoptvariables, meritfunction, backend, name='', updatefunction=None):
+    def __init__(self, classwithoptvariables, meritfunction, backend, name='', updatefunction=None, processes=1,
+                 merit_cache_size=0, merit_cache_quantum=None):
+        """
+        :param processes: (int or None) number of worker processes for
+                batches of merit function evaluations during run(); 
+                None uses multiprocessing.cpu_count(), 1 evaluates serially.
+                Where the workers are not forked (Windows), the optimizer
+                is pickled: merit and update function have to be defined
+                at module level, otherwise the evaluation stays serial
+                (see openPool)
+        :param merit_cache_size: (int) number of merit values memoized
+                (least recently used are dropped); 0 disables the cache
+        :param merit_cache_quantum: (float or None) variable vectors which
+                coincide after rounding to multiples of this step share
+                one cache entry; None compares them exactly
+        """
 
         def noupdate(cl):
             pass
         
         super(Optimizer, self).__init__(name=name)
+        self.processes = processes
+        self.pool = None
         self.classwithoptvariables = classwithoptvariables
         self.meritfunction = meritfunction # function to minimize
         if updatefunction is None:
@@ -303,17 +424,22 @@ class Optimizer(BaseLogger):
         self.meritparameters = {}
         self.updateparameters = {}
         self.number_of_calls = 0 # how often is the merit function called during one run?
+        self.merit_cache_size = merit_cache_size
+        self.merit_cache_quantum = merit_cache_quantum
+        self.clearMeritCache()
 
     def setBackend(self, backend):
         self.__backend = backend
-        self.__backend.init(self.MeritFunctionWrapper)
+        self.__backend.init(self.MeritFunctionWrapper, funcbatch=self.MeritFunctionWrapperBatch)
 
     backend = property(fget=None, fset=setBackend)
 
     def MeritFunctionWrapper(self, x):
         """
         Merit function wrapper for backend. 
-        Notice that x and length of active values must have the same size
+        Notice that x and length of active values must have the same size.
+        If the merit cache is enabled, the variables are only set and
+        the merit function is only called for vectors not in the cache.
     
         :param x (np.array): active variable values
         :param meritfunction (function): meritfunction depending on s
@@ -321,29 +447,141 @@ class Optimizer(BaseLogger):
         :return value of the merit function
         """
         self.number_of_calls += 1
+        if self.merit_cache_size <= 0:
+            return self.calcMerit(x)
+        key = self.getMeritCacheKey(x)
+        res = self.lookupMeritCache(key)
+        if res is None:
+            res = self.calcMerit(x)
+            self.storeMeritCache(key, res)
+        return res
+
+    def calcMerit(self, x):
+        """
+        Sets the variables to x, updates the system and evaluates
+        the merit function (without cache).
+        """
         self.classwithoptvariables.setActiveTransformedValues(x)
         self.updatefunction(self.classwithoptvariables, **self.updateparameters)    
         res = self.meritfunction(self.classwithoptvariables, **self.meritparameters)
         self.debug("call number " + str(self.number_of_calls) + " meritfunction: " + str(res))
         return res
 
+    def clearMeritCache(self):
+        """
+        Empties the memoized merit values, e.g. after changing the merit
+        function, its parameters or fixed variables of the system.
+        """
+        # key: (quantized) variable vector, value: [merit, time of last use]
+        self.__merit_cache = {}
+        self.__merit_cache_clock = 0
+        self.merit_cache_hits = 0
+        self.merit_cache_misses = 0
+
+    def getMeritCacheKey(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.merit_cache_quantum is not None:
+            x = np.round(x/self.merit_cache_quantum)
+        return tuple(x)
+
+    def lookupMeritCache(self, key):
+        """
+        :return memoized merit value or None
+        """
+        self.__merit_cache_clock += 1
+        entry = self.__merit_cache.get(key)
+        if entry is None:
+            self.merit_cache_misses += 1
+            return None
+        self.merit_cache_hits += 1
+        entry[1] = self.__merit_cache_clock
+        return entry[0]
+
+    def storeMeritCache(self, key, value):
+        cache = self.__merit_cache
+        while cache and len(cache) >= self.merit_cache_size:
+            del cache[min(cache, key=lambda k: cache[k][1])]
+        cache[key] = [value, self.__merit_cache_clock]
+
+    def MeritFunctionWrapperBatch(self, xs):
+        """
+        Evaluates the merit function for several variable vectors, 
+        concurrently if the evaluation pool is open (see openPool).
+        
+        :param xs (2d numpy array or list of 1d arrays): active variable values
+        
+        :return values of the merit function (1d numpy array)
+        """
+        if self.pool is None:
+            return np.array([self.MeritFunctionWrapper(x) for x in xs])
+        self.number_of_calls += len(xs)
+        res = [None]*len(xs)
+        keys = [None]*len(xs)
+        if self.merit_cache_size > 0:
+            keys = [self.getMeritCacheKey(x) for x in xs]
+            res = [self.lookupMeritCache(key) for key in keys]
+        todo = [i for (i, r) in enumerate(res) if r is None]
+        # map preserves the order of the vectors
+        values = self.pool.map(_merit_worker, [xs[i] for i in todo])
+        for (i, value) in zip(todo, values):
+            res[i] = value
+            if self.merit_cache_size > 0:
+                self.storeMeritCache(keys[i], value)
+        self.debug("batch of " + str(len(xs)) + " meritfunction calls, " + str(len(todo)) + " evaluated")
+        return np.array(res)
+
+    def openPool(self):
+        """
+        Starts the worker processes for MeritFunctionWrapperBatch. Every
+        worker gets a snapshot of the optimizer including the system;
+        afterwards only the variable vectors are transferred. If the
+        snapshot cannot be transferred (see pool_initargs_error), a 
+        warning is issued and the batches are evaluated serially.
+        """
+        processes = self.processes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes > 1 and self.pool is None:
+            error = pool_initargs_error((self,))
+            if error is not None:
+                self.warning("merit function evaluation stays serial, cannot transfer optimizer to worker processes: " + error)
+                return
+            self.pool = multiprocessing.Pool(processes, initializer=_init_merit_worker,
+                                             initargs=(self,))
+
+    def closePool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def run(self):
         '''
         Funtion to perform a certain number of optimization steps.
         '''
         self.info("optimizer run start")        
+        self.clearMeritCache()
         x0 = self.classwithoptvariables.getActiveTransformedValues()
         
         self.info("initial x: " + str(x0))
         self.info("initial merit: " + str(self.MeritFunctionWrapper(x0)))
         self.debug("calling backend run")
-        xfinal = self.__backend.run(x0)
+        self.openPool()
+        try:
+            xfinal = self.__backend.run(x0)
+        finally:
+            self.closePool()
         self.debug("finished backend run")
         self.info("final x: " + str(xfinal))
         self.info("final merit: " + str(self.MeritFunctionWrapper(xfinal)))
+        # the final merit may come from the cache, therefore update explicitly
         self.classwithoptvariables.setActiveTransformedValues(xfinal)
+        self.updatefunction(self.classwithoptvariables, **self.updateparameters)
         # TODO: do not change original classwithoptvariables
         self.info("called merit function " + str(self.number_of_calls) + " times.")
+        if self.merit_cache_size > 0:
+            self.info("merit cache: " + str(self.merit_cache_hits) + " hits, " + 
+                      str(self.merit_cache_misses) + " misses.")
         self.number_of_calls = 0
         self.info("optimizer run finished")        
         return self.classwithoptvariables
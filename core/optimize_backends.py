@@ -25,6 +25,23 @@ from scipy.optimize import minimize
 import numpy as np
 from log import BaseLogger
 
+def finite_difference_gradient(funcbatch, x, dx=1.4901161193847656e-08):
+    """
+    Forward difference gradient (as scipy.optimize.approx_fprime) 
+    for a function evaluating batches of vectors.
+    
+    :param funcbatch (function): 2d array of n+1 vectors -> 1d array 
+    :param x (1d numpy array of n floats)
+    :param dx (float) step size
+    
+    :return gradient (1d numpy array of n floats)
+    """
+    x = np.asarray(x, dtype=float)
+    xs = np.vstack((x, x + dx*np.eye(len(x))))
+    f = np.asarray(funcbatch(xs), dtype=float)
+    return (f[1:] - f[0])/dx
+
+
 class Backend(BaseLogger):
     """
     Base class for the optimization backend. Performs one full optimization run.
@@ -40,14 +57,36 @@ class Backend(BaseLogger):
         by the optimization backend        
         """        
         self.options = kwargs
+        self.funcbatch = None
         super(Backend, self).__init__(name=name)
 
-    def init(self, func):
+    def init(self, func, funcbatch=None):
         """
         Tells backend which function to optimize (usually if coupled to
-        optimizer this is a merit function wrapper)
+        optimizer this is a merit function wrapper). funcbatch evaluates
+        func for a batch of vectors (possibly concurrently).
         """
         self.func = func
+        self.funcbatch = funcbatch
+
+    def evaluateBatch(self, xs):
+        """
+        Function values for a batch of vectors.
+
+        :param xs (2d numpy array or list of 1d arrays)
+
+        :return 1d numpy array
+        """
+        if self.funcbatch is None:
+            return np.array([self.func(x) for x in xs])
+        return self.funcbatch(xs)
+
+    def gradient(self, x, dx=1.4901161193847656e-08):
+        """
+        Forward difference gradient; x and the displaced vectors are
+        evaluated in one batch.
+        """
+        return finite_difference_gradient(self.evaluateBatch, x, dx=dx)
         
     def run(self, x0):
         """
@@ -59,11 +98,18 @@ class Backend(BaseLogger):
 
 class ScipyBackend(Backend):
     """
-    Uses scipy for optimization.
+    Uses scipy for optimization. With the option batchgradient=True
+    the finite difference gradients for gradient based methods are 
+    evaluated as one batch (concurrently if the optimizer has an 
+    evaluation pool) instead of one call after another by scipy.
     """
     
     def run(self, x0):
-        res = minimize(self.func, x0, args=(), **self.options)
+        options = dict(self.options)
+        if options.pop("batchgradient", False) and options.get("jac") is None:
+            dx = options.get("options", {}).get("eps", 1.4901161193847656e-08)
+            options["jac"] = lambda x: self.gradient(x, dx=dx)
+        res = minimize(self.func, x0, args=(), **options)
         return res.x
         
 class Newton1DBackend(Backend):
@@ -120,80 +166,71 @@ class Newton1DBackend(Backend):
         return xfinal
         
 class ParticleSwarmBackend(Backend):
+    """
+    Particle swarm optimization with constriction factor. The swarm is 
+    stored as (num_particles x dim) arrays together with the cached
+    merit values of the personal best positions; every iteration evaluates
+    each particle once in a single batch (concurrently if the optimizer
+    has an evaluation pool).
+    
+    Bounds are not handled here: set an interval on the OptimizableVariable
+    (set_interval); the backend then works on the transformed, unbounded 
+    values and the particles never leave the interval.
+    
+    options: cube (2 x dim array, initial region relative to x0),
+    num_particles, max_velocities (initial velocities), tol (termination
+    when the rms spread of the swarm is smaller), iterations, c1, c2
+    """
         
     def run(self, x0):
 
-        class particle:
-            
-            def __init__(self, x0, v0):
-                self.x = x0
-                self.v = v0
-                self.pb = x0
-        
-        initcube = self.options.get("cube", np.vstack((-np.ones(np.shape(x0)), np.ones(np.shape(x0)))))
+        dim = len(x0)
+        initcube = self.options.get("cube", np.vstack((-np.ones(dim), np.ones(dim))))
         cubedelta = initcube[1] - initcube[0]
         num_particles = self.options.get("num_particles", 10)
-        max_velocities = self.options.get("max_velocities", 0.1*np.ones(np.shape(x0)))
+        max_velocities = self.options.get("max_velocities", 0.1*np.ones(dim))
         tol = self.options.get("tol", 1e-3)
         max_iters = self.options.get("iterations", 100)
-        
-        particle_list = [
-            particle(x0 + initcube[0] + np.random.random(np.shape(x0))*cubedelta,
-                     max_velocities*(1. - 2.*np.random.random(np.shape(x0)))) for i in range(num_particles)]        
-
-        termination = False
-        
-        def bestglobalpos():
-            result = np.copy(particle_list[0].x)
-            for p in particle_list:
-                if self.func(p.x) < self.func(result):
-                    result = np.copy(p.x)
-            return result
-            
-       
         c1 = self.options.get("c1", 2.0)
         c2 = self.options.get("c2", 2.0)        
+
+        phi = c1 + c2
+        chi = 2./np.abs(2. - phi - np.sqrt(phi**2 - 4.*phi))   
         
-        iters = 0        
-        
-        result = np.zeros(np.shape(x0))
+        x = x0 + initcube[0] + np.random.random((num_particles, dim))*cubedelta
+        v = max_velocities*(1. - 2.*np.random.random((num_particles, dim)))
         
+        # personal best positions and their merit values
+        pb = np.copy(x)
+        fpb = self.evaluateBatch(x)
+        best = np.argmin(fpb)
+        (pg, fpg) = (np.copy(pb[best]), fpb[best])
+
+        iters = 0        
+        termination = False
         
         while not termination and iters < max_iters:
             iters += 1
-            pg = bestglobalpos()
 
-            phi = c1 + c2
-            chi =  2./np.abs(2. - phi - np.sqrt(phi**2 - 4.*phi))   
+            r1 = np.random.random((num_particles, 1))
+            r2 = np.random.random((num_particles, 1))
+            
+            v = chi*(v + c1*r1*(pb - x) + c2*r2*(pg - x))
+            x = x + v
 
+            f = self.evaluateBatch(x)
+            improved = f < fpb
+            pb[improved] = x[improved]
+            fpb[improved] = f[improved]
 
-            particle_com = np.zeros(np.shape(x0))
+            best = np.argmin(fpb)
+            if fpb[best] < fpg:
+                (pg, fpg) = (np.copy(pb[best]), fpb[best])
 
-            
-            for p in particle_list:
-                if self.func(p.x) < self.func(p.pb):
-                    p.pb = p.x
-                    
-                r1 = np.random.random()
-                r2 = np.random.random()
-                
-                
-                p.v = chi*(p.v + c1*r1*(p.pb - p.x) + c2*r2*(pg - p.x))
-                p.x = p.x + p.v
-           
-                particle_com += p.x/num_particles
-
-            particle_rms = 0
-            for p in particle_list:
-                particle_rms += np.sum((p.x - particle_com)**2)/num_particles
-            
-            particle_rms = np.sqrt(particle_rms)
-            
+            particle_rms = np.sqrt(np.sum((x - np.mean(x, axis=0))**2)/num_particles)
             termination = particle_rms < tol
-            
-            result = pg
-        
-        return result
+
+        return pg
         
             
 
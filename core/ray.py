@@ -24,10 +24,11 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 import math
 
-from globalconstants import standard_wavelength, canonical_ex, canonical_ey
+from globalconstants import standard_wavelength, canonical_ex, canonical_ey, compaction_threshold
 
 class RayBundle(object):
-    def __init__(self, x0, k0, Efield0, rayID = [], wave = standard_wavelength, splitted=False):
+    def __init__(self, x0, k0, Efield0, rayID = [], wave = standard_wavelength, splitted=False, capacity=2,
+                 compaction_threshold=compaction_threshold):
         """
         Class representing a bundle of rays.
 
@@ -40,10 +41,24 @@ class RayBundle(object):
         :param rayID: (1d numpy array of int) 
                     Set an ID number for each ray in the bundle; 
                     if empty -> generate arange 
-        :param wave: (float) 
+        :param wave: (float or 1d numpy array of N floats) 
                     Wavelength of the radiation in millimeters. 
+                    An array assigns every ray its own wavelength
+                    (polychromatic bundle); the rays are then traced
+                    through all materials in one pass.
+        :param capacity: (int)
+                    Number of points for which the history storage is
+                    preallocated. The storage grows by doubling, therefore
+                    this is only a hint, e.g. the number of integration
+                    steps expected in a GRIN medium.
+        :param compaction_threshold: (float)
+                    Fraction of invalid rays above which they are removed
+                    in the RayBundles following this one (see 
+                    getCompactionIndices). 0 removes every invalid ray,
+                    1 never removes rays.
         """
         self.splitted = splitted
+        self.compaction_threshold = compaction_threshold
         numray = np.shape(x0)[1]
         if rayID == [] or len(rayID) == 0:
             rayID = np.arange(numray)
@@ -51,22 +66,35 @@ class RayBundle(object):
             
         newshape = self.newshape(np.shape(x0))
             
-        self.x = x0.reshape(newshape) 
+        # The history of x, k, Efield and valid is kept in preallocated
+        # buffers of shape (capacity, 3, N) and (capacity, N). Only the
+        # first self.__num entries are in use and they are exposed as views
+        # via the x, k, Efield and valid properties. Appending writes into
+        # the next free slot and doubles the capacity if necessary;
+        # therefore tracing through many surfaces or integration steps
+        # is linear in time and memory.
+        self.__num = 1
+        capacity = max(int(capacity), 1)
+        
+        self.__x = self.allocate(capacity, x0.reshape(newshape))
         # First index counting index: x[0] == x0
         # shape(x): axis=0: counting axis
         # axis=1: vector components (xyz)
         # axis=2: ray number
 
-        self.k = k0.reshape(newshape) 
+        self.__k = self.allocate(capacity, k0.reshape(newshape))
         
-        self.valid = np.ones((1, numray), dtype=bool)
+        self.__valid = self.allocate(capacity, np.ones((1, numray), dtype=bool))
         
+        if np.ndim(wave) > 0:
+            wave = np.asarray(wave, dtype=float)
+            if np.shape(wave) != (numray,):
+                raise Exception("RayBundle: need one wavelength per ray")
         self.wave = wave
         if Efield0 is None or len(Efield0) == 0:
-            self.Efield = np.zeros(newshape)
-            self.Efield[:, 1, :] = 1.
-        else:
-            self.Efield = Efield0.reshape(newshape)
+            Efield0 = np.zeros(newshape)
+            Efield0[:, 1, :] = 1.
+        self.__Efield = self.allocate(capacity, Efield0.reshape(newshape))
 
     def newshape(self, shape2d):
         """
@@ -74,6 +102,96 @@ class RayBundle(object):
         """
         return tuple([1] + list(shape2d))
 
+    def allocate(self, capacity, initial):
+        """
+        Allocates history storage for capacity points and fills in
+        the initial entries.
+        
+        :param capacity (int)
+        :param initial (numpy array with counting axis 0)
+        
+        :return buffer (numpy array of shape (capacity, ...))
+        """
+        buf = np.zeros((capacity,) + np.shape(initial)[1:], dtype=initial.dtype)
+        buf[:len(initial)] = initial
+        return buf
+
+    def getCapacity(self):
+        return np.shape(self.__x)[0]
+        
+    capacity = property(fget=getCapacity)
+
+    def reserve(self, capacity):
+        """
+        Grows the history storage such that at least capacity points
+        fit in without further reallocation.
+        
+        :param capacity (int)
+        """
+        if capacity > self.capacity:
+            self.__x = self.allocate(capacity, self.x)
+            self.__k = self.allocate(capacity, self.k)
+            self.__Efield = self.allocate(capacity, self.Efield)
+            self.__valid = self.allocate(capacity, self.valid)
+
+    def upcast(self, buf, new):
+        """
+        Returns buf converted to a dtype which is also able to hold new
+        (e.g. real k vectors are followed by complex ones).
+        """
+        dtype = np.result_type(buf, new)
+        if dtype != buf.dtype:
+            buf = buf.astype(dtype)
+        return buf
+
+    def getX(self):
+        return self.__x[:self.__num]
+
+    def setX(self, x):
+        self.__x = np.asarray(x)
+        self.__num = len(self.__x)
+
+    x = property(getX, setX)
+
+    def getK(self):
+        return self.__k[:self.__num]
+
+    def checkLength(self, name, arr):
+        """
+        Checks that a history array assigned via the k, Efield or valid
+        properties has as many points as the x history. Assign x first,
+        since it determines the number of points.
+        """
+        if len(arr) != self.__num:
+            raise Exception("RayBundle: %s has %d points but x has %d" % (name, len(arr), self.__num))
+
+    def setK(self, k):
+        k = np.asarray(k)
+        self.checkLength("k", k)
+        self.__k = k
+
+    k = property(getK, setK)
+
+    def getEfield(self):
+        return self.__Efield[:self.__num]
+
+    def setEfield(self, Efield):
+        Efield = np.asarray(Efield)
+        self.checkLength("Efield", Efield)
+        self.__Efield = Efield
+
+    Efield = property(getEfield, setEfield)
+
+    def getValid(self):
+        return self.__valid[:self.__num]
+
+    def setValid(self, valid):
+        valid = np.asarray(valid)
+        self.checkLength("valid", valid)
+        self.__valid = valid
+
+    valid = property(getValid, setValid)
+
     def append(self, xnew, knew, Enew, Validnew):
         """
         Appends one point with appropriate wave vector, electrical field and
@@ -85,30 +203,130 @@ class RayBundle(object):
         :param Validnew (1d numpy array of bool)
         
         """
-        newshape = self.newshape(np.shape(xnew))        
-        newshapev = (1, np.shape(Validnew)[0])                
+        num = self.__num
+        if num >= self.capacity:
+            self.reserve(2*self.capacity)
+
+        self.__x = self.upcast(self.__x, xnew)
+        self.__k = self.upcast(self.__k, knew)
+        self.__Efield = self.upcast(self.__Efield, Enew)
+
+        self.__x[num] = xnew
+        self.__k[num] = knew
+        self.__Efield[num] = Enew
+        self.__valid[num] = self.__valid[num - 1]*Validnew
+
+        self.__num = num + 1
+        
+    def isPolychromatic(self):
+        return np.ndim(self.wave) > 0
+
+    def returnWaveOfRays(self, indices):
+        """
+        Wavelength(s) of a subset of the rays, e.g. for RayBundles
+        continuing only some of the rays.
+        
+        :param indices (1d numpy array of int, bool mask or slice)
+        
+        :return wave (float or 1d numpy array of float)
+        """
+        if self.isPolychromatic():
+            return self.wave[indices]
+        return self.wave
+
+    def returnWaveGroups(self):
+        """
+        Groups the rays by wavelength.
+        
+        :return list of (wave, indices) tuples; wave (float),
+                indices (1d numpy array of int)
+        """
+        numrays = np.shape(self.x)[2]
+        if not self.isPolychromatic():
+            return [(self.wave, np.arange(numrays))]
+        (waves, inverse) = np.unique(self.wave, return_inverse=True)
+        return [(wave, np.flatnonzero(inverse == ind)) for (ind, wave) in enumerate(waves)]
+
+    def returnWaveMask(self, wave):
+        """
+        :param wave (float)
+        
+        :return mask of the rays with this wavelength (1d numpy array of bool)
+        """
+        numrays = np.shape(self.x)[2]
+        return np.ones(numrays, dtype=bool)*(self.wave == wave)
+
+    def getCompactionIndices(self, valid):
+        """
+        Compaction policy for rays which became invalid (vignetting, total
+        internal reflection, ...): if the fraction of invalid rays exceeds
+        compaction_threshold, only the valid rays are continued, else all
+        rays are kept and the invalid ones are only marked.
+        
+        :param valid (1d numpy array of bool)
+        
+        :return indices of the rays to continue (1d numpy array of int)
+        """
+        numrays = len(valid)
+        numinvalid = numrays - np.count_nonzero(valid)
+        if numinvalid > self.compaction_threshold*numrays:
+            return np.flatnonzero(valid)
+        return np.arange(numrays)
+
+    def createContinuation(self, x0, k0, Efield0, valid, rayID=None, splitted=False, wave=None):
+        """
+        Creates the RayBundle which continues the rays of this one 
+        (e.g. after refraction) and applies the compaction policy.
+        The rayIDs of the continued rays are kept, therefore they map 
+        the rays of the new RayBundle to the rays of the initial one.
         
-        txnew = np.reshape(xnew, newshape)
-        tknew = np.reshape(knew, newshape)
-        tEnew = np.reshape(Enew, newshape)
-        tValidnew = np.reshape(self.valid[-1]*Validnew, newshapev)
+        :param x0, k0, Efield0: (2d numpy 3xN arrays) start values for 
+                all N rays; Efield0 may be None
+        :param valid: (1d numpy array of bool) validity of all N rays
+        :param rayID: (1d numpy array of int) if None, self.rayID
+        :param splitted: (bool)
+        :param wave: (float or 1d numpy array of N floats) if None, 
+                self.wave; needed for polychromatic RayBundles if the 
+                number of rays changes (e.g. doubled rays in 
+                anisotropic media)
         
-        self.x      = np.vstack((self.x, txnew))
-        self.k      = np.vstack((self.k, tknew))
-        self.Efield = np.vstack((self.Efield, tEnew))
-        self.valid  = np.vstack((self.valid, tValidnew))
+        :return RayBundle object
+        """
+        if rayID is None:
+            rayID = self.rayID
+        indices = self.getCompactionIndices(valid)
+        if Efield0 is not None:
+            Efield0 = Efield0[:, indices]
+        if wave is None:
+            wave = self.returnWaveOfRays(indices)
+        elif np.ndim(wave) > 0:
+            wave = np.asarray(wave)[indices]
+        result = RayBundle(x0[:, indices], k0[:, indices], Efield0, rayID[indices], wave, 
+                           splitted=splitted, compaction_threshold=self.compaction_threshold)
+        result.__valid[0] = valid[indices]
+        return result
         
     def clone(self):
-        result = RayBundle(self.x[0], self.k[0], self.Efield[0], self.rayID, self.wave)
+        result = RayBundle(self.x[0], self.k[0], self.Efield[0], self.rayID, self.wave, capacity=self.capacity,
+                           compaction_threshold=self.compaction_threshold)
         
-        result.x = np.copy(self.x)
-        result.k = np.copy(self.k)
-        result.Efield = np.copy(self.Efield)
-        result.valid = np.copy(self.valid)
+        result.x = np.copy(self.__x)
+        result.k = np.copy(self.__k)
+        result.Efield = np.copy(self.__Efield)
+        result.valid = np.copy(self.__valid)
+        result.__num = self.__num
 
         return result        
         
         
+    def __getstate__(self):
+        # do not ship the unused capacity when pickling
+        # (e.g. results of parallel traces)
+        state = self.__dict__.copy()
+        for key in ["_RayBundle__x", "_RayBundle__k", "_RayBundle__Efield", "_RayBundle__valid"]:
+            state[key] = state[key][:self.__num]
+        return state
+        
     def returnLocalComponents(self, lc, num):
         xloc = lc.returnGlobalToLocalPoints(self.x[num])
         kloc = lc.returnGlobalToLocalDirections(self.k[num])
@@ -117,7 +335,7 @@ class RayBundle(object):
         return (xloc, kloc, Eloc)
 
     def returnLocalD(self, lc, num):
-        dloc = lc.returnGlobalToLocalDirections(self.returnKtoD()[num])
+        dloc = lc.returnGlobalToLocalDirections(self.returnKtoDAt(num))
         return dloc
         
     def appendLocalComponents(self, lc, xloc, kloc, Eloc, valid):
@@ -129,20 +347,23 @@ class RayBundle(object):
         
         
     def returnKtoD(self):
-        # S_j = Re((conj(E)_i E_i delta_{jl} - conj(E)_j E_l) k_l)
+        """
+        Ray directions (normalized Poynting vectors) of the whole history.
 
-        # FIXME: improve this by using np.einsum?
-        
-        absE2 = np.sum(np.conj(self.Efield)*self.Efield, axis=1)
-        Ek = np.sum(self.Efield * self.k, axis=1)
-        S = np.zeros_like( self.k, dtype=float)
-        for j in np.arange(3):
-            S[:,j,:] = np.real(absE2*self.k[:,j,:] - Ek*np.conj(self.Efield)[:,j,:])
-        absS = np.sqrt(np.sum(S**2, axis=1))
-        d = np.zeros_like( self.k, dtype=float)        
-        for j in np.arange(3):
-            d[:,j,:] = S[:,j,:] / absS
-        return d
+        :return d (3d numpy array of float, shape like k)
+        """
+        return poynting_directions(self.k, self.Efield)
+
+    def returnKtoDAt(self, num=-1):
+        """
+        Ray directions (normalized Poynting vectors) of one history slot;
+        use this instead of returnKtoD()[num].
+
+        :param num (int) index in the history, default: last point
+
+        :return d (2d numpy 3xN array of float)
+        """
+        return poynting_directions(self.k[num], self.Efield[num])
         
         
     def getLocalSurfaceNormal(self, surface, material, xglob):
@@ -194,6 +415,90 @@ class RayBundle(object):
         
 
 
+def raybundle_chunks(x0, k0, Efield0, chunksize, wave=standard_wavelength):
+    """
+    Generator which splits initial ray data into RayBundles of at most
+    chunksize rays. The rayIDs are numbered consecutively across all chunks.
+    Used for streaming traces (see OpticalSystem.seqtrace_chunked).
+    
+    :param x0, k0, Efield0: (2d numpy 3xN arrays) initial ray data
+    :param chunksize: (int) maximal number of rays per RayBundle
+    :param wave: (float or 1d numpy array of N floats) wavelength(s) in mm
+    
+    :return generator of RayBundle objects
+    """
+    (num_dims, num_rays) = np.shape(x0)
+    chunksize = max(int(chunksize), 1)
+    for start in range(0, num_rays, chunksize):
+        end = min(start + chunksize, num_rays)
+        Echunk = None if Efield0 is None else Efield0[:, start:end]
+        wavechunk = wave[start:end] if np.ndim(wave) > 0 else wave
+        yield RayBundle(x0[:, start:end], k0[:, start:end], Echunk, 
+                        rayID=np.arange(start, end), wave=wavechunk)
+
+
+
+def poynting_directions(k, Efield):
+    """
+    Normalized Poynting vectors 
+    S_j = Re((conj(E)_i E_i delta_{jl} - conj(E)_j E_l) k_l)
+    
+    :param k (numpy array of complex, shape (..., 3, N))
+    :param Efield (numpy array of complex, shape (..., 3, N))
+    
+    :return d (numpy array of float, shape (..., 3, N))
+    """
+    absE2 = np.sum(np.real(np.conj(Efield)*Efield), axis=-2)[..., np.newaxis, :]
+    Ek = np.sum(Efield*k, axis=-2)[..., np.newaxis, :]
+    S = np.real(absE2*k - Ek*np.conj(Efield))
+    absS = np.sqrt(np.sum(S**2, axis=-2))[..., np.newaxis, :]
+    return S/absS
+
+
+def merge_raybundles(raybundles):
+    """
+    Merges RayBundles containing different rays into one RayBundle.
+    The ray histories of the merged bundles may differ in length
+    (e.g. different number of integration steps in GRIN media); 
+    shorter histories are padded by repeating their last point.
+    
+    Bundles of different wavelengths are merged into a polychromatic
+    RayBundle.
+    
+    :param raybundles: (list of RayBundle objects)
+    
+    :return RayBundle object containing all rays in the order given
+    """
+    if len(raybundles) == 1:
+        return raybundles[0]
+
+    num_points = max([np.shape(rb.x)[0] for rb in raybundles])
+
+    def padded(arr):
+        if np.shape(arr)[0] < num_points:
+            arr = np.concatenate((arr, np.repeat(arr[-1:], num_points - np.shape(arr)[0], axis=0)))
+        return arr
+
+    x = np.concatenate([padded(rb.x) for rb in raybundles], axis=-1)
+    k = np.concatenate([padded(rb.k) for rb in raybundles], axis=-1)
+    Efield = np.concatenate([padded(rb.Efield) for rb in raybundles], axis=-1)
+    valid = np.concatenate([padded(rb.valid) for rb in raybundles], axis=-1)
+    rayID = np.concatenate([rb.rayID for rb in raybundles])
+    wave = raybundles[0].wave
+    if any([rb.isPolychromatic() or rb.wave != wave for rb in raybundles]):
+        wave = np.concatenate([np.ones(len(rb.rayID))*rb.wave for rb in raybundles])
+    
+    result = RayBundle(x[0], k[0], Efield[0], rayID, wave,
+                       splitted=any([rb.splitted for rb in raybundles]),
+                       compaction_threshold=raybundles[0].compaction_threshold)
+    result.x = x
+    result.k = k
+    result.Efield = Efield
+    result.valid = valid
+
+    return result
+
+
 class RayPath(object):
     
     def __init__(self, initialraybundle=None):
@@ -202,7 +507,13 @@ class RayPath(object):
         else:
             self.raybundles = [initialraybundle]
         
-    def appendRayBundle(self, raybundle):
+    def appendRayBundle(self, raybundle, keeplast=True):
+        """
+        Appends raybundle to the path. If keeplast is False, 
+        the current last RayBundle is replaced instead.
+        """
+        if not keeplast and len(self.raybundles) > 0:
+            self.raybundles.pop()
         self.raybundles.append(raybundle)
         
     def appendRayPath(self, raypath):
@@ -214,6 +525,21 @@ class RayPath(object):
 
     def containsSplitted(self):
         return any([r.splitted for r in self.raybundles])
+
+
+def merge_raypaths(raypaths):
+    """
+    Merges RayPaths of the same structure (same element sequence, 
+    but different rays) bundle by bundle.
+    
+    :param raypaths: (list of RayPath objects)
+    
+    :return RayPath object
+    """
+    result = RayPath()
+    for raybundles in zip(*[rp.raybundles for rp in raypaths]):
+        result.appendRayBundle(merge_raybundles(list(raybundles)))
+    return result
         
 
 
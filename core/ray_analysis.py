@@ -27,18 +27,34 @@ from globalconstants import numerical_tolerance
 
 
 class RayBundleAnalysis(object):
-    def __init__(self, raybundle):
+    def __init__(self, raybundle, wave=None):
+        """
+        :param raybundle (RayBundle object)
+        :param wave (float) if given, only the rays of this wavelength
+                    enter the spot calculations (polychromatic RayBundles)
+        """
         
         self.raybundle = raybundle
+        self.wave = wave
+
+    def getSelectedRays(self):
+        """
+        :return mask of the valid rays at the end of the ray bundle
+                with the selected wavelength (1d numpy array of bool)
+        """
+        selected = self.raybundle.valid[-1]
+        if self.wave is not None:
+            selected = selected*self.raybundle.returnWaveMask(self.wave)
+        return selected
         
     def getCentroidPosition(self):
         """
-        Returns the arithmetic average position of all rays at the end of the ray bundle.
+        Returns the arithmetic average position of all valid rays at the end of the ray bundle.
 
         :return centr: centroid position (1d numpy array of 3 floats)
         """
         
-        o = self.raybundle.x[-1]
+        o = self.raybundle.x[-1][:, self.getSelectedRays()]
         (num_dims, num_points) = np.shape(o)
         centroid = 1.0/(num_points + numerical_tolerance) * np.sum(o, axis=1)        
         
@@ -46,7 +62,7 @@ class RayBundleAnalysis(object):
 
     def getRMSspotSize(self, referencePos):
         """
-        Returns the root mean square (RMS) deviation of all ray positions
+        Returns the root mean square (RMS) deviation of all valid ray positions
         with respect to a reference position at the end of the ray bundle.
 
         :referencePos: (1d numpy array of 3 floats)
@@ -54,7 +70,7 @@ class RayBundleAnalysis(object):
         :return rms: RMS spot size (float)
         """
         
-        o = self.raybundle.x[-1]
+        o = self.raybundle.x[-1][:, self.getSelectedRays()]
         (num_dims, num_points) = np.shape(o)        
         
         delta = o - referencePos.reshape((3, 1)) * np.ones((3, num_points))        
@@ -78,7 +94,7 @@ class RayBundleAnalysis(object):
         :return centr: centroid unit direction vector (1d numpy array of 3 floats)
         """
        
-        directions = self.raybundle.returnKtoD()[-1]        
+        directions = self.raybundle.returnKtoDAt(-1)        
         (num_dims, num_rays) = np.shape(directions)        
         com_d = np.sum(directions, axis=1)
         length = np.sqrt(np.sum(com_d**2))
@@ -102,7 +118,7 @@ class RayBundleAnalysis(object):
         # sin(angle)**2 approx angle**2 for small deviations from the reference,
         # but for large deviations the definition makes no sense, anyway
 
-        directions = self.raybundle.returnKtoD()[-1]        
+        directions = self.raybundle.returnKtoDAt(-1)        
         (num_dims, num_rays) = np.shape(directions)        
 
         cross_product = np.cross(directions, refDir, axisa=0).T
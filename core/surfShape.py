@@ -29,15 +29,52 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 # calculations
 
 import numpy as np
-from scipy.misc import factorial
 import math
 from optimize import ClassWithOptimizableVariables
 from optimize import OptimizableVariable
 from scipy.optimize import fsolve
-from scipy.interpolate import RectBivariateSpline, interp2d, bisplrep
+from scipy.interpolate import RectBivariateSpline
 from globalconstants import numerical_tolerance
 import ctypes
 
+def conic_intersection_parameter(r0, rayDir, curv, cc):
+    """
+    Closed form intersection of rays with a conic surface.
+
+    :param r0: (3xN numpy array of float) start points in local coordinates
+    :param rayDir: (3xN numpy array of float) directions in local coordinates
+    :param curv: (float) curvature
+    :param cc: (float) conic constant
+    
+    :return (t, valid): ray parameters of the intersection points 
+            (1d numpy array of float) and whether the rays hit the conic
+            (1d numpy array of bool)
+    """
+
+    # FIXME: G = 0 if start points lie on a conic with the same parameters than
+    # the next surface! (e.g.: water drop with internal reflection)
+
+    F = rayDir[2] - curv * (rayDir[0] * r0[0] + rayDir[1] * r0[1] + rayDir[2] * r0[2] * (1+cc))
+    G = curv * (r0[0]**2 + r0[1]**2 + r0[2]**2 * (1+cc)) - 2 * r0[2]
+    H = - curv - cc * curv * rayDir[2]**2
+
+    square = F**2 + H*G
+    division_part = F + np.sqrt(square)
+
+    
+    #H_nearly_zero = (np.abs(H) < numerical_tolerance)
+    #G_nearly_zero = (np.abs(G) < numerical_tolerance)
+    #F_nearly_zero = (np.abs(F) < numerical_tolerance)                
+    #t = np.where(H_nearly_zero, G/(2.*F), np.where(G_nearly_zero, -2.*F/H, G / division_part))
+
+    t = G/division_part 
+
+    # find indices of rays that don't intersect with the sphere
+    valid = square > 0 #*(True - F_nearly_zero)
+    
+    return (t, valid)
+
+
 class Shape(ClassWithOptimizableVariables):
     def __init__(self, lc, **kwargs):
         """
@@ -139,8 +176,7 @@ class Shape(ClassWithOptimizableVariables):
 
     def getLocalRayBundleForIntersect(self, raybundle):
         localo = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
-        globald = raybundle.returnKtoD()        
-        locald = self.lc.returnGlobalToLocalDirections(globald[-1])                
+        locald = raybundle.returnLocalD(self.lc, -1)
         return (localo, locald)        
 
 
@@ -273,29 +309,10 @@ class Conic(Shape):
         # rayDir = raybundle.rayDir in the local coordinate system
         # raybundle itself lives in the global coordinate system
 
-        # FIXME: G = 0 if start points lie on a conic with the same parameters than
-        # the next surface! (e.g.: water drop with internal reflection)
-
-        F = rayDir[2] - self.curvature.evaluate() * (rayDir[0] * r0[0] + rayDir[1] * r0[1] + rayDir[2] * r0[2] * (1+self.conic.evaluate()))
-        G = self.curvature.evaluate() * (r0[0]**2 + r0[1]**2 + r0[2]**2 * (1+self.conic.evaluate())) - 2 * r0[2]
-        H = - self.curvature.evaluate() - self.conic.evaluate() * self.curvature.evaluate() * rayDir[2]**2
-
-        square = F**2 + H*G
-        division_part = F + np.sqrt(square)
-
-        
-        #H_nearly_zero = (np.abs(H) < numerical_tolerance)
-        #G_nearly_zero = (np.abs(G) < numerical_tolerance)
-        F_nearly_zero = (np.abs(F) < numerical_tolerance)                
-        #t = np.where(H_nearly_zero, G/(2.*F), np.where(G_nearly_zero, -2.*F/H, G / division_part))
-
-        t = G/division_part 
+        (t, validIndices) = conic_intersection_parameter(r0, rayDir, self.curvature.evaluate(), self.conic.evaluate())
 
         intersection = r0 + rayDir * t
 
-        # find indices of rays that don't intersect with the sphere
-        validIndices = square > 0 #*(True - F_nearly_zero)
-
         globalinter = self.lc.returnLocalToGlobalPoints(intersection)
         
         raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], validIndices)
@@ -407,21 +424,69 @@ class ExplicitShape(FreeShape):
     def getSag(self, x, y):
         return self.F(x, y)
 
-    def intersect(self, raybundle):
-        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
+    def getBaseConic(self):
+        """
+        Curvature and conic constant of a conic approximating the surface.
+        Its closed form intersection is the starting point of the 
+        Newton iteration in intersect.
+        
+        :return (curv, cc) tuple of float
+        """
+        try:
+            return (self.getCentralCurvature(), 0.)
+        except NotImplementedError:
+            return (0., 0.)
 
-        t = np.zeros_like(r0[0])
+    def intersectNewton(self, r0, rayDir):
+        """
+        Solves r0[2] + t*rayDir[2] = F(r0[0] + t*rayDir[0], r0[1] + t*rayDir[1])
+        for every ray separately by Newton's method. The iteration starts
+        at the intersection with the base conic and uses the analytic
+        gradient. Only rays which are not yet converged are evaluated,
+        therefore the cost is linear in the number of rays.
 
-        def Fwrapper(t, r0, rayDir):
-            return r0[2] + t*rayDir[2] - self.F(r0[0] + t*rayDir[0], r0[1] + t*rayDir[1])
+        :param r0: (3xN numpy array of float) start points in local coordinates
+        :param rayDir: (3xN numpy array of float) directions in local coordinates
 
-        t = fsolve(Fwrapper, t, args=(r0, rayDir))
+        :return (t, valid): ray parameters (1d numpy array of float) and
+                converged rays (1d numpy array of bool)
+        """
+        (curv, cc) = self.getBaseConic()
+        (t, valid_start) = conic_intersection_parameter(r0, rayDir, curv, cc)
+        # rays missing the base conic start at the vertex plane
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_plane = -r0[2]/rayDir[2]
+        t = np.where(valid_start & np.isfinite(t), t, t_plane)
+        
+        converged = np.zeros_like(t, dtype=bool)
+        active = np.flatnonzero(np.isfinite(t))
+
+        for i in range(self.iterations):
+            if len(active) == 0:
+                break
+            ta = t[active]
+            xa = r0[:, active] + rayDir[:, active]*ta
+            f = xa[2] - self.F(xa[0], xa[1])
+            # derivative of f along the ray (gradF is the gradient of z - F)
+            df = np.sum(self.gradF(xa[0], xa[1], xa[2])*rayDir[:, active], axis=0)
+            df = np.where(np.isfinite(df) & (np.abs(df) > numerical_tolerance), df, rayDir[2, active])
+            
+            dt = f/df
+            t[active] = ta - dt
 
-        globalinter = self.lc.returnLocalToGlobalPoints(r0 + rayDir * t)
+            finite = np.isfinite(dt)
+            done = finite & (np.abs(dt) < self.eps)
+            converged[active[done]] = True
+            active = active[finite & (True ^ done)]
+        
+        return (t, converged)
 
+    def intersect(self, raybundle):
+        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
 
-        validIndices = np.ones_like(r0[0], dtype=bool)
+        (t, validIndices) = self.intersectNewton(r0, rayDir)
 
+        globalinter = self.lc.returnLocalToGlobalPoints(r0 + rayDir * t)
 
         raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], validIndices)
 
@@ -562,6 +627,9 @@ class Asphere(ExplicitShape):
     def getCentralCurvature(self):
         return self.params["curv"].evaluate()
 
+    def getBaseConic(self):
+        return (self.params["curv"](), self.params["cc"]())
+
 
 class Biconic(ExplicitShape):
     """
@@ -759,53 +827,120 @@ class GridSag(ExplicitShape):
     Class for gridsag
     """
     
+    # spline degrees corresponding to the kinds of scipy's interp2d
+    spline_degrees = {"linear": 1, "cubic": 3, "quintic": 5}
+
     def __init__(self, lc, (xlinspace, ylinspace, Zgrid), *args, **kwargs):
+        """
+        :param lc: local coordinate system (LocalCoordinates object)
+        :param xlinspace: (1d numpy array of float) x grid coordinates
+        :param ylinspace: (1d numpy array of float) y grid coordinates
+        :param Zgrid: (2d numpy array of float) sag values of shape 
+                      (len(ylinspace), len(xlinspace)) as for interp2d
+        :param kind: (string) "linear", "cubic" (default) or "quintic"
+        :param name: (string)
+        :param kwargs: further arguments of RectBivariateSpline (bbox, s);
+                       the interp2d argument copy is accepted and ignored,
+                       bounds_error and fill_value are not supported 
+                       (the spline extrapolates)
+        """
+        if len(args) > 0:
+            raise Exception("GridSag: positional interp2d arguments are not supported, use kind=...")
     
         kwargs_dict = kwargs
         kind = kwargs_dict.pop('kind', 'cubic')
         name = kwargs_dict.pop('name', '')
+        if kind not in self.spline_degrees:
+            raise Exception("GridSag: unknown kind " + repr(kind) + ", use one of " + str(sorted(self.spline_degrees)))
+        degree = self.spline_degrees[kind]
+        kwargs_dict.pop('copy', None)
+        if kwargs_dict.pop('bounds_error', False) or kwargs_dict.pop('fill_value', None) is not None:
+            raise Exception("GridSag: bounds_error and fill_value are not supported, the spline extrapolates")
     
-        self.interpolant = interp2d(xlinspace, ylinspace, Zgrid, kind=kind, *args, **kwargs_dict)
+        # all rays are evaluated in one call of the spline; the fit is
+        # kept by this surface only
+        self.interpolant = RectBivariateSpline(np.asarray(xlinspace, dtype=float), 
+                                               np.asarray(ylinspace, dtype=float), 
+                                               np.asarray(Zgrid, dtype=float).T,
+                                               kx=degree, ky=degree, **kwargs_dict)
     
         def gsf(x, y):
-            
-            res = np.zeros_like(x)
-            
-            for i in range(len(x)):            
-                res[i] = self.interpolant(x[i], y[i])[0]
-
-            # interpolants give a not perfect return value            
-                        
-            return res
+            return self.interpolant.ev(x, y)
 
         def gradgsf(x, y, z): # gradient for implicit function z - af(x, y) = 0
             res = np.zeros((3, len(x)))
             
-            for i in range(len(x)):
-                res[0, i] = -self.interpolant(x[i], y[i], dx=1)[0]
-                res[1, i] = -self.interpolant(x[i], y[i], dy=1)[0]
-            res[2, :] = 1.
+            res[0] = -self.interpolant.ev(x, y, dx=1)
+            res[1] = -self.interpolant.ev(x, y, dy=1)
+            res[2] = 1.
             
             return res
 
         def hessgsf(x, y, z):
             res = np.zeros((3, 3, len(x)))
             
-            for i in range(len(x)):
-                res[0, 0, i] = -self.interpolant(x, y, dx=2)[0]            
-                res[0, 1, i] = res[1, 0, i] = -self.interpolant(x, y, dx=1, dy=1)[0]            
-                res[1, 1, i] = -self.interpolant(x, y, dy=2)[0]            
-            
+            res[0, 0] = -self.interpolant.ev(x, y, dx=2)
+            res[0, 1] = res[1, 0] = -self.interpolant.ev(x, y, dx=1, dy=1)
+            res[1, 1] = -self.interpolant.ev(x, y, dy=2)
             
             return res
 
         super(GridSag, self).__init__(lc, gsf, gradgsf, hessgsf, eps=1e-6, iterations=10, name=name)
 
+def zernike_radial(nmlist, s, derivatives=0):
+    """
+    Radial Zernike polynomials R_n^m(r) = r^m Q_n^m(r^2) for all (n, m) 
+    in nmlist in one pass. The Q_n^m are obtained by the recurrence
+    R_n^m = r (R_{n-1}^{|m-1|} + R_{n-1}^{m+1}) - R_{n-2}^m, i.e.
+    
+    Q_n^m = Q_{n-1}^{m-1} + s Q_{n-1}^{m+1} - Q_{n-2}^m   (m > 0)
+    Q_n^0 = 2 s Q_{n-1}^1 - Q_{n-2}^0
+    
+    with Q_m^m = 1, which avoids factorials and is polynomial in s = r^2
+    (no singularity at r = 0 for the derivatives).
+
+    :param nmlist: (list of (n, m) tuples with m >= 0)
+    :param s: (1d numpy array of float) squared normalized radius
+    :param derivatives: (int) highest derivative w.r.t. s to calculate (0, 1, 2)
+
+    :return dict (n, m) -> list of Q and its derivatives w.r.t. s
+    """
+    nmax = max([n for (n, m) in nmlist] + [0])
+    zero = [np.zeros_like(s) for i in range(derivatives + 1)]
+    one = [np.ones_like(s)] + zero[1:]
+    Q = {}
+    
+    def get(n, m):
+        return Q.get((n, m), zero)
+    
+    for n in range(nmax + 1):
+        for m in range(n % 2, n + 1, 2):
+            if m == n:
+                Q[(n, m)] = one
+                continue
+            if m == 0:
+                (q1, q2, fac) = (get(n - 1, 1), get(n - 2, 0), 2.)
+                qa = [np.zeros_like(s)]*(derivatives + 1)
+            else:
+                (q1, q2, fac) = (get(n - 1, m + 1), get(n - 2, m), 1.)
+                qa = get(n - 1, m - 1)
+            res = [qa[0] + fac*s*q1[0] - q2[0]]
+            if derivatives > 0:
+                res.append(qa[1] + fac*(q1[0] + s*q1[1]) - q2[1])
+            if derivatives > 1:
+                res.append(qa[2] + fac*(2.*q1[1] + s*q1[2]) - q2[2])
+            Q[(n, m)] = res
+    return Q
+
+
 class ZernikeFringe(ExplicitShape):
     """
     Class for Zernike Fringe
     """
     
+    # (n, m) indices of the first numterms Fringe polynomials
+    nm_table_cache = {}
+    
     def __init__(self, lc, normradius=1., coefficients=None, **kwargs):
         if coefficients is None:
             coefficients = []
@@ -815,17 +950,26 @@ class ZernikeFringe(ExplicitShape):
             
         def zf(x, y):
             (normradius, zcoefficients) = self.getZernikeFringeParameters()            
-            res = np.zeros_like(x)            
-            for (num, val) in enumerate(zcoefficients):
-                res += val*self.zernike_norm(num + 1, x/normradius, y/normradius)
-            
+            (res,) = self.zernike_sum(zcoefficients, x/normradius, y/normradius, derivatives=0)
             return res
         
-        def gradzf(x, y, z):
-            return np.zeros_like(x)
+        def gradzf(x, y, z): # gradient for implicit function z - zf(x, y) = 0
+            (normradius, zcoefficients) = self.getZernikeFringeParameters()            
+            (_, zx, zy) = self.zernike_sum(zcoefficients, x/normradius, y/normradius, derivatives=1)
+            res = np.zeros((3, len(x)))
+            res[0] = -zx/normradius
+            res[1] = -zy/normradius
+            res[2] = 1.
+            return res
             
         def hesszf(x, y, z):
-            return np.zeros_like(x)
+            (normradius, zcoefficients) = self.getZernikeFringeParameters()            
+            (_, _, _, zxx, zxy, zyy) = self.zernike_sum(zcoefficients, x/normradius, y/normradius, derivatives=2)
+            res = np.zeros((3, 3, len(x)))
+            res[0, 0] = -zxx/normradius**2
+            res[0, 1] = res[1, 0] = -zxy/normradius**2
+            res[1, 1] = -zyy/normradius**2
+            return res
 
         super(ZernikeFringe, self).__init__(lc, zf, gradzf, hesszf, \
             paramlist=([("normradius", normradius)]+initcoeffs), **kwargs)
@@ -847,31 +991,73 @@ class ZernikeFringe(ExplicitShape):
     def nmtoj(self, (n, m)):
         return int(((n + abs(m))/2 + 1)**2 - 2*abs(m) + (1 - np.sign(m))/2)
 
-    def zernike_norm(self, j, xp, yp):        
-        (n, m) = self.jtonm(j)        
+    def getNMTable(self, numterms):
+        """
+        Returns the (cached) list of (n, m) for the Fringe indices 1 .. numterms.
+        """
+        if numterms not in self.nm_table_cache:
+            self.nm_table_cache[numterms] = [self.jtonm(j) for j in range(1, numterms + 1)]
+        return self.nm_table_cache[numterms]
 
-        R = np.zeros(n+1)                        
-        omega = abs(m)
+    def zernike_sum(self, coefficients, xp, yp, derivatives=0):
+        """
+        Evaluates sum_j coefficients[j-1]*Z_j(xp, yp) and its derivatives
+        for all points at once. The radial parts are obtained by a
+        recurrence in (n, m) (see zernike_radial), the angular parts
+        r^m cos(m phi) and r^m sin(m phi) as real and imaginary parts of
+        (xp + i yp)^m by repeated multiplication.
         
-        a = np.arange(omega, n+1, 2)
-        k = (n-a)/2        
-    
-        R[a] = (-1)**k * factorial(n-k) / ( factorial(k) * factorial((n+m)/2 - k) * factorial((n-m)/2-k) );
+        :param coefficients: (list of float) Fringe coefficients Z1, Z2, ...
+        :param xp, yp: (1d numpy arrays of float) normalized coordinates
+        :param derivatives: (int) 0: value, 1: also gradient, 2: also Hessian
         
-        r = np.sqrt(xp**2 + yp**2)
-        phi = np.arctan2(yp, xp)
+        :return tuple (f,) or (f, fx, fy) or (f, fx, fy, fxx, fxy, fyy) 
+        """
+        nmlist = self.getNMTable(len(coefficients))
+        w = xp + complex(0, 1)*yp
+        s = xp**2 + yp**2
+        mmax = max([abs(m) for (n, m) in nmlist] + [0])
+
+        # powers w^m for m = 0 .. mmax
+        P = [np.ones_like(w)]
+        for m in range(mmax):
+            P.append(P[-1]*w)
+            
+        Q = zernike_radial([(n, abs(m)) for (n, m) in nmlist], s, derivatives=derivatives)
         
-        rho = np.zeros_like(r)
+        result = [np.zeros_like(xp) for i in range([1, 3, 6][derivatives])]
+        for ((n, m), coefficient) in zip(nmlist, coefficients):
+            if coefficient == 0:
+                continue
+            omega = abs(m)
+            # angular part: real part for cos, imaginary part for sin
+            part = np.real if m >= 0 else np.imag
+            q = Q[(n, omega)]
+            A = part(P[omega])
+            result[0] += coefficient*q[0]*A
+            if derivatives > 0:
+                Pm1 = omega*P[omega - 1] if omega > 0 else np.zeros_like(w)
+                Ax = part(Pm1)
+                Ay = part(complex(0, 1)*Pm1)
+                result[1] += coefficient*(2.*xp*q[1]*A + q[0]*Ax)
+                result[2] += coefficient*(2.*yp*q[1]*A + q[0]*Ay)
+            if derivatives > 1:
+                Pm2 = omega*(omega - 1)*P[omega - 2] if omega > 1 else np.zeros_like(w)
+                Axx = part(Pm2)
+                Axy = part(complex(0, 1)*Pm2)
+                Ayy = -Axx
+                result[3] += coefficient*(4.*xp**2*q[2]*A + 2.*q[1]*A + 4.*xp*q[1]*Ax + q[0]*Axx)
+                result[4] += coefficient*(4.*xp*yp*q[2]*A + 2.*xp*q[1]*Ay + 2.*yp*q[1]*Ax + q[0]*Axy)
+                result[5] += coefficient*(4.*yp**2*q[2]*A + 2.*q[1]*A + 4.*yp*q[1]*Ay + q[0]*Ayy)
+        return tuple(result)
 
-        for i in range(n+1):
-            rho += R[i]*r**i
-                
-        result = np.zeros_like(rho)
-        if m < 0:
-            result = rho*np.sin(omega*phi)
-        else:
-            result = rho*np.cos(omega*phi)
-        
+    def zernike_norm(self, j, xp, yp):        
+        """
+        Single Fringe Zernike polynomial Z_j at normalized coordinates.
+        """
+        coefficients = np.zeros(j)
+        coefficients[j - 1] = 1.
+        (result,) = self.zernike_sum(coefficients, xp, yp)
         return result
 
 
@@ -940,11 +1126,14 @@ class FIXED_DATA(ctypes.Structure):
             ("k", ctypes.c_double),
             ("param", 9*ctypes.c_double),
             ("fdreserved1", ctypes.c_double),
+            ("fdreserved2", ctypes.c_double),
+            ("fdreserved3", ctypes.c_double),
+            ("fdreserved4", ctypes.c_double),
             ("xdata", 201*ctypes.c_double),
             ("glass", 21*ctypes.c_byte) 
         ]
 
-
+user_data_dtype = np.dtype(USER_DATA)
 
    
 class ZMXDLLShape(Conic):
@@ -970,7 +1159,11 @@ class ZMXDLLShape(Conic):
             gcc -c -fpic -o us_stand.o us_stand.c -lm
             gcc -shared -o us_stand.so us_stand.o
 
+        To evaluate whole ray bundles with one call into the library, link
+        core/zmx_usersurface_array.c into the shared object as well:
 
+            gcc -c -fpic -o zmx_usersurface_array.o zmx_usersurface_array.c
+            gcc -shared -o us_stand.so us_stand.o zmx_usersurface_array.o -lm
         """
         super(ZMXDLLShape, self).__init__(lc, curv=curv, cc=cc, **kwargs)
         
@@ -986,6 +1179,7 @@ class ZMXDLLShape(Conic):
         for (key, (value_int, value_float)) in xdata_dict.iteritems():
             self.xdata[value_int] = OptimizableVariable(name="xdata"+str(value_int), value=value_float)
         self.us_surf = self.dll.UserDefinedSurface
+        self.us_surf_array = getattr(self.dll, "UserDefinedSurfaceArray", None)
 
     def writeParam(self, f):
         for (key, var) in self.param.iteritems():
@@ -997,73 +1191,90 @@ class ZMXDLLShape(Conic):
             f.xdata[key] = var()
         return f
 
-    def intersect(self, raybundle):
-        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
+    def newFixedData(self, datatype):
+        """
+        Fixed data struct for one request, filled from the shape variables.
 
-        intersection = np.zeros_like(r0)
-        
-        u = USER_DATA()
+        :param datatype (int): Zemax data type (3 sag, 5 intersection, ...)
+
+        :return f (FIXED_DATA)
+        """
         f = FIXED_DATA()
 
-        f.type = 5 # ask for intersection
-        f.k = self.cc()
+        f.type = datatype
+        f.k = self.conic()
         f.cv = self.curvature()
-        f.wavelength = raybundle.wave
 
-        
         f = self.writeParam(f)
         f = self.writeXdata(f)
-        
-        
-        x = r0[0, :]
-        y = r0[1, :]
-        z = r0[2, :]
 
-        l = rayDir[0, :]
-        m = rayDir[1, :]
-        n = rayDir[2, :]
+        return f
 
-        for (ind, (xl, yl, zl, ll, ml, nl)) in zip(x.tolist(), y.tolist(), z.tolist(), l.tolist(), m.tolist(), n.tolist()):
-            
-            u.x = xl
-            u.y = yl
-            u.z = zl
-            u.l = ll
-            u.m = ml
-            u.n = nl            
-            
-            self.us_surf(ctypes.byref(u), ctypes.byref(f))            
-            
-            intersection[0, ind] = u.x
-            intersection[1, ind] = u.y
-            intersection[2, ind] = u.z        
+    def callUserSurface(self, u, f):
+        """
+        Call the user surface for every entry of an array of USER_DATA structs.
 
+        If the library exports UserDefinedSurfaceArray (see
+        zmx_usersurface_array.c) the whole buffer is handed over in one call.
+        Otherwise UserDefinedSurface is called per entry directly on the
+        buffer without marshalling single struct fields.
 
-        globalinter = self.lc.returnLocalToGlobalPoints(intersection)
-        
-        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], raybundle.valid[-1])
+        :param u (1d numpy array of dtype user_data_dtype), modified in place
+        :param f (FIXED_DATA)
 
-    def getSag(self, x, y):
-        u = USER_DATA()
-        f = FIXED_DATA()
+        :return retvals (1d numpy array of int) return values of the user surface
+        """
+        num = len(u)
+        retvals = np.zeros(num, dtype=np.intc)
 
-        f.type = 3 # ask for sag
-        f.k = self.cc()
-        f.cv = self.curvature()
+        if self.us_surf_array is not None:
+            self.us_surf_array(u.ctypes.data_as(ctypes.POINTER(USER_DATA)),
+                               ctypes.byref(f), ctypes.c_int(num),
+                               retvals.ctypes.data_as(ctypes.POINTER(ctypes.c_int)))
+        else:
+            address = u.ctypes.data
+            for ind in range(num):
+                retvals[ind] = self.us_surf(ctypes.c_void_p(address + ind*u.itemsize),
+                                            ctypes.byref(f))
+        return retvals
 
+    def intersect(self, raybundle):
+        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
 
-        #f = self.writeParam(f)
-        #f = self.writeXdata(f)
+        f = self.newFixedData(5) # ask for intersection
 
-        z = np.zeros_like(x)
+        u = np.zeros(np.shape(r0)[1], dtype=user_data_dtype)
+        (u["x"], u["y"], u["z"]) = r0
+        (u["l"], u["m"], u["n"]) = rayDir
 
-        for (ind, (xp, yp)) in enumerate(zip(x.tolist(), y.tolist())):        
-            u.x = xp
-            u.y = yp
-            retval = self.us_surf(ctypes.byref(u), ctypes.byref(f))
-            z[ind] = u.sag1 if retval == 0 else u.sag2
-            
-        return z
+        if raybundle.isPolychromatic():
+            # FIXED_DATA holds one wavelength: one call per wavelength
+            retvals = np.zeros(len(u), dtype=np.intc)
+            for (wave, indices) in raybundle.returnWaveGroups():
+                f.wavelength = wave
+                usub = u[indices]
+                retvals[indices] = self.callUserSurface(usub, f)
+                u[indices] = usub
+        else:
+            f.wavelength = raybundle.wave
+            retvals = self.callUserSurface(u, f)
+
+        intersection = np.vstack((u["x"], u["y"], u["z"]))
+        globalinter = self.lc.returnLocalToGlobalPoints(intersection)
+
+        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], 
+                         raybundle.valid[-1]*(retvals == 0))
+
+    def getSag(self, x, y):
+        f = self.newFixedData(3) # ask for sag
+
+        u = np.zeros(len(x), dtype=user_data_dtype)
+        u["x"] = x
+        u["y"] = y
+
+        retvals = self.callUserSurface(u, f)
+
+        return np.where(retvals == 0, u["sag1"], u["sag2"])
             
 if __name__=="__main__":
     
@@ -0,0 +1,79 @@
+/*
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2014-2018
+               by     Moritz Esslinger moritz.esslinger@web.de
+               and    Johannes Hartung j.hartung@gmx.net
+               and    Uwe Lippmann  uwe.lippmann@web.de
+               and    Thomas Heinze t.heinze@uni-jena.de
+               and    others
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+*/
+
+/*
+Batched entry point for Zemax compatible user defined surfaces.
+
+ZMXDLLShape looks for the symbol UserDefinedSurfaceArray in the loaded
+library. If it is present, a whole ray bundle (an array of USER_DATA
+structs, one per ray) is evaluated with a single call from Python instead
+of one foreign function call per ray. Compile this file together with the
+user surface source:
+
+    gcc -c -fpic -o us_stand.o us_stand.c -lm
+    gcc -c -fpic -o zmx_usersurface_array.o zmx_usersurface_array.c
+    gcc -shared -o us_stand.so us_stand.o zmx_usersurface_array.o -lm
+
+The struct definitions below have to match the ones in usersurf.h and
+core/surfShape.py; only pointers to them are passed around here.
+*/
+
+typedef struct
+{
+    double x, y, z;
+    double l, m, n;
+    double ln, mn, nn;
+    double path;
+    double sag1, sag2;
+    double index, dndx, dndy, dndz;
+    double rel_surf_tran;
+    double udreserved1, udreserved2, udreserved3, udreserved4;
+    char string[20];
+} USER_DATA;
+
+typedef struct
+{
+    int type, numb;
+    int surf, wave;
+    double wavelength, pwavelength;
+    double n1, n2;
+    double cv, thic, sdia, k;
+    double param[9];
+    double fdreserved1, fdreserved2, fdreserved3, fdreserved4;
+    double xdata[201];
+    char glass[21];
+} FIXED_DATA;
+
+int UserDefinedSurface(USER_DATA *UD, FIXED_DATA *FD);
+
+int UserDefinedSurfaceArray(USER_DATA *UD, FIXED_DATA *FD, int num, int *retvals)
+{
+    int i;
+    for (i = 0; i < num; i++)
+    {
+        retvals[i] = UserDefinedSurface(&UD[i], FD);
+    }
+    return 0;
+}
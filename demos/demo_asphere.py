@@ -107,7 +107,7 @@ initialbundle = RayBundle(x0=o, k0=k, Efield0=E0, wave=wavelength)
 
 def meritfunctionrms(s):
     initialbundle_local = RayBundle(x0=o, k0=k, Efield0=E0, wave=wavelength)
-    rpaths = s.seqtrace(initialbundle_local, sysseq)
+    rpaths = s.seqtrace(initialbundle_local, sysseq, record="last")
     # other constructions lead to fill up of initial bundle with intersection values
     
     # for glassy asphere only one path necessary
@@ -132,7 +132,7 @@ def meritfunction_step2(s):
     Merit function (=function to be minimized) for step 2.
     """
     initialbundle = bundle_step1()
-    rpaths = s.seqtrace(initialbundle, seq)   
+    rpaths = s.seqtrace(initialbundle, seq, record="last")   
     x = rpaths[0].raybundles[-1].x[-1, 0, :]
     #y = rpaths[0].raybundles[-1].x[-1, 1, :]
     rba.raybundle = rpaths[0].raybundles[-1]
@@ -201,7 +201,7 @@ def final_meritfunction(s, rpup, fno, maxfield_deg):
 
     initialbundles = bundles_step3(rpup=rpup, maxfield_deg=maxfield_deg)
     for (ind, b) in enumerate(initialbundles):
-        rpaths = s.seqtrace(b, seq)   
+        rpaths = s.seqtrace(b, seq, record="last")   
         x = rpaths[0].raybundles[-1].x[-1, 0, :]
         #y = rpaths[0].raybundles[-1].x[-1, 1, :]
 
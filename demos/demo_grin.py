@@ -41,6 +41,7 @@ from core.localcoordinates import LocalCoordinates
 
 from core.globalconstants import canonical_ey
 
+import time
 import math
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -112,6 +113,26 @@ sysseq = [("grinelement", [("object", {"is_stop":True}), ("surf1", {}), ("surf2"
 initialbundle = RayBundle(x0=o, k0=k, Efield0=E0, wave=wavelength)
 r2 = s.seqtrace(initialbundle, sysseq, splitup=False)
 
+# optional benchmark: adaptive step size and storing only every 10th 
+# integration step for many rays
+
+run_benchmark = False
+
+if run_benchmark:
+    nrays_benchmark = 10000
+    (px_bm, py_bm) = raster.RectGrid().getGrid(nrays_benchmark)
+    o_bm = np.vstack((rpup*px_bm, rpup*py_bm, -5.*np.ones_like(px_bm)))
+    k_bm = np.zeros_like(o_bm)
+    k_bm[2,:] = 1.
+
+    grinmaterial.adaptive = True
+    grinmaterial.decimation = 10
+    t0 = time.time()
+    s.seqtrace(RayBundle(x0=o_bm, k0=k_bm, Efield0=None, wave=wavelength), sysseq, splitup=False)
+    logging.info("benchmark : " + str(time.time() - t0) + "s for tracing " + str(np.shape(o_bm)[1]) + " rays through the GRIN medium.")
+    grinmaterial.adaptive = False
+    grinmaterial.decimation = 1
+
 fig = plt.figure(1)
 ax = fig.add_subplot(111)
 
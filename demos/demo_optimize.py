@@ -248,7 +248,7 @@ def osupdate(s):
 
 def meritfunctionrms(s):
     initialbundle = generatebundle(openangle=10.*math.pi/180, numrays=121)
-    rpaths = s.seqtrace(initialbundle, sysseq)
+    rpaths = s.seqtrace(initialbundle, sysseq, record="last")
     
     x = rpaths[0].raybundles[-1].x[-1, 0, :]
     y = rpaths[0].raybundles[-1].x[-1, 1, :]
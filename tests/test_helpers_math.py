@@ -0,0 +1,45 @@
+"""
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2017 Moritz Esslinger <moritz.esslinger@web.de>
+               and Johannes Hartung <j.hartung@gmx.net>
+               and     Uwe Lippmann <uwe.lippmann@web.de>
+               and    Thomas Heinze <t.heinze@fn.de>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+MA  02110-1301, USA.
+"""
+
+from hypothesis import given
+from hypothesis.strategies import floats
+from hypothesis.extra.numpy import arrays
+import numpy as np
+from core.helpers_math import polyroots
+
+
+@given(rnd_data1=arrays(np.float, (5, 7), elements=floats(0.1, 1)),
+       rnd_data2=arrays(np.float, (5, 7), elements=floats(-1, 1)))
+def test_polyroots(rnd_data1, rnd_data2):
+    """
+    Batched roots of random complex quartics coincide with np.roots.
+    """
+    coeffs = rnd_data1 + complex(0, 1)*rnd_data2
+    roots = polyroots(coeffs)
+    assert np.shape(roots) == (4, 7)
+    for j in range(7):
+        distances = np.abs(roots[:, j, np.newaxis] 
+                           - np.roots(coeffs[:, j])[np.newaxis, :])
+        assert np.allclose(np.min(distances, axis=0), 0)
+        assert np.allclose(np.min(distances, axis=1), 0)
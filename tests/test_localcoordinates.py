@@ -23,7 +23,10 @@ MA 02110-1301, USA.
 """
 
 import math
-from hypothesis import given
+import gc
+import copy
+import weakref
+from hypothesis import given, settings
 from hypothesis.strategies import floats, integers
 from hypothesis.extra.numpy import arrays
 import numpy as np
@@ -208,3 +211,97 @@ def inverse_coordinate(dec_x, dec_y, dec_z, tilt_x, tilt_y, tilt_z):
                                                 tiltz=-tilt_z,
                                                 tiltThenDecenter=1))
     assert np.allclose(system4.globalcoordinates, 0)
+
+@settings(deadline=None)
+@given(parameters=arrays(np.float, (2, 6), elements=floats(0, 1)),
+       points=arrays(np.float, (3, 10), elements=floats(-10, 10)))
+def test_cached_transformations(parameters, points):
+    """
+    Cached transformations between coordinate systems equal the round trip
+    via global coordinates; only changed subtrees are recalculated.
+    """
+    (decs, tilts) = (20.*(2.*parameters[:, :3]-1.),
+                     math.pi*(2.*parameters[:, 3:]-1.))
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1", decz=10.))
+    system2 = system1.addChild(LocalCoordinates(
+        name="2", decx=decs[0, 0], decy=decs[0, 1], decz=decs[0, 2],
+        tiltx=tilts[0, 0], tilty=tilts[0, 1], tiltz=tilts[0, 2]))
+    system3 = root.addChild(LocalCoordinates(
+        name="3", decx=decs[1, 0], decy=decs[1, 1], decz=decs[1, 2],
+        tiltx=tilts[1, 0], tilty=tilts[1, 1], tiltz=tilts[1, 2],
+        tiltThenDecenter=1))
+
+    def check():
+        assert np.allclose(
+            system2.returnActualToOtherPoints(points, system3),
+            system3.returnGlobalToLocalPoints(
+                system2.returnLocalToGlobalPoints(points)))
+        assert np.allclose(
+            system2.returnOtherToActualPoints(points, system3),
+            system2.returnGlobalToLocalPoints(
+                system3.returnLocalToGlobalPoints(points)))
+        assert np.allclose(
+            system2.returnOtherToActualDirections(points, system3),
+            system2.returnGlobalToLocalDirections(
+                system3.returnLocalToGlobalDirections(points)))
+
+    check()
+    versions = [lc.version for lc in (root, system1, system2, system3)]
+    root.update()
+    assert [lc.version for lc in (root, system1, system2, system3)] == versions
+    system1.decy.setvalue(5.)
+    system1.tiltx.setvalue(0.3)
+    root.update()
+    assert ([lc.version for lc in (root, system1, system2, system3)] ==
+            [versions[0], versions[1] + 1, versions[2] + 1, versions[3]])
+    check()
+
+def test_transformation_cache_references():
+    """
+    Cached transformations neither keep temporary coordinate systems
+    alive nor are they copied.
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1", decz=10.))
+    temporary = LocalCoordinates(name="temporary", decx=1.)
+    points = np.random.random((3, 5))
+    assert np.allclose(system1.returnActualToOtherPoints(points, temporary),
+                       points + np.array([[-1.], [0.], [10.]]))
+    reference = weakref.ref(temporary)
+    del temporary
+    gc.collect()
+    assert reference() is None
+
+    copied = copy.copy(system1)
+    assert "_LocalCoordinates__transforms" not in system1.__getstate__()
+    assert np.allclose(copied.returnActualToOtherPoints(points, root),
+                       points + np.array([[0.], [0.], [10.]]))
+
+@given(tilts=arrays(np.float, (2, 3), elements=floats(-math.pi, math.pi)),
+       tensors=arrays(np.float, (3, 3, 10), elements=floats(-1, 1)))
+def test_tensor_transformations(tilts, tensors):
+    """
+    Tensor transformations agree with the explicit R T R^T for stacked
+    tensors and for a single constant tensor.
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(
+        name="1", tiltx=tilts[0, 0], tilty=tilts[0, 1], tiltz=tilts[0, 2]))
+    system2 = root.addChild(LocalCoordinates(
+        name="2", decz=5., tiltx=tilts[1, 0], tilty=tilts[1, 1],
+        tiltz=tilts[1, 2]))
+    basis = system1.localbasis
+    globaltensors = system1.returnLocalToGlobalTensors(tensors)
+    for i in range(tensors.shape[2]):
+        assert np.allclose(globaltensors[:, :, i],
+                           np.dot(basis, np.dot(tensors[:, :, i], basis.T)))
+    assert np.allclose(system1.returnGlobalToLocalTensors(globaltensors),
+                       tensors)
+    assert np.allclose(system1.returnLocalToGlobalTensors(tensors[:, :, 0]),
+                       globaltensors[:, :, 0])
+    othertensors = system1.returnActualToOtherTensors(tensors, system2)
+    assert np.allclose(othertensors,
+                       system2.returnGlobalToLocalTensors(globaltensors))
+    assert np.allclose(system1.returnOtherToActualTensors(othertensors,
+                                                          system2), tensors)
@@ -22,6 +22,7 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 MA  02110-1301, USA.
 """
 
+import os
 from hypothesis import given
 from hypothesis.strategies import floats
 from hypothesis.extra.numpy import arrays
@@ -29,6 +30,12 @@ import numpy as np
 import sympy
 from core.localcoordinates import LocalCoordinates
 from core.material_anisotropic import AnisotropicMaterial
+from core.material_grin import IsotropicGrinMaterial
+from core.material_glasscat import (CatalogMaterial,
+                                    refractiveindex_dot_info_glasscatalog)
+from core.optimize import OptimizableVariable
+from core.surface import Surface
+from core.ray import RayBundle
 
 @given(rnd_data1=arrays(np.float, (3, 3), elements=floats(0, 1)),
        rnd_data2=arrays(np.float, (3, 3), elements=floats(0, 1)),
@@ -298,3 +305,274 @@ def test_anisotropic_xi_eigenvectors(rnd_data1, rnd_data2, rnd_data3,
                  + Cmatrix[:, :, j]*eigenvalues[k, j]
                  + Kmatrix[:, :, j]), eigenvectors[k, :, j])
     assert np.allclose(should_be_zero, 0)
+
+@given(rnd_data1=arrays(np.float, (3, 3), elements=floats(0.1, 1)),
+       rnd_data2=arrays(np.float, (3, 3), elements=floats(0.1, 1)),
+       rnd_data3=arrays(np.float, (3, 5), elements=floats(-1, 1)))
+def test_anisotropic_propagator_determinants(rnd_data1, rnd_data2, rnd_data3):
+    """
+    Batched propagator determinant coincides with np.linalg.det and its
+    first and second derivatives with central finite differences.
+    """
+    lc = LocalCoordinates("1")
+    myeps = rnd_data1 + complex(0, 1)*rnd_data2
+    m = AnisotropicMaterial(lc, myeps)
+    k = rnd_data3
+    dets = m.calcDetPropagatorNorm(k)
+    for j in range(5):
+        propagator = -np.dot(k[:, j], k[:, j])*np.eye(3) \
+            + np.outer(k[:, j], k[:, j]) + myeps
+        assert np.isclose(dets[j], np.linalg.det(propagator))
+    h = 1e-6
+    grad = m.calcDetDerivativePropagatorNorm(k)
+    hess = m.calcDet2ndDerivativePropagatorNorm(k)
+    for i in range(3):
+        dk = np.zeros_like(k)
+        dk[i] = h
+        grad_fd = (m.calcDetPropagatorNorm(k + dk)
+                   - m.calcDetPropagatorNorm(k - dk))/(2.*h)
+        hess_fd = (m.calcDetDerivativePropagatorNorm(k + dk)
+                   - m.calcDetDerivativePropagatorNorm(k - dk))/(2.*h)
+        assert np.allclose(grad[i], grad_fd, atol=1e-5)
+        assert np.allclose(hess[i], hess_fd, atol=1e-5)
+
+@given(rnd_data1=arrays(np.float, (3, 3), elements=floats(0.1, 1)),
+       rnd_data2=arrays(np.float, (3, 3), elements=floats(0.1, 1)),
+       rnd_data3=arrays(np.float, (3, 3), elements=floats(-1, 1)))
+def test_homogeneous_epsilon_tensor(rnd_data1, rnd_data2, rnd_data3):
+    """
+    A homogeneous material returns a single epsilon tensor; all results
+    coincide with those for N explicit copies of it (N=3 on purpose to
+    catch wrongly aligned broadcasting).
+    """
+    class RepeatedEpsilonMaterial(AnisotropicMaterial):
+        def isHomogeneous(self):
+            return False
+
+        def getEpsilonTensor(self, x, wave=None):
+            return np.repeat(self.epstensor[:, :, np.newaxis],
+                             np.shape(x)[1], axis=2)
+
+    lc = LocalCoordinates("1")
+    myeps = rnd_data1 + complex(0, 1)*rnd_data2
+    m = AnisotropicMaterial(lc, myeps)
+    mrep = RepeatedEpsilonMaterial(lc, myeps)
+    x = np.zeros((3, 3))
+    n = np.zeros((3, 3))
+    n[2, :] = 1.
+    k = rnd_data3
+    kpa = k - np.sum(n * k, axis=0)*n
+    assert m.isHomogeneous()
+    assert np.shape(m.getEpsilonTensor(x)) == (3, 3)
+    assert np.shape(m.getEpsilonTensorArray(x)) == (3, 3, 3)
+    for (res, resrep) in zip(m.calcXiPolynomialNorm(x, n, kpa),
+                             mrep.calcXiPolynomialNorm(x, n, kpa)):
+        assert np.allclose(res*np.ones(3), resrep)
+    for (res, resrep) in zip(m.calcXiQEVMatricesNorm(x, n, kpa)[1],
+                             mrep.calcXiQEVMatricesNorm(x, n, kpa)[1]):
+        assert np.allclose(res, resrep)
+    for method in (AnisotropicMaterial.calcDetPropagatorNorm,
+                   AnisotropicMaterial.calcDetDerivativePropagatorNorm,
+                   AnisotropicMaterial.calcDet2ndDerivativePropagatorNorm):
+        assert np.allclose(method(m, k), method(mrep, k))
+
+@given(rnd_data=arrays(np.float, (10,), elements=floats(-1, 1)))
+def test_grin_integrator(rnd_data):
+    """
+    Rays in a parabolic GRIN medium n^2 = n0^2 - g^2 x^2 starting parallel to
+    the z axis follow x(z) = x0 cos(g z/n(x0)), for adaptive and fixed steps.
+    """
+    (n0, g, length) = (1.5, 0.2, 5.)
+    x_start = 2.*rnd_data
+
+    def nfunc(x):
+        return np.sqrt(n0**2 - g**2*x[0]**2)
+
+    def gradfun(x):
+        grad = np.zeros_like(x)
+        grad[0] = -g**2*x[0]/nfunc(x)
+        return grad
+
+    for (adaptive, decimation) in ((True, 1), (False, 5)):
+        coordinate_system = LocalCoordinates(name="grin")
+        grin_material = IsotropicGrinMaterial(coordinate_system, nfunc,
+                                              None, None, None,
+                                              lambda x: np.abs(x[0]) < 3.,
+                                              ds=0.02, energyviolation=1e-3,
+                                              gradfun=gradfun,
+                                              adaptive=adaptive,
+                                              decimation=decimation)
+        next_surface = Surface(LocalCoordinates(name="end", decz=length))
+        x0 = np.zeros((3, 10))
+        x0[0] = x_start
+        k0 = np.zeros((3, 10))
+        k0[2] = 1.
+        raybundle = RayBundle(x0, k0, None)
+        grin_material.symplecticintegrator(raybundle, next_surface, 0.02)
+        xfinal = raybundle.x[-1]
+        assert np.all(raybundle.valid[-1])
+        assert np.all(xfinal[2] <= length)
+        assert np.allclose(xfinal[0],
+                           x_start*np.cos(g*xfinal[2]/nfunc(x0)), atol=1e-6)
+        if adaptive:
+            assert np.allclose(xfinal[2], length, atol=1e-4)
+        else:
+            # every step advances the rays by 2 n ds along z
+            assert np.all(xfinal[2] > length - 2.*n0*0.02)
+            maxsteps = length/(2.*np.min(nfunc(x0))*0.02) + 1.
+            assert len(raybundle.x) <= 2 + maxsteps/5.
+
+@given(rnd_data=arrays(np.float, (10,), elements=floats(0, 1)))
+def test_catalog_material_index(rnd_data):
+    """
+    Vectorized and memoized index of a catalog material (Sellmeier n,
+    tabulated k) equals the explicit formula.
+    """
+    (b1, c1, b2, c2, b3, c3) = (1.03961212, 0.00600069867, 0.231792344,
+                                0.0200179144, 1.01046945, 103.560653)
+    ymldict = {"DATA": [{"type": "formula 2",
+                         "coefficients": " ".join(str(c) for c in
+                                                  (0, b1, c1, b2, c2, b3, c3)),
+                         "range": "0.3 2.5"},
+                        {"type": "tabulated k",
+                         "data": "0.3 1e-6\n2.5 1e-7\n"}]}
+    material = CatalogMaterial(None, ymldict, index_cache_size=16)
+    waves = 1e-3*(0.4 + 0.1*np.floor(10*rnd_data))
+    w2 = (1e3*waves)**2
+    comparison = (np.sqrt(1 + b1*w2/(w2 - c1) + b2*w2/(w2 - c2)
+                          + b3*w2/(w2 - c3))
+                  + 1j*np.interp(1e3*waves, [0.3, 2.5], [1e-6, 1e-7]))
+    index = material.getIndex(None, waves)
+    assert np.shape(index) == np.shape(waves)
+    assert np.allclose(index, comparison)
+    assert np.allclose([material.getIndex(None, w) for w in waves],
+                       comparison)
+    assert material.index_cache_misses == len(np.unique(waves))
+    material.clearIndexCache()
+    material.getIndex(None, waves[0])
+    material.getIndex(None, waves[0])
+    assert (material.index_cache_hits, material.index_cache_misses) == (1, 1)
+    material.dummy = OptimizableVariable(name="dummy", value=1.)
+    material.clearIndexCache()
+    material.getIndex(None, waves[0])
+    material.dummy.setvalue(2.)
+    material.getIndex(None, waves[0])
+    material.getIndex(None, waves[0])
+    assert (material.index_cache_hits, material.index_cache_misses) == (1, 2)
+    material.index_cache_size = 1
+    material.getIndex(None, 2e-3)
+    material.getIndex(None, waves[0])
+    assert (material.index_cache_hits, material.index_cache_misses) == (1, 4)
+
+def write_glass_database(tmpdir):
+    """
+    Writes a refractiveindex.info database with N-BK7 and F2 to tmpdir.
+    """
+    tmpdir.join("library.yml").write(
+        "- SHELF: glass\n"
+        "  name: Glass\n"
+        "  content:\n"
+        "    - DIVIDER: Schott\n"
+        "    - BOOK: BK7\n"
+        "      name: BK7\n"
+        "      content:\n"
+        "        - PAGE: SCHOTT\n"
+        "          name: SCHOTT N-BK7\n"
+        "          path: glass/schott/N-BK7.yml\n"
+        "    - BOOK: F2\n"
+        "      name: F2\n"
+        "      content:\n"
+        "        - PAGE: SCHOTT\n"
+        "          name: SCHOTT F2\n"
+        "          path: glass/schott/F2.yml\n")
+    for (page, coefficients) in (
+            ("N-BK7", "0 1.03961212 0.00600069867 0.231792344 0.0200179144 "
+                      "1.01046945 103.560653"),
+            ("F2", "0 1.34533359 0.00997743871 0.209073176 0.0470450767 "
+                   "0.937357162 111.886764")):
+        tmpdir.join("glass", "schott", page + ".yml").write(
+            "DATA:\n"
+            "  - type: formula 2\n"
+            "    range: 0.32 2.5\n"
+            "    coefficients: " + coefficients + "\n", ensure=True)
+    return str(tmpdir)
+
+def test_glasscatalog_cache(tmpdir):
+    """
+    The glass catalog index and pages are taken from the cache file as long
+    as library.yml is unchanged. The file is only written if requested and
+    once per search, not for every page read.
+    """
+    database = write_glass_database(tmpdir)
+    cachefile = str(tmpdir.join("pyrate_catalog_cache.pickle"))
+
+    refractiveindex_dot_info_glasscatalog(database)
+    assert not os.path.exists(cachefile)
+
+    gcat = refractiveindex_dot_info_glasscatalog(database, cachefile=cachefile)
+    assert os.path.isfile(cachefile)
+    assert gcat.getDictOfLongNames() == {
+        "SCHOTT N-BK7": ("glass", "BK7", "SCHOTT"),
+        "SCHOTT F2": ("glass", "F2", "SCHOTT")}
+    assert gcat.findPagesWithLongNameContaining("F2").keys() == ["SCHOTT F2"]
+    writes = []
+    write_cache = gcat.write_cache
+    def count_writes():
+        writes.append(1)
+        write_cache()
+    gcat.write_cache = count_writes
+    f2 = gcat.getMaterialDict("glass", "F2", "SCHOTT")
+    assert len(writes) == 0
+    bk7 = gcat.getMaterialDictFromLongName("SCHOTT N-BK7")
+    assert len(writes) == 1
+    gcat.getMaterialDictFromLongName("SCHOTT N-BK7")
+    gcat.save_cache()
+    assert len(writes) == 1
+
+    # no yml file is parsed as long as the catalog is unchanged
+    def read_yml_file(ymlfilename):
+        raise AssertionError("parsed " + ymlfilename)
+    cached = refractiveindex_dot_info_glasscatalog(database, cachefile=cachefile)
+    cached.read_yml_file = read_yml_file
+    assert cached.getMaterialDictFromLongName("SCHOTT N-BK7") == bk7
+    assert cached.getMaterialDict("glass", "F2", "SCHOTT") == f2
+    nd = CatalogMaterial(None, bk7).getIndex(None, 0.5875618e-3)
+    assert abs(nd - 1.5168) < 1e-4
+
+    libraryfile = os.path.join(database, "library.yml")
+    os.utime(libraryfile, (0, os.path.getmtime(libraryfile) + 10.))
+    rebuilt = refractiveindex_dot_info_glasscatalog(database, cachefile=cachefile)
+    assert rebuilt.getPages("glass", "F2") == ["SCHOTT"]
+    uncached = refractiveindex_dot_info_glasscatalog(database)
+    assert uncached.getMaterialDictFromLongName("SCHOTT F2") == \
+        rebuilt.getMaterialDictFromLongName("SCHOTT F2")
+
+def test_glasscatalog_nearest_glass(tmpdir):
+    """
+    Glasses are found by nd, vd, PgF and by their six digit code; the glass
+    map is stored in the cache file.
+    """
+    database = write_glass_database(tmpdir)
+    cachefile = str(tmpdir.join("pyrate_catalog_cache.pickle"))
+    gcat = refractiveindex_dot_info_glasscatalog(database, cachefile=cachefile)
+    (locations, table) = gcat.getGlassTable()
+    bk7 = table[locations.index(("glass", "BK7", "SCHOTT"))]
+    f2 = table[locations.index(("glass", "F2", "SCHOTT"))]
+    assert np.allclose(bk7, (1.5168, 64.17, 0.5349), rtol=1e-3)
+    assert np.allclose(f2, (1.62004, 36.37, 0.5828), rtol=1e-3)
+    assert gcat.findPagesCloseTo_nd_vd_PgF(1.55, 55., num=2) == \
+        [("glass", "BK7", "SCHOTT"), ("glass", "F2", "SCHOTT")]
+    assert gcat.findPagesCloseTo_nd_vd_PgF(1.6, 40., 0.58) == \
+        [("glass", "F2", "SCHOTT")]
+    assert gcat.getMaterialDictCloseTo_nd_vd_PgF(1.52, 63., 0.53) == \
+        gcat.getMaterialDict("glass", "BK7", "SCHOTT")
+
+    def read_yml_file(ymlfilename):
+        raise AssertionError("parsed " + ymlfilename)
+    cached = refractiveindex_dot_info_glasscatalog(database, cachefile=cachefile)
+    cached.read_yml_file = read_yml_file
+    assert cached.findPagesCloseTo_nd_vd_PgF(1.62, 36.) == \
+        [("glass", "F2", "SCHOTT")]
+    assert gcat.getMaterialDictFromSchottCode(620364) == \
+        gcat.getMaterialDictCloseTo_nd_vd(1.62, 36.4) == \
+        gcat.getMaterialDict("glass", "F2", "SCHOTT")
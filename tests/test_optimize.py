@@ -22,10 +22,13 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 MA  02110-1301, USA.
 """
 
-from core.optimize import ClassWithOptimizableVariables, OptimizableVariable, Optimizer
-from core.optimize_backends import ScipyBackend, Newton1DBackend
+from core.optimize import ClassWithOptimizableVariables, OptimizableVariable, Optimizer, pool_initargs_error
+from core.optimize_backends import (ScipyBackend, Newton1DBackend,
+                                    ParticleSwarmBackend,
+                                    finite_difference_gradient)
 
 import numpy as np
+import copy
 
 #class ExampleSubClass(ClassWithOptimizableVariables):
 #    def __init__(self):
@@ -109,3 +112,164 @@ def test_optimization():
     assert np.isclose(os.X()**2 + os.Y()**2, os.Z())
 
     
+
+
+def test_parallel_merit_evaluation():
+    """
+    Batches of merit function evaluations in worker processes coincide
+    with serial evaluations; batch gradients drive scipy.
+    """
+    class ExampleOS(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleOS, self).__init__()
+            self.X = OptimizableVariable("variable", name="X", value=3.0)
+            self.Y = OptimizableVariable("variable", name="Y", value=2.0)
+
+    def testmerit(s):
+        return (s.X() - 1.)**2 + 10.*(s.Y() + 2.)**2
+
+    os = ExampleOS()
+    xs = np.random.random((5, 2))
+    optimi = Optimizer(os, testmerit, backend=ScipyBackend(), processes=2)
+    serial = optimi.MeritFunctionWrapperBatch(xs)
+    assert np.allclose(serial, (xs[:, 0] - 1.)**2 + 10.*(xs[:, 1] + 2.)**2)
+    optimi.openPool()
+    try:
+        assert optimi.pool is not None
+        assert np.allclose(optimi.MeritFunctionWrapperBatch(xs), serial)
+    finally:
+        optimi.closePool()
+    assert optimi.pool is None
+
+    grad = finite_difference_gradient(optimi.MeritFunctionWrapperBatch,
+                                      np.array([3., 2.]), dx=1e-7)
+    assert np.allclose(grad, [4., 80.], rtol=1e-4)
+
+    # nested merit functions are only transferable to forked workers
+    assert pool_initargs_error((testmerit,), forking=True) is None
+    assert pool_initargs_error((testmerit,), forking=False) is not None
+    assert pool_initargs_error((xs,), forking=False) is None
+
+    optimi.backend = ScipyBackend(method="BFGS", batchgradient=True)
+    optimi.run()
+    assert np.allclose([os.X(), os.Y()], [1., -2.], atol=1e-4)
+
+
+def test_particle_swarm():
+    """
+    Particle swarm evaluates every particle once per iteration and
+    respects variable intervals.
+    """
+    class ExampleOS(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleOS, self).__init__()
+            self.X = OptimizableVariable("variable", name="X", value=1.0)
+            self.Y = OptimizableVariable("variable", name="Y", value=1.0)
+
+    calls = []
+
+    def testmerit(s):
+        calls.append(1)
+        assert 0. <= s.X() <= 2.
+        return (s.X() + 1.)**2 + (s.Y() - 3.)**2
+
+    os = ExampleOS()
+    os.X.set_interval(0., 2.)
+    np.random.seed(1234)
+    optimi = Optimizer(os, testmerit,
+                       backend=ParticleSwarmBackend(num_particles=20,
+                                                    iterations=50, tol=1e-6))
+    optimi.run()
+    assert np.isclose(os.Y(), 3., atol=1e-2)
+    assert os.X() < 0.1
+    # at most (iterations + 1) batches plus initial and final merit in run()
+    assert len(calls) <= 20*51 + 2
+
+
+def test_merit_cache():
+    """
+    Memoized merit values lead to the same optimization result with
+    fewer merit function calls.
+    """
+    class ExampleOS(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleOS, self).__init__()
+            self.X = OptimizableVariable("variable", name="X", value=3.0)
+            self.Y = OptimizableVariable("variable", name="Y", value=20.0)
+
+    calls = []
+
+    def testmerit(s):
+        calls.append(1)
+        return (s.X()**2 + s.Y()**2 - 5.**2)**2
+
+    results = []
+    for cache_size in (0, 16):
+        os = ExampleOS()
+        optimi = Optimizer(os, testmerit,
+                           backend=Newton1DBackend(dx=1e-6, iterations=50),
+                           merit_cache_size=cache_size)
+        np.random.seed(4321)
+        del calls[:]
+        optimi.run()
+        results.append((os.X(), os.Y(), len(calls)))
+        assert optimi.merit_cache_misses == (len(calls) if cache_size else 0)
+    assert np.isclose(results[0][0], results[1][0])
+    assert np.isclose(results[0][1], results[1][1])
+    assert results[1][2] < results[0][2]
+
+    optimi = Optimizer(ExampleOS(), testmerit, backend=Newton1DBackend(),
+                       merit_cache_size=2, merit_cache_quantum=1e-3)
+    del calls[:]
+    optimi.MeritFunctionWrapper(np.array([1., 2.]))
+    optimi.MeritFunctionWrapper(np.array([1.0001, 2.]))
+    assert (len(calls), optimi.merit_cache_hits) == (1, 1)
+    optimi.MeritFunctionWrapper(np.array([2., 2.]))
+    optimi.MeritFunctionWrapper(np.array([3., 2.]))
+    optimi.MeritFunctionWrapper(np.array([1., 2.]))
+    assert (len(calls), optimi.merit_cache_misses) == (4, 4)
+
+
+def test_variable_registry():
+    """
+    Cached variable lists follow structural changes.
+    """
+    class ExampleOS(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleOS, self).__init__()
+            self.X = OptimizableVariable("variable", name="X", value=1.0)
+            self.Y = OptimizableVariable("fixed", name="Y", value=2.0)
+            self.parts = {}
+
+    os = ExampleOS()
+    assert set(os.getAllVariables()) == set([os.X, os.Y])
+    assert os.getActiveVariables() == [os.X]
+    (allvars, activevars) = os.getVariableRegistry()
+    assert os.getVariableRegistry()[0] is allvars
+
+    os.Y.changetype("variable")
+    assert set(os.getActiveVariables()) == set([os.X, os.Y])
+
+    part = ExampleOS()
+    os.parts["part"] = part
+    os.invalidateVariableRegistry()
+    assert len(os.getAllVariables()) == 4
+
+    os.Z = OptimizableVariable("variable", name="Z", value=3.0)
+    assert len(os.getActiveVariables()) == 4
+    os.setActiveValues(np.arange(4.))
+    assert np.all(os.getActiveValues() == np.arange(4.))
+
+    # objects never collected into a registry do not invalidate it
+    (allvars, activevars) = os.getVariableRegistry()
+    other = ExampleOS()
+    other.X.changetype("fixed")
+    assert os.getVariableRegistry()[0] is allvars
+    part.W = OptimizableVariable("variable", name="W", value=4.0)
+    assert len(os.getActiveVariables()) == 5
+
+    # the registry is not pickled or copied
+    assert "_ClassWithOptimizableVariables__registry" not in os.__getstate__()
+    copied = copy.copy(os)
+    assert "_ClassWithOptimizableVariables__registry" not in copied.__dict__
+    assert len(copied.getActiveVariables()) == 5
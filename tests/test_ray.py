@@ -0,0 +1,123 @@
+"""
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2017 Moritz Esslinger <moritz.esslinger@web.de>
+               and Johannes Hartung <j.hartung@gmx.net>
+               and     Uwe Lippmann <uwe.lippmann@web.de>
+               and    Thomas Heinze <t.heinze@fn.de>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+MA 02110-1301, USA.
+"""
+
+import numpy as np
+from core.ray import RayBundle
+
+def test_append_history():
+    """
+    Appending many points keeps the complete history and grows
+    the storage by doubling.
+    """
+    num_rays = 7
+    num_steps = 100
+    x0 = np.random.random((3, num_rays))
+    k0 = np.random.random((3, num_rays))
+    E0 = np.random.random((3, num_rays))
+    raybundle = RayBundle(x0, k0, E0)
+    xs = [x0]
+    for i in range(num_steps):
+        xnew = np.random.random((3, num_rays))
+        valid = np.ones(num_rays, dtype=bool)
+        valid[i % num_rays] = False
+        raybundle.append(xnew, k0, E0, valid)
+        xs.append(xnew)
+    assert np.shape(raybundle.x) == (num_steps + 1, 3, num_rays)
+    assert np.shape(raybundle.valid) == (num_steps + 1, num_rays)
+    assert raybundle.capacity >= num_steps + 1
+    assert raybundle.capacity < 2*(num_steps + 1)
+    assert np.allclose(raybundle.x, np.array(xs))
+    assert np.allclose(raybundle.x[-1], xs[-1])
+    # validity is cumulative
+    assert not np.any(raybundle.valid[-1])
+    assert np.all(raybundle.valid[0])
+
+def test_append_upcast_and_clone():
+    """
+    Real wave vectors followed by complex ones are stored without loss,
+    modifying the validity of the last point writes through and clones
+    are independent.
+    """
+    x0 = np.zeros((3, 2))
+    k0 = np.ones((3, 2))
+    raybundle = RayBundle(x0, k0, None, capacity=1)
+    k1 = k0 + complex(0, 1)*k0
+    raybundle.append(x0 + 1., k1, raybundle.Efield[-1], np.ones(2, dtype=bool))
+    assert np.allclose(raybundle.k[-1], k1)
+    assert np.allclose(raybundle.k[0], k0)
+    raybundle.valid[-1] = np.array([True, False])
+    assert np.all(raybundle.valid[-1] == np.array([True, False]))
+    cloned = raybundle.clone()
+    cloned.append(x0 + 2., k1, cloned.Efield[-1], np.ones(2, dtype=bool))
+    assert np.shape(raybundle.x)[0] == 2
+    assert np.shape(cloned.x)[0] == 3
+    assert np.all(cloned.valid[-1] == np.array([True, False]))
+
+def test_history_setters():
+    """
+    Assigning the k, Efield or valid history requires as many points
+    as the x history.
+    """
+    x0 = np.zeros((3, 2))
+    k0 = np.ones((3, 2))
+    raybundle = RayBundle(x0, k0, None)
+    raybundle.x = np.array([x0, x0 + 1.])
+    raybundle.k = np.array([k0, k0])
+    raybundle.Efield = np.array([k0, k0])
+    raybundle.valid = np.ones((2, 2), dtype=bool)
+    assert np.shape(raybundle.k) == (2, 3, 2)
+    assert np.shape(raybundle.valid) == (2, 2)
+    for name, value in [("k", np.array([k0])),
+                        ("Efield", np.array([k0, k0, k0])),
+                        ("valid", np.ones((1, 2), dtype=bool))]:
+        try:
+            setattr(raybundle, name, value)
+        except Exception:
+            pass
+        else:
+            assert False, "length mismatch of %s not detected" % (name,)
+    assert np.shape(raybundle.k) == (2, 3, 2)
+
+def test_poynting_directions():
+    """
+    Directions of a single history slot equal the ones of the whole history
+    and the explicit Poynting vector; for E perpendicular to real k they are
+    parallel to k.
+    """
+    num_rays = 5
+    x0 = np.random.random((3, num_rays))
+    k0 = np.random.random((3, num_rays))
+    E0 = np.cross(k0, np.random.random((3, num_rays)), axis=0)
+    raybundle = RayBundle(x0, k0, E0)
+    k1 = np.random.random((3, num_rays)) + 1j*np.random.random((3, num_rays))
+    E1 = np.random.random((3, num_rays)) + 1j*np.random.random((3, num_rays))
+    raybundle.append(x0, k1, E1, np.ones(num_rays, dtype=bool))
+    directions = raybundle.returnKtoD()
+    assert np.allclose(raybundle.returnKtoDAt(0), directions[0])
+    assert np.allclose(raybundle.returnKtoDAt(), directions[1])
+    assert np.allclose(directions[0], k0/np.linalg.norm(k0, axis=0))
+    poynting = np.real(np.sum(np.conj(E1)*E1, axis=0)*k1 -
+                       np.sum(E1*k1, axis=0)*np.conj(E1))
+    assert np.allclose(directions[1],
+                       poynting/np.linalg.norm(poynting, axis=0))
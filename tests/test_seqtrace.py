@@ -0,0 +1,302 @@
+"""
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2017 Moritz Esslinger <moritz.esslinger@web.de>
+               and Johannes Hartung <j.hartung@gmx.net>
+               and     Uwe Lippmann <uwe.lippmann@web.de>
+               and    Thomas Heinze <t.heinze@fn.de>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+MA 02110-1301, USA.
+"""
+
+import numpy as np
+from core import raster
+from core.material_isotropic import ConstantIndexGlass, ModelGlass
+from core.material_anisotropic import AnisotropicMaterial
+from core import surfShape
+from core.optical_element import OpticalElement
+from core.surface import Surface
+from core.optical_system import OpticalSystem
+from core.optical_system_analysis import OpticalSystemAnalysis
+from core.ray import RayBundle, raybundle_chunks, merge_raybundles
+from core.ray_analysis import RayBundleAnalysis
+from core.aperture import CircularAperture
+from core.localcoordinates import LocalCoordinates
+from core.helpers import collimated_bundle
+
+def build_doublet(dispersive=False, anisotropic=False):
+    """
+    Doublet from demo_doublet.py (without plotting).
+    If dispersive, the glasses are Conrady model glasses.
+    If anisotropic, the first lens is an uniaxial crystal with tilted
+    optical axis.
+    """
+    s = OpticalSystem()
+    lc0 = s.addLocalCoordinateSystem(LocalCoordinates(name="stop", decz=0.0), refname=s.rootcoordinatesystem.name)
+    lc1 = s.addLocalCoordinateSystem(LocalCoordinates(name="surf1", decz=-1.048), refname=lc0.name)
+    lc2 = s.addLocalCoordinateSystem(LocalCoordinates(name="surf2", decz=4.0), refname=lc1.name)
+    lc3 = s.addLocalCoordinateSystem(LocalCoordinates(name="surf3", decz=2.5), refname=lc2.name)
+    lc4 = s.addLocalCoordinateSystem(LocalCoordinates(name="image", decz=97.2), refname=lc3.name)
+    stopsurf = Surface(lc0)
+    frontsurf = Surface(lc1, shape=surfShape.Conic(lc1, curv=1./62.8), apert=CircularAperture(lc1, 12.7))
+    cementsurf = Surface(lc2, shape=surfShape.Conic(lc2, curv=-1./45.7), apert=CircularAperture(lc2, 12.7))
+    rearsurf = Surface(lc3, shape=surfShape.Conic(lc3, curv=-1./128.2), apert=CircularAperture(lc3, 12.7))
+    image = Surface(lc4)
+    elem = OpticalElement(lc0, name="thorlabs_AC_254-100-A")
+    if dispersive:
+        elem.addMaterial("BK7", ModelGlass(lc1))
+        elem.addMaterial("SF5", ModelGlass(lc2, n0_A_B=(1.6416, 0.0158e-3, 0.00075*(1e-3)**3.5)))
+    elif anisotropic:
+        (c, sn) = (np.cos(0.5), np.sin(0.5))
+        rotation = np.array([[1., 0., 0.], [0., c, -sn], [0., sn, c]])
+        eps = np.dot(rotation, np.dot(np.diag([1.5**2, 1.5**2, 1.6**2]), rotation.T))
+        elem.addMaterial("BK7", AnisotropicMaterial(lc1, eps))
+        elem.addMaterial("SF5", ConstantIndexGlass(lc2, n=1.6727))
+    else:
+        elem.addMaterial("BK7", ConstantIndexGlass(lc1, n=1.5168))
+        elem.addMaterial("SF5", ConstantIndexGlass(lc2, n=1.6727))
+    elem.addSurface("stop", stopsurf, (None, None))
+    elem.addSurface("front", frontsurf, (None, "BK7"))
+    elem.addSurface("cement", cementsurf, ("BK7", "SF5"))
+    elem.addSurface("rear", rearsurf, ("SF5", None))
+    elem.addSurface("image", image, (None, None))
+    s.addElement("AC254-100", elem)
+    sysseq = [("AC254-100", [("stop", {"is_stop":True}), ("front", {}),
+                             ("cement", {}), ("rear", {}), ("image", {})])]
+    return (s, sysseq)
+
+def test_seqtrace_chunked():
+    """
+    Chunked trace delivers the same final rays as a full trace
+    and the streamed spot statistics coincide with the direct ones.
+    """
+    (s, sysseq) = build_doublet()
+    (x0, k0, E0) = collimated_bundle(200, -5., 0., 11.43, raster.RectGrid())
+    (num_dims, num_rays) = np.shape(x0)
+    rpaths = s.seqtrace(RayBundle(x0, k0, E0), sysseq)
+    final_full = rpaths[0].raybundles[-1]
+
+    final_chunks = [rbs[0] for rbs in s.seqtrace_chunked(raybundle_chunks(x0, k0, E0, 17), sysseq)]
+    assert len(final_chunks) == int(np.ceil(num_rays/17.))
+    assert np.allclose(np.hstack([rb.x[-1] for rb in final_chunks]), final_full.x[-1])
+    assert np.all(np.hstack([rb.rayID for rb in final_chunks]) == final_full.rayID)
+
+    (centroid, rms, num_valid) = OpticalSystemAnalysis(s).getSpotChunked(raybundle_chunks(x0, k0, E0, 17), sysseq)
+    xvalid = final_full.x[-1][:, final_full.valid[-1]]
+    xvalid = s.elements["AC254-100"].surfaces["image"].rootcoordinatesystem.returnGlobalToLocalPoints(xvalid)
+    centroid_full = np.mean(xvalid, axis=1)
+    rms_full = np.sqrt(np.sum((xvalid - centroid_full[:, np.newaxis])**2)/(num_valid - 1))
+    assert num_valid == np.shape(xvalid)[1]
+    assert np.allclose(centroid, centroid_full)
+    assert np.isclose(rms, rms_full)
+
+def test_spot_chunked_decentered():
+    """
+    Streamed spot statistics of a tiny spot far off the local origin of
+    the image surface coincide with the direct ones.
+    """
+    s = OpticalSystem()
+    lc0 = s.addLocalCoordinateSystem(LocalCoordinates(name="stop", decz=0.0), refname=s.rootcoordinatesystem.name)
+    lc1 = s.addLocalCoordinateSystem(LocalCoordinates(name="image", decz=10.0), refname=lc0.name)
+    elem = OpticalElement(lc0, name="free")
+    elem.addSurface("stop", Surface(lc0), (None, None))
+    elem.addSurface("image", Surface(lc1), (None, None))
+    s.addElement("free", elem)
+    sysseq = [("free", [("stop", {"is_stop":True}), ("image", {})])]
+
+    # spot radius 10 nm, 50 mm off axis
+    (x0, k0, E0) = collimated_bundle(200, -5., 50., 1e-5, raster.RectGrid())
+    osa = OpticalSystemAnalysis(s)
+    (spot_xy, rms_direct) = osa.getSpot(s.seqtrace(RayBundle(x0, k0, E0), sysseq)[0], sysseq)
+    (centroid, rms, num_valid) = osa.getSpotChunked(raybundle_chunks(x0, k0, E0, 17), sysseq)
+    assert num_valid == np.shape(spot_xy)[1]
+    assert np.allclose(centroid[:2], np.mean(spot_xy, axis=1))
+    assert rms_direct > 0.
+    assert np.isclose(rms, rms_direct, rtol=1e-6)
+
+def test_seqtrace_parallel():
+    """
+    Parallel trace delivers the same ray histories as a serial trace.
+    """
+    (s, sysseq) = build_doublet()
+    (x0, k0, E0) = collimated_bundle(200, -5., 0., 11.43, raster.RectGrid())
+    rpaths = s.seqtrace(RayBundle(x0, k0, E0), sysseq)
+    rpaths_par = s.seqtrace_parallel(RayBundle(x0, k0, E0), sysseq, processes=2, chunksize=23)
+    assert len(rpaths_par) == len(rpaths)
+    assert len(rpaths_par[0].raybundles) == len(rpaths[0].raybundles)
+    for (rb, rb_par) in zip(rpaths[0].raybundles, rpaths_par[0].raybundles):
+        assert np.allclose(rb.x, rb_par.x)
+        assert np.allclose(rb.k, rb_par.k)
+        assert np.allclose(rb.Efield, rb_par.Efield)
+        assert np.all(rb.valid == rb_par.valid)
+        assert np.all(rb.rayID == rb_par.rayID)
+
+def test_seqtrace_parallel_invalid_rays():
+    """
+    Parallel trace keeps the compaction threshold and the invalid rays of
+    the initial RayBundle.
+    """
+    (s, sysseq) = build_doublet()
+    # radius larger than the apertures: some rays are vignetted
+    (x0, k0, E0) = collimated_bundle(200, -5., 0., 15., raster.RectGrid())
+
+    def initialbundle(threshold):
+        rb = RayBundle(x0, k0, E0, compaction_threshold=threshold)
+        rb.valid[0][::7] = False
+        return rb
+
+    # invalid rays are carried along: identical histories
+    final = s.seqtrace(initialbundle(1.), sysseq)[0].raybundles[-1]
+    final_par = s.seqtrace_parallel(initialbundle(1.), sysseq, processes=2, chunksize=23)[0].raybundles[-1]
+    assert np.shape(final_par.x)[2] == np.shape(x0)[1]
+    assert not np.any(final_par.valid[-1][::7])
+    assert final_par.compaction_threshold == 1.
+    assert np.all(final.valid == final_par.valid)
+    assert np.all(final.rayID == final_par.rayID)
+    assert np.allclose(final.x, final_par.x)
+
+    # compaction decided per chunk: the valid rays coincide
+    final = s.seqtrace(initialbundle(0.5), sysseq)[0].raybundles[-1]
+    final_par = s.seqtrace_parallel(initialbundle(0.5), sysseq, processes=2, chunksize=23)[0].raybundles[-1]
+    valid = final.valid[-1]
+    valid_par = final_par.valid[-1]
+    assert np.all(final.rayID[valid] == final_par.rayID[valid_par])
+    assert np.allclose(final.x[-1][:, valid], final_par.x[-1][:, valid_par])
+    assert not np.any(np.in1d(final_par.rayID[valid_par], np.arange(0, np.shape(x0)[1], 7)))
+
+def test_seqtrace_record():
+    """
+    Recording only selected surfaces keeps the same final RayBundle.
+    """
+    (s, sysseq) = build_doublet()
+    (x0, k0, E0) = collimated_bundle(50, -5., 0., 11.43, raster.RectGrid())
+    rpaths = s.seqtrace(RayBundle(x0, k0, E0), sysseq)
+    final_full = rpaths[0].raybundles[-1]
+
+    rpaths_last = s.seqtrace(RayBundle(x0, k0, E0), sysseq, record="last")
+    assert len(rpaths_last[0].raybundles) == 1
+    assert np.allclose(rpaths_last[0].raybundles[-1].x, final_full.x)
+    assert np.all(rpaths_last[0].raybundles[-1].valid == final_full.valid)
+
+    rpaths_sel = s.seqtrace(RayBundle(x0, k0, E0), sysseq, record=["stop", ("AC254-100", "cement")])
+    # bundles starting at stop, cement, and image (last)
+    assert len(rpaths_sel[0].raybundles) == 3
+    assert np.allclose(rpaths_sel[0].raybundles[0].x, rpaths[0].raybundles[2].x)
+    assert np.allclose(rpaths_sel[0].raybundles[1].x, rpaths[0].raybundles[4].x)
+    assert np.allclose(rpaths_sel[0].raybundles[-1].x, final_full.x)
+
+    # surface keys are qualified by their element, "stop" is no surface key
+    rpaths_stop = s.seqtrace(RayBundle(x0, k0, E0), sysseq, record=[("AC254-100", "stop")])
+    assert len(rpaths_stop[0].raybundles) == 2
+    assert np.allclose(rpaths_stop[0].raybundles[0].x, rpaths_sel[0].raybundles[0].x)
+    assert len(s.seqtrace(RayBundle(x0, k0, E0), sysseq, record=[("other", "cement")])[0].raybundles) == 1
+
+def test_seqtrace_compaction():
+    """
+    Removing vignetted rays (compaction_threshold=0) or carrying them 
+    along (compaction_threshold=1) leads to the same valid final rays.
+    """
+    (s, sysseq) = build_doublet()
+    # radius larger than the apertures: some rays are vignetted
+    (x0, k0, E0) = collimated_bundle(100, -5., 0., 15., raster.RectGrid())
+    final_compact = s.seqtrace(RayBundle(x0, k0, E0, compaction_threshold=0.), sysseq)[0].raybundles[-1]
+    final_full = s.seqtrace(RayBundle(x0, k0, E0, compaction_threshold=1.), sysseq)[0].raybundles[-1]
+    
+    (num_dims, num_rays) = np.shape(x0)
+    assert np.shape(final_full.x)[2] == num_rays
+    assert np.all(final_compact.valid[-1])
+    assert 0 < np.shape(final_compact.x)[2] < num_rays
+    
+    valid = final_full.valid[-1]
+    assert np.all(final_compact.rayID == final_full.rayID[valid])
+    assert np.allclose(final_compact.x[:, :, :], final_full.x[:, :, valid])
+
+def test_seqtrace_total_internal_reflection():
+    """
+    Rays lost by total internal reflection (a minority of the bundle) 
+    are removed by default and contribute no NaN to the spot or to a
+    merit function using all final positions.
+    """
+    s = OpticalSystem()
+    lc0 = s.addLocalCoordinateSystem(LocalCoordinates(name="stop", decz=0.0), refname=s.rootcoordinatesystem.name)
+    lc1 = s.addLocalCoordinateSystem(LocalCoordinates(name="front", decz=5.0), refname=lc0.name)
+    lc2 = s.addLocalCoordinateSystem(LocalCoordinates(name="rear", decz=15.0), refname=lc1.name)
+    lc3 = s.addLocalCoordinateSystem(LocalCoordinates(name="image", decz=20.0), refname=lc2.name)
+    elem = OpticalElement(lc0, name="tir")
+    elem.addMaterial("glass", ConstantIndexGlass(lc1, n=1.5))
+    elem.addSurface("stop", Surface(lc0), (None, None))
+    elem.addSurface("front", Surface(lc1), (None, "glass"))
+    # rays higher than 2/3 of the radius are totally reflected
+    elem.addSurface("rear", Surface(lc2, shape=surfShape.Conic(lc2, curv=-0.1)), ("glass", None))
+    elem.addSurface("image", Surface(lc3), (None, None))
+    s.addElement("tir", elem)
+    sysseq = [("tir", [("stop", {"is_stop":True}), ("front", {}), ("rear", {}), ("image", {})])]
+
+    (x0, k0, E0) = collimated_bundle(100, -5., 0., 7.5, raster.RectGrid())
+    rpath = s.seqtrace(RayBundle(x0, k0, E0), sysseq)[0]
+    final = rpath.raybundles[-1]
+    assert 0 < np.shape(final.x)[2] < np.shape(x0)[1]
+    assert np.all(final.valid[-1])
+    assert not np.any(np.isnan(final.x[-1]))
+    merit = np.sum(final.x[-1, 0, :]**2 + final.x[-1, 1, :]**2)
+    assert np.isfinite(merit)
+    (spot_xy, rmscentroidsize) = OpticalSystemAnalysis(s).getSpot(rpath, sysseq)
+    assert not np.any(np.isnan(spot_xy))
+    assert np.isfinite(rmscentroidsize)
+
+def test_seqtrace_polychromatic():
+    """
+    One trace of a polychromatic RayBundle (per-ray wavelengths) equals
+    separate monochromatic traces, also if vignetted rays are removed.
+    """
+    (s, sysseq) = build_doublet(dispersive=True)
+    (x0, k0, E0) = collimated_bundle(100, -5., 0., 15., raster.RectGrid())
+    waves = [0.4861e-3, 0.5876e-3, 0.6563e-3]
+    mono = [RayBundle(x0, k0, E0, wave=w, compaction_threshold=1.) for w in waves]
+    poly = merge_raybundles([RayBundle(x0, k0, E0, wave=w) for w in waves])
+    assert poly.isPolychromatic()
+    poly.compaction_threshold = 0.
+    final_poly = s.seqtrace(poly, sysseq)[0].raybundles[-1]
+    assert np.all(final_poly.valid[-1])
+    for (w, rb) in zip(waves, mono):
+        final_mono = s.seqtrace(rb, sysseq)[0].raybundles[-1]
+        valid = final_mono.valid[-1]
+        mask = final_poly.returnWaveMask(w)
+        assert np.all(final_poly.rayID[mask] == final_mono.rayID[valid])
+        assert np.allclose(final_poly.x[:, :, mask], final_mono.x[:, :, valid])
+        assert np.isclose(RayBundleAnalysis(final_poly, wave=w).getRMSspotSizeCentroid(),
+                          RayBundleAnalysis(final_mono).getRMSspotSizeCentroid())
+    # dispersion separates the colours
+    assert not np.allclose(final_poly.x[-1, :, final_poly.returnWaveMask(waves[0])],
+                           final_poly.x[-1, :, final_poly.returnWaveMask(waves[2])])
+
+def test_seqtrace_polychromatic_anisotropic():
+    """
+    Polychromatic RayBundles keep one wavelength per ray when anisotropic
+    materials double the rays (splitup=False).
+    """
+    (s, sysseq) = build_doublet(anisotropic=True)
+    (x0, k0, E0) = collimated_bundle(20, -5., 0., 5., raster.RectGrid())
+    waves = [0.4861e-3, 0.6563e-3]
+    poly = merge_raybundles([RayBundle(x0, k0, E0, wave=w) for w in waves])
+    final_poly = s.seqtrace(poly, sysseq)[0].raybundles[-1]
+    assert np.shape(final_poly.wave) == (np.shape(final_poly.x)[2],)
+    for w in waves:
+        final_mono = s.seqtrace(RayBundle(x0, k0, E0, wave=w), sysseq)[0].raybundles[-1]
+        mask = final_poly.returnWaveMask(w)
+        assert np.shape(final_mono.x)[2] == 2*np.shape(x0)[1]
+        assert np.all(final_poly.rayID[mask] == final_mono.rayID)
+        assert np.allclose(final_poly.x[-1][:, mask], final_mono.x[-1])
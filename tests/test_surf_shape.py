@@ -23,14 +23,22 @@ MA  02110-1301, USA.
 """
 
 import math
-from hypothesis import given
+import os
+import subprocess
+import tempfile
+import shutil
+import pytest
+from hypothesis import given, settings
 from hypothesis.strategies import floats
 from hypothesis.extra.numpy import arrays
 import numpy as np
-from core.surfShape import Conic, Asphere, Biconic, XYPolynomials
+from core.surfShape import (Conic, Asphere, Biconic, XYPolynomials, GridSag,
+                            ZernikeFringe, ZMXDLLShape)
 from core.localcoordinates import LocalCoordinates
+from core.ray import RayBundle
 
 # pylint: disable=no-value-for-parameter
+@settings(deadline=None)
 @given(test_vector=arrays(np.float, (2, 10), elements=floats(0, 1)))
 def test_sag(test_vector):
     """
@@ -326,4 +334,206 @@ def xypolynomials_grad(test_vector):
     comparison[2, :] = 1.
         
     assert np.allclose(gradient, comparison)
-    
\ No newline at end of file
+    
+@settings(deadline=None)
+@given(test_vector=arrays(np.float, (2, 10), elements=floats(0, 1)))
+def test_explicit_intersect(test_vector):
+    """
+    Intersection points of explicit shapes lie on the surface and on the rays.
+    """
+    coordinate_system = LocalCoordinates(name="root", decz=5.)
+    shapes = [Asphere(coordinate_system, curv=1./20., cc=-1.5,
+                      coefficients=[1e-3, -1e-6, 1e-8]),
+              Biconic(coordinate_system, curvx=1./30., curvy=1./20., ccx=-0.5,
+                      coefficients=[(1e-4, 0.1), (1e-7, -1.)]),
+              XYPolynomials(coordinate_system,
+                            coefficients=[(2, 0, 0.01), (0, 2, 0.02),
+                                          (2, 1, 1e-4)])]
+    x0 = np.zeros((3, 10))
+    x0[0:2] = (2*test_vector - 1.)*5.
+    k0 = np.zeros((3, 10))
+    k0[0] = 0.1
+    k0[2] = 1.
+    k0 = k0/np.linalg.norm(k0, axis=0)
+    for shape in shapes:
+        raybundle = RayBundle(x0, k0, None)
+        shape.intersect(raybundle)
+        intersection = raybundle.x[-1]
+        assert np.all(raybundle.valid[-1])
+        assert np.allclose(intersection[2] - 5.,
+                           shape.getSag(intersection[0], intersection[1]))
+        assert np.allclose(np.cross(intersection - x0, k0, axis=0), 0)
+
+@settings(deadline=None)
+@given(test_vector=arrays(np.float, (2, 10), elements=floats(0, 1)))
+def test_gridsag(test_vector):
+    """
+    Cubic grid sag reproduces sag, gradient and Hessian of a cubic polynomial.
+    """
+    coordinate_system = LocalCoordinates(name="root")
+    xlinspace = np.linspace(-10., 10., 21)
+    ylinspace = np.linspace(-8., 8., 17)
+    (xgrid, ygrid) = np.meshgrid(xlinspace, ylinspace)
+    zgrid = 0.01*xgrid**2 + 0.02*ygrid**2 + 0.001*xgrid*ygrid + 1e-4*xgrid**3
+    shape = GridSag(coordinate_system, (xlinspace, ylinspace, zgrid))
+    x = (2*test_vector[0] - 1.)*10.
+    y = (2*test_vector[1] - 1.)*8.
+    sag = shape.getSag(x, y)
+    gradient = shape.getGrad(x, y)
+    hessian = shape.getHessian(x, y)
+    assert np.allclose(sag, 0.01*x**2 + 0.02*y**2 + 0.001*x*y + 1e-4*x**3)
+    assert np.allclose(gradient[0], -(0.02*x + 0.001*y + 3e-4*x**2))
+    assert np.allclose(gradient[1], -(0.04*y + 0.001*x))
+    assert np.allclose(gradient[2], 1.)
+    assert np.allclose(hessian[0, 0], -(0.02 + 6e-4*x))
+    assert np.allclose(hessian[0, 1], -0.001)
+    assert np.allclose(hessian[1, 1], -0.04)
+
+    linear = GridSag(coordinate_system, (xlinspace, ylinspace, zgrid), kind="linear", copy=False)
+    assert np.allclose(linear.getSag(xlinspace, np.zeros_like(xlinspace)), zgrid[8])
+    for (args, kwargs) in [(("linear",), {}), ((), {"kind": "spline"}), ((), {"bounds_error": True})]:
+        try:
+            GridSag(coordinate_system, (xlinspace, ylinspace, zgrid), *args, **kwargs)
+        except Exception:
+            pass
+        else:
+            assert False, "unsupported interp2d arguments not rejected"
+
+@settings(deadline=None)
+@given(test_vector=arrays(np.float, (2, 10), elements=floats(-1, 1)))
+def test_zernike_fringe(test_vector):
+    """
+    Fringe Zernike sag, gradient and Hessian equal explicit calculation
+    for a combination of Z4 (defocus), Z5, Z6 (astigmatism) and 
+    Z9 (spherical aberration).
+    """
+    coordinate_system = LocalCoordinates(name="root")
+    normradius = 2.
+    (c4, c5, c6, c9) = (0.1, -0.2, 0.3, 0.05)
+    shape = ZernikeFringe(coordinate_system, normradius=normradius,
+                          coefficients=[0., 0., 0., c4, c5, c6, 0., 0., c9])
+    x = test_vector[0]*normradius
+    y = test_vector[1]*normradius
+    xp = x/normradius
+    yp = y/normradius
+    r2 = xp**2 + yp**2
+    sag = shape.getSag(x, y)
+    gradient = shape.getGrad(x, y)
+    hessian = shape.getHessian(x, y)
+    comparison = (c4*(2*r2 - 1) + c5*(xp**2 - yp**2) + c6*2*xp*yp
+                  + c9*(6*r2**2 - 6*r2 + 1))
+    dzdxp = c4*4*xp + c5*2*xp + c6*2*yp + c9*(24*r2*xp - 12*xp)
+    dzdyp = c4*4*yp - c5*2*yp + c6*2*xp + c9*(24*r2*yp - 12*yp)
+    d2zdxp2 = c4*4 + c5*2 + c9*(24*r2 + 48*xp**2 - 12)
+    d2zdxpdyp = c6*2 + c9*48*xp*yp
+    d2zdyp2 = c4*4 - c5*2 + c9*(24*r2 + 48*yp**2 - 12)
+    assert np.allclose(sag, comparison)
+    assert np.allclose(gradient[0], -dzdxp/normradius)
+    assert np.allclose(gradient[1], -dzdyp/normradius)
+    assert np.allclose(gradient[2], 1.)
+    assert np.allclose(hessian[0, 0], -d2zdxp2/normradius**2)
+    assert np.allclose(hessian[0, 1], -d2zdxpdyp/normradius**2)
+    assert np.allclose(hessian[1, 1], -d2zdyp2/normradius**2)
+
+STUB_USER_SURFACE = """
+#include <math.h>
+typedef struct
+{
+    double x, y, z, l, m, n, ln, mn, nn, path, sag1, sag2;
+    double index, dndx, dndy, dndz, rel_surf_tran;
+    double udreserved1, udreserved2, udreserved3, udreserved4;
+    char string[20];
+} USER_DATA;
+typedef struct
+{
+    int type, numb, surf, wave;
+    double wavelength, pwavelength, n1, n2, cv, thic, sdia, k;
+    double param[9];
+    double fdreserved1, fdreserved2, fdreserved3, fdreserved4;
+    double xdata[201];
+    char glass[21];
+} FIXED_DATA;
+/* conic shifted by piston param[1] */
+int UserDefinedSurface(USER_DATA *UD, FIXED_DATA *FD)
+{
+    double c = FD->cv, k = FD->k, z = UD->z - FD->param[1];
+    double a, b, d, t;
+    switch (FD->type)
+    {
+    case 3:
+        UD->sag1 = c*(UD->x*UD->x + UD->y*UD->y)/
+            (1. + sqrt(1. - (1. + k)*c*c*(UD->x*UD->x + UD->y*UD->y)))
+            + FD->param[1];
+        UD->sag2 = UD->sag1;
+        return 0;
+    case 5:
+        a = c*(UD->l*UD->l + UD->m*UD->m + (1. + k)*UD->n*UD->n);
+        b = c*(UD->x*UD->l + UD->y*UD->m + (1. + k)*z*UD->n) - UD->n;
+        d = c*(UD->x*UD->x + UD->y*UD->y + (1. + k)*z*z) - 2.*z;
+        if (b*b - a*d < 0.)
+            return -1;
+        t = d/(-b + sqrt(b*b - a*d));
+        UD->x += t*UD->l;
+        UD->y += t*UD->m;
+        UD->z += t*UD->n;
+        return 0;
+    }
+    return -1;
+}
+"""
+
+@pytest.fixture(scope="module")
+def zmx_dll_files():
+    """
+    Compiles the stub user surface with and without the batched entry point.
+    """
+    tmpdir = tempfile.mkdtemp()
+    source = os.path.join(tmpdir, "us_stub.c")
+    with open(source, "w") as filehandle:
+        filehandle.write(STUB_USER_SURFACE)
+    shim = os.path.join(os.path.dirname(__file__), "..", "core",
+                        "zmx_usersurface_array.c")
+    single = os.path.join(tmpdir, "us_stub.so")
+    batched = os.path.join(tmpdir, "us_stub_array.so")
+    try:
+        subprocess.check_call(["gcc", "-shared", "-fpic", "-o", single,
+                               source, "-lm"])
+        subprocess.check_call(["gcc", "-shared", "-fpic", "-o", batched,
+                               source, shim, "-lm"])
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(tmpdir)
+        pytest.skip("no C compiler available")
+    yield (single, batched)
+    shutil.rmtree(tmpdir)
+
+@settings(deadline=None)
+@given(test_vector=arrays(np.float, (2, 10), elements=floats(0, 1)))
+def test_zmx_dll_shape(zmx_dll_files, test_vector):
+    """
+    Sag and intersection from a compiled user surface equal the conic,
+    with and without the batched entry point.
+    """
+    coordinate_system = LocalCoordinates(name="root", decz=5.)
+    conic = Conic(coordinate_system, curv=1./20., cc=-0.5)
+    x0 = np.zeros((3, 10))
+    x0[0:2] = (2*test_vector - 1.)*5.
+    k0 = np.zeros((3, 10))
+    k0[0] = 0.1
+    k0[2] = 1.
+    k0 = k0/np.linalg.norm(k0, axis=0)
+    raybundle = RayBundle(x0, k0, None)
+    conic.intersect(raybundle)
+    for (dllfile, hasarray) in zip(zmx_dll_files, (False, True)):
+        shape = ZMXDLLShape(coordinate_system, dllfile,
+                            param_dict={"piston": (1, 0.)},
+                            curv=1./20., cc=-0.5)
+        assert (shape.us_surf_array is not None) == hasarray
+        sag = shape.getSag(x0[0], x0[1])
+        assert np.allclose(sag, conic.getSag(x0[0], x0[1]))
+        shape.param[1].setvalue(0.1)
+        assert np.allclose(shape.getSag(x0[0], x0[1]), sag + 0.1)
+        shape.param[1].setvalue(0.)
+        dllbundle = RayBundle(x0, k0, None)
+        shape.intersect(dllbundle)
+        assert np.all(dllbundle.valid[-1])
+        assert np.allclose(dllbundle.x[-1], raybundle.x[-1])